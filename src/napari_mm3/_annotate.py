@@ -21,6 +21,8 @@ import yaml
 import os
 import glob
 
+from ._function import load_stack, infer_output_format
+
 
 class Annotate(Container):
     def __init__(self, napari_viewer):
@@ -88,31 +90,15 @@ class Annotate(Container):
         fov = self.get_cur_fov(specs)
         peak = self.get_cur_peak(specs)
 
-        data_directory = self.data_directory_widget.value
-        experiment_name = self.experiment_name_widget.value
-
-        img_filename = (
-            data_directory
-            / self.analysis_folder_widget.value
-            / "channels"
-            / f"{experiment_name}_xy{fov:03d}_p{peak:04d}_c1.tif"
-        )
-        mask_filename = (
-            data_directory
-            / self.analysis_folder_widget.value
-            / "segmented"
-            / f"{experiment_name}_xy{fov:03d}_p{peak:04d}_seg_unet.tif"
-        )
-
-        with tiff.TiffFile(mask_filename) as tif:
-            mask_stack = tif.asarray()
-        with tiff.TiffFile(img_filename) as tif:
-            img_stack = tif.asarray()
+        # the stacks are read in the format Compile wrote them in
+        params = self.stack_params()
+        img_stack = load_stack(params, fov, peak, color="c1")
 
         self.viewer.layers.clear()
         self.viewer.add_image(img_stack)
 
         try:
+            mask_stack = load_stack(params, fov, peak, color="seg_unet")
             self.viewer.add_labels(mask_stack, name="Labels")
         except:
             pass
@@ -123,6 +109,21 @@ class Annotate(Container):
             empty = np.zeros(np.shape(img_stack), dtype=int)
             self.viewer.add_labels(empty, name="Labels")
 
+    def stack_params(self):
+        """Parameters load_stack needs to find the stacks of the analysis folder."""
+        params = dict()
+        params["experiment_name"] = self.experiment_name_widget.value
+        params["ana_dir"] = os.path.join(
+            self.data_directory_widget.value, self.analysis_folder_widget.value
+        )
+        params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+        params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
+        params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
+        params["seg_dir"] = os.path.join(params["ana_dir"], "segmented")
+        params["seg_img"] = "seg_unet"
+        params["output"] = infer_output_format(params)
+        return params
+
     def next_peak(self):
         self.save_out()
         self.peak_id += 1
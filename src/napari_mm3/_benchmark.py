@@ -0,0 +1,831 @@
+"""Benchmarks for the processing steps of mm3 on synthetic data.
+
+Run with
+
+    python -m napari_mm3._benchmark
+
+to time the current implementations against the ones they replaced, and with
+
+    python -m napari_mm3._benchmark --pipeline results.json
+
+to run the pipeline stage by stage on a synthetic experiment (see _synthetic) and
+save the time and peak memory of each stage, and of the steps of each stage from
+the run report (see _report), to results.json.
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import re
+import shutil
+import struct
+import tempfile
+import time
+import traceback
+import h5py
+import numpy as np
+import yaml
+
+from pathlib import Path
+from scipy.signal import find_peaks_cwt
+from skimage.feature import match_template
+
+from ._compile import (
+    find_channel_locs_stack,
+    parse_elements_tag,
+    compile,
+    compile_gen_params,
+)
+from ._function import (
+    hdf5_dataset_kwargs,
+    load_specs,
+    load_time_table,
+    find_all_cell_intensities,
+    template_spectra,
+)
+from ._subtract import subtract, subtract_prepare_params, find_empty_offsets
+from ._segment_otsu import segmentOTSU
+from ._track import Track_Cells, track_update_params
+from ._synthetic import (
+    write_synthetic_experiment,
+    grow_channel_cells,
+    render_fov_frame,
+)
+from ._report import peak_rss_mb, load_run_report, summarize_run_report
+from ._catalog import load_catalog
+
+
+### Synthetic data ###
+def synthetic_channel_frames(
+    n_frames=100,
+    rows=400,
+    cols=1200,
+    n_channels=24,
+    channel_width=10,
+    channel_separation=45,
+    noise=20,
+    seed=0,
+):
+    """Makes a stack of phase contrast like mother machine frames.
+
+    Channels are bright bars on a dark background which jitter by a few pixels
+    between frames, as they would with stage drift.
+
+    Returns
+    frames : np.ndarray
+        uint16 array (n_frames, rows, cols).
+    true_peaks : np.ndarray
+        int array (n_frames, n_channels) of the channel centers in x.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    x0 = (cols - (n_channels - 1) * channel_separation) // 2
+    centers = x0 + channel_separation * np.arange(n_channels)
+    closed_end = rows // 10
+    open_end = rows - rows // 6
+
+    frames = np.empty((n_frames, rows, cols), dtype=np.uint16)
+    true_peaks = np.empty((n_frames, n_channels), dtype=int)
+    x = np.arange(cols)
+    for f in range(n_frames):
+        drift_x, drift_y = rng.integers(-3, 4, size=2)
+        # soft edged channels, cells in them make the intensity uneven along y
+        profile = np.zeros(cols)
+        for c in centers + drift_x:
+            edge_dist = np.clip(np.abs(x - c) - channel_width / 2.0, -50, 50)
+            profile += 1.0 / (1.0 + np.exp(edge_dist))
+        frame = np.full((rows, cols), 200.0)
+        y1, y2 = closed_end + drift_y, open_end + drift_y
+        frame[y1:y2] += 1000.0 * profile * rng.uniform(0.8, 1.0, size=(y2 - y1, 1))
+        frame += rng.normal(0, noise, frame.shape)
+        frames[f] = np.clip(frame, 0, 65535)
+        true_peaks[f] = centers + drift_x
+
+    return frames, true_peaks
+
+
+def synthetic_phase_channels(n_frames=200, n_peaks=10, rows=320, seed=0):
+    """Makes the phase contrast stacks of the channels of one FOV with cells, and of
+    an empty channel, as Compile would slice them, with the channels drawn by
+    render_fov_frame and the stage drifting a few pixels.
+
+    Returns
+    channel_stacks : np.ndarray
+        uint16 array (n_peaks, n_frames, y, x).
+    empty_stack : np.ndarray
+        uint16 array (n_frames, y, x).
+    """
+
+    rng = np.random.default_rng(seed)
+    channel_width = 10
+    channel_separation = 45
+    channel_xs = channel_separation * (np.arange(n_peaks + 1) + 1)
+    channel_top = rows // 8
+    channel_length = rows - 2 * channel_top
+
+    # the last channel is empty
+    channel_cells = [
+        grow_channel_cells(rng, n_frames, channel_length) for _ in range(n_peaks)
+    ] + [[np.zeros((0, 2))] * n_frames]
+    steps = rng.integers(-1, 2, size=(n_frames, 2))
+    steps[0] = 0
+    drifts = np.clip(np.cumsum(steps, axis=0), -3, 3)
+
+    frames = np.stack(
+        [
+            render_fov_frame(
+                rng,
+                (rows, channel_separation * (n_peaks + 2)),
+                1,
+                channel_xs,
+                channel_top,
+                channel_length,
+                channel_width,
+                [cells[t] for cells in channel_cells],
+                drifts[t],
+                20.0,
+            )[0]
+            for t in range(n_frames)
+        ]
+    )
+
+    # cut the channels out like the channel masks would, with some room around them
+    stacks = np.stack(
+        [
+            frames[
+                :, channel_top - 10 : channel_top + channel_length + 10, x - 16 : x + 16
+            ]
+            for x in channel_xs
+        ]
+    )
+
+    return stacks[:-1], stacks[-1]
+
+
+def synthetic_elements_tag(planes=("Phase", "GFP", "mCherry"), n_entries=2000, seed=0):
+    """Makes a binary metadata tag (65331) like the ones Nikon Elements writes.
+
+    Entries are a type byte, a name length byte, the UTF-16LE name and a value, with
+    the stage position and time at the offsets parse_elements_tag reads them from.
+
+    Returns
+    blob : bytes
+    values : dict
+        the x, y, jd and planes which were written.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    def entry(name, value):
+        return (
+            bytes([rng.integers(1, 10), len(name) + 1])
+            + (name + "\0").encode("utf-16-le")
+            + value
+        )
+
+    values = {
+        "x": float(np.float32(rng.uniform(-5000, 5000))),
+        "y": float(np.float32(rng.uniform(-5000, 5000))),
+        "jd": float(rng.uniform(2459000, 2460000)),
+        "planes": list(planes),
+    }
+
+    # filler entries with made up names and values around the ones we want
+    blob = b""
+    for n in range(n_entries):
+        blob += entry("uiEntry%d" % n, rng.integers(0, 32, 8, dtype=np.uint8).tobytes())
+        if n == n_entries // 4:
+            for name in ("dXPos", "dYPos"):
+                # the reader takes a float from 16 bytes after the start of the name
+                blob += b"\1\6" + name.encode("utf-16-le")
+                blob += bytes(16 - 2 * len(name))
+                blob += struct.pack("<f", values[name[1].lower()]) + bytes(4)
+        if n == n_entries // 2:
+            blob += b"\6\16" + "dTimeAbsolute\0".encode("utf-16-le")
+            blob += struct.pack("<d", values["jd"])
+        if n == 3 * n_entries // 4:
+            for plane in planes:
+                blob += entry(
+                    "sOpticalConfigName", b"\6" + (plane + "\0").encode("utf-16-le")
+                )
+    blob += bytes(len(blob) % 2)
+
+    return blob, values
+
+
+### Reference implementations ###
+def find_channel_peaks_cwt(params, image_data):
+    """The channel peak finding find_channel_locs used before find_channel_peaks,
+    one image at a time with scipy's find_peaks_cwt."""
+
+    chan_w = params["compile"]["channel_width"]
+    chan_snr = params["compile"]["channel_detection_snr"]
+
+    projection_x = image_data.sum(axis=0).astype(np.int32)
+    return find_peaks_cwt(
+        projection_x, np.arange(chan_w - 5, chan_w + 5), min_snr=chan_snr
+    )
+
+
+def parse_elements_tag_loop(blob):
+    """The parsing get_tif_metadata_elements did before parse_elements_tag, building
+    strings from the tag a character at a time. It was run for every page of a file.
+    """
+
+    idata = {}
+    infolist = [a + b * 0x100 for a, b in zip(blob[0::2], blob[1::2])]
+    t_string = ""
+    for c_entry in range(0, len(infolist)):
+        if infolist[c_entry] < 127 and infolist[c_entry] > 64:
+            t_string += chr(infolist[c_entry])
+        else:
+            t_string += " "
+
+    arraypos = t_string.index("dXPos") * 2 + 16
+    idata["x"] = float(struct.unpack("<f", bytes(blob[arraypos : arraypos + 4]))[0])
+    arraypos = t_string.index("dYPos") * 2 + 16
+    idata["y"] = float(struct.unpack("<f", bytes(blob[arraypos : arraypos + 4]))[0])
+    arraypos = t_string.index("dTimeAbsolute") * 2 + 26
+    idata["jd"] = float(
+        struct.unpack("<d", bytes(blob[arraypos + 2 : arraypos + 10]))[0]
+    )
+
+    il = [a + b * 0x100 for a, b in zip(blob[0::2], blob[1::2])]
+    li = [a + b * 0x100 for a, b in zip(blob[1::2], blob[2::2])]
+    strings = list(zip(il, li))
+    allchars = ""
+    for c_entry in range(0, len(strings)):
+        if 31 < strings[c_entry][0] < 127:
+            allchars += chr(strings[c_entry][0])
+        elif 31 < strings[c_entry][1] < 127:
+            allchars += chr(strings[c_entry][1])
+        else:
+            allchars += " "
+    words = re.sub(" +", " ", allchars).split(" ")
+    idata["planes"] = [
+        words[idx + 1] for idx, x in enumerate(words) if x == "sOpticalConfigName"
+    ]
+
+    return idata
+
+
+def peak_recall(found_peaks, true_peaks, tolerance=3):
+    """Fraction of true peaks with a found peak within tolerance pixels, and the number
+    of found peaks which are not close to a true peak."""
+
+    found_peaks = np.asarray(found_peaks)
+    if len(found_peaks) == 0:
+        return 0.0, 0
+    dist = np.abs(found_peaks[:, None] - np.asarray(true_peaks)[None, :])
+    recall = np.mean(dist.min(axis=0) <= tolerance)
+    false_peaks = int(np.sum(dist.min(axis=1) > tolerance))
+    return recall, false_peaks
+
+
+### Benchmarks ###
+def benchmark_channel_detection(n_frames=100, **frame_kwargs):
+    """Times channel detection on synthetic frames with the batched matched filter
+    (find_channel_locs_stack) and with per-frame find_peaks_cwt.
+
+    Edge channels are dropped by both the same way, so only channels at least half
+    a separation from the image edge are counted.
+    """
+
+    frames, true_peaks = synthetic_channel_frames(n_frames, **frame_kwargs)
+    params = {
+        "compile": {
+            "channel_width": frame_kwargs.get("channel_width", 10),
+            "channel_separation": frame_kwargs.get("channel_separation", 45),
+            "channel_width_pad": 10,
+            "channel_detection_snr": 1,
+        }
+    }
+
+    results = {"n_frames": n_frames, "frame_shape": frames.shape[1:]}
+
+    start = time.perf_counter()
+    chnl_loc_dicts = find_channel_locs_stack(params, frames)
+    results["batched_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cwt_peaks = [find_channel_peaks_cwt(params, frame) for frame in frames]
+    results["cwt_peaks_only_s"] = time.perf_counter() - start
+
+    for name, all_peaks in (
+        ("batched", [sorted(d.keys()) for d in chnl_loc_dicts]),
+        ("cwt", cwt_peaks),
+    ):
+        scores = [peak_recall(p, t) for p, t in zip(all_peaks, true_peaks)]
+        results[name + "_recall"] = float(np.mean([s[0] for s in scores]))
+        results[name + "_false_peaks"] = int(np.sum([s[1] for s in scores]))
+
+    results["speedup"] = results["cwt_peaks_only_s"] / results["batched_s"]
+
+    return results
+
+
+def benchmark_elements_metadata(n_files=20, n_planes=3, n_entries=2000):
+    """Times parsing the Elements metadata tag of n_files synthetic files with
+    parse_elements_tag (first page only) and with the old character loop (every page).
+    """
+
+    planes = ["c%d" % (i + 1) for i in range(n_planes)]
+    blobs = [synthetic_elements_tag(planes, n_entries, seed=n) for n in range(n_files)]
+    results = {"n_files": n_files, "tag_bytes": len(blobs[0][0])}
+
+    start = time.perf_counter()
+    parsed = [parse_elements_tag(blob) for blob, values in blobs]
+    results["vectorized_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for blob, values in blobs:
+        for plane in planes:
+            parsed_loop = parse_elements_tag_loop(blob)
+    results["loop_s"] = time.perf_counter() - start
+
+    results["matches_written"] = all(
+        idata == values for idata, (blob, values) in zip(parsed, blobs)
+    )
+    results["matches_loop"] = parsed[-1] == parsed_loop
+    results["speedup"] = results["loop_s"] / results["vectorized_s"]
+
+    return results
+
+
+def benchmark_phase_alignment(n_frames=200, n_peaks=10, alignment_pad=10):
+    """Times aligning the empty channel to every frame of the channels of an FOV with
+    match_template frame by frame, as subtract_phase does, and with
+    find_empty_offsets, which aligns batches of frames by FFT with the transforms of
+    the empty made once for all the channels.
+    """
+
+    channel_stacks, empty_stack = synthetic_phase_channels(n_frames, n_peaks)
+    params = {"subtract": {"alignment_pad": alignment_pad}}
+    results = {"n_frames": n_frames, "n_peaks": n_peaks}
+
+    start = time.perf_counter()
+    template_offsets = []
+    for channel_stack in channel_stacks:
+        for channel, empty in zip(channel_stack, empty_stack):
+            match_result = match_template(
+                np.pad(channel, alignment_pad, mode="reflect"), empty
+            )
+            template_offsets.append(
+                np.unravel_index(np.argmax(match_result), match_result.shape)
+            )
+    results["match_template_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    # in single precision, as subtract shares them
+    empty_spectra = template_spectra(
+        empty_stack,
+        np.array(channel_stacks.shape[2:]) + 2 * alignment_pad,
+    ).astype(np.complex64)
+    fft_offsets = np.concatenate(
+        [
+            find_empty_offsets(params, channel_stack, empty_stack, empty_spectra)
+            for channel_stack in channel_stacks
+        ]
+    )
+    results["fft_s"] = time.perf_counter() - start
+
+    results["matches_match_template"] = float(
+        np.mean(np.all(fft_offsets == np.array(template_offsets), axis=1))
+    )
+    results["speedup"] = results["match_template_s"] / results["fft_s"]
+
+    return results
+
+
+def benchmark_catalog(n_fovs=50, n_frames=400, t_start=100, t_end=300):
+    """Makes an image directory of n_fovs * n_frames empty TIFFs and times finding the
+    files of each FOV from t_start to t_end with glob and name filtering as before,
+    with a fresh catalog scan, and with the catalog once it is cached.
+    """
+
+    results = {"n_files": n_fovs * n_frames}
+    with tempfile.TemporaryDirectory() as tif_dir:
+        for fov_id in range(1, n_fovs + 1):
+            for t in range(1, n_frames + 1):
+                open(
+                    os.path.join(tif_dir, "exp_t%04dxy%02d.tif" % (t, fov_id)), "w"
+                ).close()
+
+        # glob, then a regex to cut the time range and a substring test per fov
+        start = time.perf_counter()
+        found_files = sorted(
+            os.path.basename(fn) for fn in glob.glob(os.path.join(tif_dir, "*.tif"))
+        )
+        in_range = [
+            fn
+            for fn in found_files
+            if t_start <= int(re.search(r"t(\d+)xy", fn).group(1)) <= t_end
+        ]
+        glob_files = {
+            fov_id: [fn for fn in in_range if "xy%02d" % fov_id in fn]
+            for fov_id in range(1, n_fovs + 1)
+        }
+        results["glob_s"] = time.perf_counter() - start
+
+        def catalog_files():
+            catalog = load_catalog(tif_dir)
+            return {
+                fov_id: catalog.query(fovs=[fov_id], t_start=t_start, t_end=t_end)
+                for fov_id in catalog.fov_ids()
+            }
+
+        start = time.perf_counter()
+        scanned_files = catalog_files()
+        results["catalog_scan_s"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cached_files = catalog_files()
+        results["catalog_cached_s"] = time.perf_counter() - start
+
+    results["matches_glob"] = scanned_files == glob_files == cached_files
+    results["speedup_scan"] = results["glob_s"] / results["catalog_scan_s"]
+    results["speedup_cached"] = results["glob_s"] / results["catalog_cached_s"]
+
+    return results
+
+
+# layouts compared by benchmark_hdf5_layouts, the first is the default
+HDF5_LAYOUTS = [
+    {"compression": "gzip", "t_chunk": 1, "fletcher32": True},
+    {"compression": "gzip", "compression_level": 1, "t_chunk": 1, "fletcher32": True},
+    {"compression": "gzip", "compression_level": 1, "t_chunk": 16, "fletcher32": True},
+    {"compression": "lzf", "t_chunk": 1, "fletcher32": True},
+    {"compression": "lzf", "t_chunk": 16, "fletcher32": False},
+    {"compression": "blosc-lz4", "t_chunk": 16, "fletcher32": False},
+    {"compression": "blosc-zstd", "t_chunk": 16, "fletcher32": False},
+    {"compression": None, "t_chunk": 16, "fletcher32": False},
+]
+
+
+def benchmark_hdf5_layouts(
+    n_frames=500, n_channels=20, n_reads=200, layouts=None, seed=0
+):
+    """Writes synthetic channel stacks to HDF5 with each layout (see
+    hdf5_dataset_kwargs) and reports the write speed in MB/s of raw image data,
+    the compression ratio and the mean time to read one random frame.
+
+    Layouts which need a codec that is not installed are skipped.
+    """
+
+    if layouts is None:
+        layouts = HDF5_LAYOUTS
+
+    # cut channel stacks out of synthetic frames, as compile would
+    frames, true_peaks = synthetic_channel_frames(
+        n_frames, rows=300, cols=64 * n_channels, n_channels=n_channels, seed=seed
+    )
+    channel_stacks = [
+        frames[:, :, peak - 16 : peak + 16] for peak in true_peaks[0, 1:-1]
+    ]
+    raw_mb = sum(stack.nbytes for stack in channel_stacks) / 1024.0**2
+
+    rng = np.random.default_rng(seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n, layout in enumerate(layouts):
+            name = "%s t_chunk=%d%s%s" % (
+                layout["compression"],
+                layout["t_chunk"],
+                (
+                    " level=%d" % layout["compression_level"]
+                    if layout.get("compression_level") is not None
+                    else ""
+                ),
+                " fletcher32" if layout["fletcher32"] else "",
+            )
+            filename = os.path.join(tmp_dir, "layout%d.hdf5" % n)
+
+            try:
+                start = time.perf_counter()
+                with h5py.File(filename, "w") as h5f:
+                    for peak, stack in enumerate(channel_stacks):
+                        h5f.create_dataset(
+                            "p%04d_c1" % peak,
+                            data=stack,
+                            **hdf5_dataset_kwargs({"hdf5": layout}, stack.shape)
+                        )
+                write_s = time.perf_counter() - start
+            except (ImportError, ValueError) as e:
+                results[name] = "skipped (%s)" % e
+                continue
+
+            # read single frames from random channels and time points
+            start = time.perf_counter()
+            with h5py.File(filename, "r") as h5f:
+                for peak, t in zip(
+                    rng.integers(0, len(channel_stacks), n_reads),
+                    rng.integers(0, n_frames, n_reads),
+                ):
+                    h5f["p%04d_c1" % peak][t]
+            read_s = time.perf_counter() - start
+
+            results[name] = "write %.1f MB/s, ratio %.2f, frame read %.3f ms" % (
+                raw_mb / write_s,
+                raw_mb * 1024**2 / os.path.getsize(filename),
+                1000.0 * read_s / n_reads,
+            )
+
+    return results
+
+
+### Pipeline ###
+def pipeline_params(experiment_directory, experiment_name, num_analyzers, output):
+    """Parameters for all the stages of the pipeline benchmark, with the defaults of
+    the widgets. The segmentation parameters are those of the SegmentOtsu widget."""
+
+    params = compile_gen_params(
+        experiment_name,
+        experiment_directory,
+        "analysis",
+        "TIFF/",
+        "",
+        "nd2",
+        "c1",
+        120,
+        10,
+        45,
+        0.99,
+        output=output,
+    )
+    params["num_analyzers"] = num_analyzers
+    params["pxl2um"] = 0.11
+
+    params["subtract"] = subtract_prepare_params(
+        experiment_name,
+        experiment_directory,
+        "analysis",
+        "TIFF/",
+        "",
+        "c1",
+        10,
+    )["subtract"]
+
+    params["segment"] = dict()
+    params["segment"]["OTSU_threshold"] = 1.0
+    params["segment"]["first_opening_size"] = 2
+    params["segment"]["distance_threshold"] = 2
+    params["segment"]["second_opening_size"] = 1
+    params["segment"]["min_object_size"] = 25
+
+    params["track"] = track_update_params(
+        experiment_name,
+        experiment_directory,
+        "TIFF/",
+        "analysis",
+        "",
+        "c1",
+        0.11,
+        3,
+        150,
+        4,
+        1.5,
+        0.7,
+        "Otsu",
+    )["track"]
+
+    return params
+
+
+def pick_channels(params):
+    """Marks the channels Compile guessed have cells to be analyzed and the rest as
+    empties, as a user would in the channel picker."""
+
+    with open(os.path.join(params["ana_dir"], "crosscorrs.pkl"), "rb") as xcorrs_file:
+        crosscorrs = pickle.load(xcorrs_file)
+
+    specs = {
+        fov_id: {
+            peak_id: 1 if xcorrs["full"] else 0 for peak_id, xcorrs in peaks.items()
+        }
+        for fov_id, peaks in crosscorrs.items()
+    }
+
+    with open(os.path.join(params["ana_dir"], "specs.yaml"), "w") as specs_file:
+        yaml.dump(data=specs, stream=specs_file, default_flow_style=False, tags=None)
+
+
+def find_cell_intensities(params):
+    """Loads the tracked cells and finds their fluorescence in the second plane."""
+
+    specs = load_specs(params)
+    time_table = load_time_table(params["ana_dir"])
+    with open(os.path.join(params["cell_dir"], "all_cells.pkl"), "rb") as cell_file:
+        Cells = pickle.load(cell_file)
+
+    find_all_cell_intensities(
+        params,
+        Cells,
+        specs,
+        time_table,
+        channel_name="c2",
+        seg_img=params["track"]["seg_img"],
+    )
+
+
+def run_stage(stage, args, results_queue):
+    """Runs one stage and puts its run time and peak memory on results_queue. Each
+    stage runs in its own process, so the peak memory is that of the stage alone.
+    The id of the run the stage started in the run report (see _report) is put
+    along, the first of args being params.
+
+    Called by
+    benchmark_pipeline
+    """
+
+    start = time.perf_counter()
+    try:
+        stage(*args)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+
+    results_queue.put(
+        {
+            "seconds": seconds,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_worker_rss_mb": peak_rss_mb(children=True),
+            "error": error,
+            "run_id": args[0].get("run_id"),
+        }
+    )
+
+
+def benchmark_pipeline(
+    out_file=None,
+    n_fovs=2,
+    n_channels=12,
+    n_frames=40,
+    n_planes=2,
+    num_analyzers=None,
+    output="TIFF",
+    experiment_directory=None,
+    seed=0,
+):
+    """Writes a synthetic experiment with write_synthetic_experiment and runs compile,
+    subtract, segmentOTSU, Track_Cells and find_all_cell_intensities on it. The
+    channels are picked with pick_channels after compile.
+
+    For each stage the run time, the raw images (FOV time points) processed per
+    second and the peak memory of the stage process and of its largest worker
+    process are recorded. A stage which fails records its traceback, and the stages
+    after it are skipped.
+
+    Parameters
+    out_file : str
+        the results are saved to this JSON file.
+    experiment_directory : str
+        where to write the experiment. It is kept if given, otherwise a temporary
+        directory is used and removed afterwards.
+
+    Returns
+    results : dict
+        what is saved to out_file.
+    """
+
+    if num_analyzers is None:
+        num_analyzers = multiprocessing.cpu_count()
+
+    tmp_dir = None
+    if experiment_directory is None:
+        tmp_dir = tempfile.mkdtemp(prefix="mm3_benchmark_")
+        experiment_directory = tmp_dir
+
+    experiment_name = "synthetic"
+    results = {
+        "experiment": {
+            "n_fovs": n_fovs,
+            "n_channels": n_channels,
+            "n_frames": n_frames,
+            "n_planes": n_planes,
+            "seed": seed,
+        },
+        "output": output,
+        "num_analyzers": num_analyzers,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": {},
+    }
+
+    try:
+        start = time.perf_counter()
+        experiment = write_synthetic_experiment(
+            experiment_directory,
+            experiment_name=experiment_name,
+            n_fovs=n_fovs,
+            n_channels=n_channels,
+            n_frames=n_frames,
+            n_planes=n_planes,
+            seed=seed,
+        )
+        results["experiment"]["n_images"] = experiment["n_images"]
+        results["experiment"]["write_s"] = time.perf_counter() - start
+
+        params = pipeline_params(
+            Path(experiment_directory), experiment_name, num_analyzers, output
+        )
+
+        stages = [
+            ("compile", compile, (params,)),
+            ("pick_channels", pick_channels, (params,)),
+            ("subtract", subtract, (params, Path(params["ana_dir"]))),
+            ("segmentOTSU", segmentOTSU, (params,)),
+            ("Track_Cells", Track_Cells, (params,)),
+            ("find_all_cell_intensities", find_cell_intensities, (params,)),
+        ]
+
+        for name, stage, args in stages:
+            results_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_stage, args=(stage, args, results_queue)
+            )
+            process.start()
+            stage_results = results_queue.get()
+            process.join()
+
+            stage_results["frames_per_s"] = (
+                experiment["n_images"] / stage_results["seconds"]
+            )
+
+            # the time and memory of the steps of the stage, from the run report
+            run_id = stage_results.pop("run_id")
+            if run_id is not None:
+                stage_results["steps"] = summarize_run_report(
+                    load_run_report(params["ana_dir"], run_id)
+                )
+            results["stages"][name] = stage_results
+            print_results(name, stage_results)
+
+            if stage_results["error"]:
+                break
+
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if out_file is not None:
+        with open(out_file, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    return results
+
+
+def print_results(title, results):
+    print(title)
+    for key, value in results.items():
+        if isinstance(value, dict):
+            # the steps, printed by the stage from the run report
+            continue
+        if isinstance(value, float):
+            value = "%.4g" % value
+        print("    %s: %s" % (key, value))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--pipeline",
+        metavar="RESULTS_JSON",
+        help="run the pipeline benchmark and save the results to this file",
+    )
+    parser.add_argument("--fovs", type=int, default=2)
+    parser.add_argument("--channels", type=int, default=12)
+    parser.add_argument("--frames", type=int, default=40)
+    parser.add_argument("--planes", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", choices=["TIFF", "HDF5", "Zarr"], default="TIFF")
+    parser.add_argument(
+        "--experiment-directory",
+        help="write the synthetic experiment here and keep it",
+    )
+    args = parser.parse_args()
+
+    if args.pipeline:
+        benchmark_pipeline(
+            args.pipeline,
+            n_fovs=args.fovs,
+            n_channels=args.channels,
+            n_frames=args.frames,
+            n_planes=args.planes,
+            num_analyzers=args.workers,
+            output=args.output,
+            experiment_directory=args.experiment_directory,
+        )
+    else:
+        print_results("Channel detection", benchmark_channel_detection())
+        print_results("HDF5 layouts", benchmark_hdf5_layouts())
+        print_results("Elements metadata", benchmark_elements_metadata())
+        print_results("Image catalog", benchmark_catalog())
+        print_results("Phase alignment", benchmark_phase_alignment())
@@ -0,0 +1,231 @@
+"""Catalog of the raw TIFFs of an experiment.
+
+The image directory is scanned once for TIFFs, and the FOV, time point and plane
+of each file are parsed from its name (name_t0001xy01.tif as nd2ToTIFF writes
+them, optionally with a row suffix, _1, or a plane, c1). Compile, the channel picker
+and the nd2 conversion preview query the catalog instead of globbing the directory
+and filtering the names themselves.
+
+Catalogs are kept in memory by directory, and saved as image_catalog.npz to a cache
+directory (the analysis directory) if given. A catalog is scanned again when the
+modification time of the image directory has changed, which happens whenever a
+file is added, removed or renamed. Directory times can be coarse, or cached on
+network file systems, so a file added just after a scan may not change it. As git
+does for its index, a catalog scanned less than RACY_SECONDS after the directory
+last changed is not trusted and scanned again.
+"""
+
+import os
+import re
+import time
+import numpy as np
+
+# t, fov, and what is between the fov and .tif (row suffix or plane)
+FILENAME_PATTERN = re.compile(r"t(\d+)xy(\d+)(\w*)\.tif$")
+PLANE_PATTERN = re.compile(r"(c\d+)$")
+
+# a catalog scanned this soon after the image directory changed is scanned again
+RACY_SECONDS = 5
+
+# catalogs scanned in this process, by image directory
+_catalogs = {}
+
+
+class ImageCatalog(object):
+    """The TIFFs of an image directory, with the FOV, time point and plane of each.
+    FOV and time point are -1 for files whose name does not have them, and the plane
+    is '' for files which hold all planes. The suffix is all of the name between the
+    FOV and .tif, e.g. '_1' for a row or 'c1' for a plane, and '' for plain
+    name_t0001xy01.tif files.
+    """
+
+    def __init__(
+        self, tif_dir, mtime_ns, scan_ns, filenames, fovs, ts, planes, suffixes
+    ):
+        self.tif_dir = tif_dir
+        self.mtime_ns = int(mtime_ns)
+        self.scan_ns = int(scan_ns)
+
+        # in file name order, which is time order for names as nd2ToTIFF writes them
+        order = np.argsort(filenames, kind="stable")
+        self.filenames = np.asarray(filenames, dtype=str)[order]
+        self.fovs = np.asarray(fovs, dtype=np.int64)[order]
+        self.ts = np.asarray(ts, dtype=np.int64)[order]
+        self.planes = np.asarray(planes, dtype=str)[order]
+        self.suffixes = np.asarray(suffixes, dtype=str)[order]
+
+        # rows of each fov, so queries by fov do not go through all files
+        self._fov_rows = {}
+        for row, fov_id in enumerate(self.fovs.tolist()):
+            self._fov_rows.setdefault(fov_id, []).append(row)
+
+    @classmethod
+    def scan(cls, tif_dir):
+        """Lists the TIFFs in tif_dir and parses their names."""
+
+        # the time before listing, so files added while listing count as after it
+        scan_ns = time.time_ns()
+        mtime_ns = os.stat(tif_dir).st_mtime_ns
+
+        filenames, fovs, ts, planes, suffixes = [], [], [], [], []
+        with os.scandir(tif_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".tif") or not entry.is_file():
+                    continue
+                filenames.append(entry.name)
+
+                match = FILENAME_PATTERN.search(entry.name)
+                if match is None:
+                    ts.append(-1)
+                    fovs.append(-1)
+                    planes.append("")
+                    suffixes.append("")
+                    continue
+                ts.append(int(match.group(1)))
+                fovs.append(int(match.group(2)))
+                plane = PLANE_PATTERN.search(match.group(3))
+                planes.append(plane.group(1) if plane else "")
+                suffixes.append(match.group(3))
+
+        return cls(tif_dir, mtime_ns, scan_ns, filenames, fovs, ts, planes, suffixes)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a catalog saved with save."""
+
+        with np.load(filename) as catalog_file:
+            return cls(
+                str(catalog_file["tif_dir"]),
+                int(catalog_file["mtime_ns"]),
+                int(catalog_file["scan_ns"]),
+                catalog_file["filenames"],
+                catalog_file["fovs"],
+                catalog_file["ts"],
+                catalog_file["planes"],
+                catalog_file["suffixes"],
+            )
+
+    def save(self, filename):
+        np.savez(
+            filename,
+            tif_dir=np.array(self.tif_dir),
+            mtime_ns=np.array(self.mtime_ns, dtype=np.int64),
+            scan_ns=np.array(self.scan_ns, dtype=np.int64),
+            filenames=self.filenames,
+            fovs=self.fovs,
+            ts=self.ts,
+            planes=self.planes,
+            suffixes=self.suffixes,
+        )
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def is_fresh(self, mtime_ns):
+        """Whether the catalog still lists the image directory, which has modification
+        time mtime_ns: it has not changed since the scan, and the scan was not so
+        soon after its last change that files added in the same tick were missed."""
+
+        return (
+            self.mtime_ns == mtime_ns
+            and self.scan_ns - self.mtime_ns > RACY_SECONDS * 1e9
+        )
+
+    def fov_ids(self):
+        """Returns the FOVs in the catalog, sorted."""
+
+        return sorted(fov_id for fov_id in self._fov_rows.keys() if fov_id >= 0)
+
+    def query(self, fovs=None, t_start=None, t_end=None, plane=None, suffix=None):
+        """Returns the names of the files of the given FOVs (all if None) from time
+        point t_start to t_end (inclusive, either None for no limit), in file name
+        order. If plane or suffix is given only files of that plane or with that
+        suffix are returned, e.g. suffix='' for the files holding all planes of a
+        whole FOV. Files whose name has no time point are only left out if a time
+        range is given, and those with no FOV only if FOVs are given.
+        """
+
+        if fovs:
+            rows = np.array(
+                sorted(
+                    row for fov_id in fovs for row in self._fov_rows.get(fov_id, [])
+                ),
+                dtype=np.int64,
+            )
+        else:
+            rows = np.arange(len(self.filenames))
+
+        keep = np.ones(len(rows), dtype=bool)
+        if t_start is not None:
+            keep &= self.ts[rows] >= t_start
+        if t_end is not None:
+            keep &= (self.ts[rows] <= t_end) & (self.ts[rows] >= 0)
+        if plane is not None:
+            keep &= self.planes[rows] == plane
+        if suffix is not None:
+            keep &= self.suffixes[rows] == suffix
+
+        return self.filenames[rows[keep]].tolist()
+
+    def lookup(self, fov_id, t, plane=""):
+        """Returns the name of the file of an FOV, time point and plane, or None."""
+
+        for row in self._fov_rows.get(fov_id, []):
+            if self.ts[row] == t and self.planes[row] == plane:
+                return str(self.filenames[row])
+
+        return None
+
+
+def load_catalog(tif_dir, cache_dir=None, rescan=False):
+    """Returns the catalog of tif_dir, scanning the directory only if it has changed
+    since it was last scanned, in this process or (with cache_dir) before (see
+    ImageCatalog.is_fresh).
+
+    Parameters
+    tif_dir : str or Path
+        the image directory.
+    cache_dir : str or Path
+        directory to keep the catalog in between runs, e.g. the analysis directory.
+    rescan : bool
+        scan the directory even if the catalog looks fresh, e.g. while watching it
+        for new images.
+
+    Returns
+    catalog : ImageCatalog
+
+    Called by
+    mm3_Compile.compile
+    mm3_ChannelPicker.load_fov
+    mm3_nd2ToTIFF.Nd2ToTIFF
+    """
+
+    tif_dir = os.path.abspath(str(tif_dir))
+    mtime_ns = os.stat(tif_dir).st_mtime_ns
+
+    catalog = _catalogs.get(tif_dir)
+    if not rescan and catalog is not None and catalog.is_fresh(mtime_ns):
+        return catalog
+
+    cache_path = None
+    if cache_dir is not None and os.path.isdir(str(cache_dir)):
+        cache_path = os.path.join(str(cache_dir), "image_catalog.npz")
+        if not rescan and os.path.exists(cache_path):
+            try:
+                catalog = ImageCatalog.load(cache_path)
+            except (OSError, KeyError, ValueError):
+                catalog = None
+            if (
+                catalog is not None
+                and catalog.tif_dir == tif_dir
+                and catalog.is_fresh(mtime_ns)
+            ):
+                _catalogs[tif_dir] = catalog
+                return catalog
+
+    catalog = ImageCatalog.scan(tif_dir)
+    _catalogs[tif_dir] = catalog
+    if cache_path is not None:
+        catalog.save(cache_path)
+
+    return catalog
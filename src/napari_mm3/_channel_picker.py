@@ -8,6 +8,7 @@ import numpy as np
 import yaml
 import tifffile as tiff
 
+from ._catalog import load_catalog
 
 TRANSLUCENT_RED = np.array([1.0, 0.0, 0.0, 0.25])
 TRANSLUCENT_GREEN = np.array([0.0, 1.0, 0.0, 0.25])
@@ -17,10 +18,8 @@ TRANSPARENT = np.array([0, 0, 0, 0])
 
 def load_fov(image_directory, fov_id):
     print("getting files")
-    found_files = image_directory.glob(f"*xy{fov_id:02d}.tif")
-    found_files = [filepath.name for filepath in found_files]  # remove pre-path
-    print("sorting files")
-    found_files = sorted(found_files)  # should sort by timepoint
+    # sorted by name, which is by timepoint. files of one row or plane are left out
+    found_files = load_catalog(image_directory).query(fovs=[fov_id], suffix="")
 
     if len(found_files) == 0:
         print("No data found for FOV " + str(fov_id))
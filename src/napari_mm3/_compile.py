@@ -5,23 +5,42 @@ import os
 import yaml
 import six
 import pickle
-import glob
 import sys
 import traceback
 import tifffile as tiff
 import numpy as np
 import json
 import struct
+import sqlite3
+import time
 
 from scipy import ndimage as ndi
-from skimage.feature import match_template
-from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
 from pathlib import Path
 from pprint import pprint
-from scipy.signal import find_peaks_cwt
 from magicgui import magic_factory
 
-from ._function import information, warning, get_fov, get_time, load_stack
+from ._function import (
+    information,
+    warning,
+    get_fov,
+    get_time,
+    load_stack,
+    open_zarr_fov,
+    create_zarr_stack,
+    hdf5_dataset_kwargs,
+    match_template_fft,
+    match_template_at,
+    phase_correlation_shifts,
+    load_drift,
+    save_output_format,
+    TimeTable,
+)
+from ._scheduler import TaskGraph
+from ._report import start_run, stage_timer, count, print_run_summary
+from ._planner import plan_workers, plan_slicing, print_plan
+from ._catalog import load_catalog
 
 
 ### Functions for working with TIFF metadata ###
@@ -29,8 +48,9 @@ from ._function import information, warning, get_fov, get_time, load_stack
 # get params is the major function which processes raw TIFF images
 def get_tif_params(params, image_filename, find_channels=True):
     """This is a damn important function for getting the information
-    out of an image. It loads a tiff file, pulls out the image data, and the metadata,
-    including the location of the channels if flagged.
+    out of an image. It opens a tiff file and pulls out the metadata from the TIFF tags,
+    including the location of the channels if flagged. Pixel data is only decoded when
+    channels are to be found, so a metadata-only pass is cheap.
 
     it returns a dictionary like this for each image:
 
@@ -41,7 +61,8 @@ def get_tif_params(params, image_filename, find_channels=True):
     'x' : image_metadata['x'], # x position on stage [um]
     'y' : image_metadata['y'], # y position on stage [um]
     'plane_names' : image_metadata['plane_names'] # list of plane names
-    'channels': cp_dict, # dictionary of channel locations, in the case of Unet-based channel segmentation, it's a dictionary of channel labels
+    'shape' : img_shape, # shape of a single plane, from the TIFF header
+    'channels': cp_dict, # dictionary of channel locations, only if find_channels is True
 
     Called by
     mm3_Compile.py __main__
@@ -54,48 +75,21 @@ def get_tif_params(params, image_filename, find_channels=True):
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params["TIFF_dir"], image_filename)) as tif:
-            image_data = tif.asarray()
-
-            if params["TIFF_source"] == "TIFF_from_elements":
-                image_metadata = get_tif_metadata_elements(tif)
-            elif params["TIFF_source"] == "nd2" or "TIFF_from_nd2":
-                image_metadata = get_tif_metadata_nd2ToTIFF(tif)
-            elif params["TIFF_source"] == "TIFF":
-                image_metadata = get_tif_metadata_filename(tif)
-
-        # look for channels if flagged
-        if find_channels:
-            # fix the image orientation and get the number of planes
-            image_data = fix_orientation(params, image_data)
-
-            # if the image data has more than 1 plane restrict image_data to phase,
-            # which should have highest mean pixel data
-            if len(image_data.shape) > 2:
-                # ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
-                ph_index = int(params["phase_plane"][1:]) - 1
-                image_data = image_data[ph_index]
-
-            # get shape of single plane
-            img_shape = [image_data.shape[0], image_data.shape[1]]
+            image_params = get_tif_image_params(params, image_filename, tif)
 
-            # find channels on the processed image
-            chnl_loc_dict = find_channel_locs(params, image_data)
+            # look for channels if flagged
+            if find_channels:
+                image_data = get_phase_image(params, tif.asarray())
 
         information("Analyzed %s" % image_filename)
+        count(files=1)
 
-        # return the file name, the data for the channels in that image, and the metadata
-        return {
-            "filepath": os.path.join(params["TIFF_dir"], image_filename),
-            "fov": image_metadata["fov"],  # fov id
-            "t": image_metadata["t"],  # time point
-            "jd": image_metadata["jd"],  # absolute julian time
-            "x": image_metadata["x"],  # x position on stage [um]
-            "y": image_metadata["y"],  # y position on stage [um]
-            "planes": image_metadata["planes"],  # list of plane names
-            "shape": img_shape,  # image shape x y in pixels
+        # find channels on the processed image
+        if find_channels:
             # 'channels' : {1 : {'A' : 1, 'B' : 2}, 2 : {'C' : 3, 'D' : 4}}}
-            "channels": chnl_loc_dict,
-        }  # dictionary of channel locations
+            image_params["channels"] = find_channel_locs(params, image_data)
+
+        return image_params
 
     except:
         warning("Failed get_params for " + image_filename.split("/")[-1])
@@ -108,6 +102,235 @@ def get_tif_params(params, image_filename, find_channels=True):
         }
 
 
+def get_tif_image_params(params, image_filename, tif):
+    """Pulls the metadata out of the tags of an open raw TIFF, with the reader for
+    params['TIFF_source'], and returns it in the form get_tif_params returns.
+
+    Called by
+    mm3_Compile.get_tif_params
+    mm3_Compile.read_fov_frames
+    """
+
+    if params["TIFF_source"] == "TIFF_from_elements":
+        image_metadata = get_tif_metadata_elements(tif)
+    elif params["TIFF_source"] == "nd2" or "TIFF_from_nd2":
+        image_metadata = get_tif_metadata_nd2ToTIFF(tif)
+    elif params["TIFF_source"] == "TIFF":
+        image_metadata = get_tif_metadata_filename(tif)
+
+    # get shape of single plane from the header, orientation does not change it
+    img_shape = [int(dim) for dim in tif.series[0].shape[-2:]]
+
+    # return the file name and the metadata
+    return {
+        "filepath": os.path.join(params["TIFF_dir"], image_filename),
+        "fov": image_metadata["fov"],  # fov id
+        "t": image_metadata["t"],  # time point
+        "jd": image_metadata["jd"],  # absolute julian time
+        "x": image_metadata["x"],  # x position on stage [um]
+        "y": image_metadata["y"],  # y position on stage [um]
+        "planes": image_metadata["planes"],  # list of plane names
+        "shape": img_shape,  # image shape x y in pixels
+    }
+
+
+def get_fov_channels(params, image_filenames):
+    """Loads the pixel data of raw tiffs from one FOV and finds the channels in their
+    phase planes, a chunk of images at a time (see find_channel_locs_chunked).
+    This is the channel detection counterpart to the metadata-only get_tif_params.
+
+    Returns
+    fov_channels : dict
+        channel location dictionary (as returned by find_channel_locs) per file name.
+
+    Called by
+    mm3_Compile.find_image_channels
+    """
+
+    # the images are read as the chunks are filled
+    def phase_images():
+        for fn in image_filenames:
+            with tiff.TiffFile(os.path.join(params["TIFF_dir"], fn)) as tif:
+                yield fn, get_phase_image(params, tif.asarray())
+
+    fov_channels = find_channel_locs_chunked(params, phase_images())
+
+    information("Found channels in %d images." % len(fov_channels))
+    count(files=len(image_filenames), frames=len(fov_channels))
+
+    return fov_channels
+
+
+# number of phase images analyzed together when finding channels, so a worker only
+# holds a few images at a time whatever the number of frames
+CHANNEL_DETECTION_CHUNK = 16
+
+
+def find_channel_locs_chunked(params, phase_images):
+    """Finds the channels in phase images with find_channel_locs_stack, taking
+    CHANNEL_DETECTION_CHUNK images of the same shape at a time from phase_images, an
+    iterable of (key, image) pairs.
+
+    Returns
+    chnl_locs : dict
+        channel location dictionary (as returned by find_channel_locs) per key.
+
+    Called by
+    mm3_Compile.get_fov_channels
+    mm3_Compile.read_fov_frames
+    """
+
+    chnl_locs = {}
+    chunks = {}  # images waiting to be analyzed, by shape
+
+    def analyze_chunk(chunk):
+        image_stack = np.stack([image_data for key, image_data in chunk])
+        chnl_loc_dicts = find_channel_locs_stack(params, image_stack)
+        for (key, image_data), chnl_loc_dict in zip(chunk, chnl_loc_dicts):
+            chnl_locs[key] = chnl_loc_dict
+
+    for key, image_data in phase_images:
+        chunk = chunks.setdefault(image_data.shape, [])
+        chunk.append((key, image_data))
+        if len(chunk) == CHANNEL_DETECTION_CHUNK:
+            analyze_chunk(chunk)
+            del chunks[image_data.shape]
+
+    for chunk in chunks.values():
+        analyze_chunk(chunk)
+
+    return chnl_locs
+
+
+def get_phase_image(params, image_data):
+    """Fixes the orientation of raw image data and returns the phase plane,
+    which is the image channel finding is done on.
+
+    Called by
+    mm3_Compile.get_tif_params
+    mm3_Compile.get_fov_channels
+    """
+
+    # fix the image orientation and get the number of planes
+    image_data = fix_orientation(params, image_data)
+
+    # if the image data has more than 1 plane restrict image_data to phase,
+    # which should have highest mean pixel data
+    if len(image_data.shape) > 2:
+        # ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
+        ph_index = int(params["phase_plane"][1:]) - 1
+        image_data = image_data[ph_index]
+
+    return image_data
+
+
+# where fused compiling keeps the detection images of an FOV until they are sliced
+def fused_spill_path(params, fov_id):
+    """Returns the path of the spill file read_fov_frames writes the oriented detection
+    images of an FOV to. Spill files are in the fused_spill folder of the analysis
+    directory.
+    """
+
+    return os.path.join(params["ana_dir"], "fused_spill", "xy%03d.npy" % fov_id)
+
+
+# reads the images of an FOV channels are found in once, for fused compiling
+def read_fov_frames(params, fov_id, image_filenames, indexed_imgs):
+    """Gets the metadata and the channels of one FOV, for params['compile']['fused'].
+
+    The metadata of images which are not in indexed_imgs is taken from their tags as in
+    get_tif_params, without decoding the pixel data. Channels are then found in the
+    images picked by select_channel_detection_images, whose pixel data, with the
+    orientation fixed, is spilled to a memmap at fused_spill_path. Slicing takes these
+    images from the spill (see load_raw_image), so every raw image is decoded once:
+    the detection sample here, the other images when they are sliced.
+
+    Returns
+    fov_imgs : dict
+        image information as returned by get_tif_params per file name, with
+        'channels' for the images channels were found in.
+    spill_rows : dict
+        row of each detection image in the spill per file name.
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    fov_imgs = {}
+    n_read = 0
+    for fn in image_filenames:
+        if indexed_imgs.get(fn):
+            fov_imgs[fn] = dict(indexed_imgs[fn])
+            continue
+        n_read += 1
+        try:
+            with tiff.TiffFile(os.path.join(params["TIFF_dir"], fn)) as tif:
+                fov_imgs[fn] = get_tif_image_params(params, fn, tif)
+        except Exception as e:
+            warning("Failed get_params for %s: %s" % (fn, e))
+            fov_imgs[fn] = {
+                "filepath": os.path.join(params["TIFF_dir"], fn),
+                "analyze_success": False,
+            }
+    information("Read the metadata of %d images of FOV %d." % (n_read, fov_id))
+    count(files=n_read)
+
+    # read the sampled images, and keep them for slicing
+    detection_imgs = select_channel_detection_images(params, fov_imgs)
+    spill_path = fused_spill_path(params, fov_id)
+    spill_rows = {}
+    spill = None
+    for fn in detection_imgs:
+        try:
+            with tiff.TiffFile(os.path.join(params["TIFF_dir"], fn)) as tif:
+                image_data = tif.asarray()
+        except Exception as e:
+            warning("Failed reading %s: %s" % (fn, e))
+            continue
+
+        # orient the image once, as it is for channel finding and slicing
+        image_data = fix_orientation(params, image_data)
+        if len(image_data.shape) == 2:
+            image_data = np.expand_dims(image_data, 0)
+
+        # the spill is made for the shape of the first image
+        if spill is None:
+            if not os.path.exists(os.path.dirname(spill_path)):
+                os.makedirs(os.path.dirname(spill_path), exist_ok=True)
+            spill = np.lib.format.open_memmap(
+                spill_path,
+                mode="w+",
+                dtype=image_data.dtype,
+                shape=(len(detection_imgs),) + image_data.shape,
+            )
+        if image_data.shape != spill.shape[1:]:
+            warning("Image %s does not have the shape of its FOV." % fn)
+            continue
+
+        spill[len(spill_rows)] = image_data
+        spill_rows[fn] = len(spill_rows)
+
+    if spill is None:
+        return fov_imgs, spill_rows
+
+    # find channels in the phase planes of the sampled images, read back from the spill
+    ph_index = int(params["phase_plane"][1:]) - 1 if spill.shape[1] > 1 else 0
+    chnl_locs = find_channel_locs_chunked(
+        params,
+        ((fn, spill[row, ph_index]) for fn, row in six.iteritems(spill_rows)),
+    )
+    for fn, chnl_loc_dict in six.iteritems(chnl_locs):
+        fov_imgs[fn]["channels"] = chnl_loc_dict
+
+    spill.flush()
+    del spill
+
+    information("Found channels in %d images of FOV %d." % (len(spill_rows), fov_id))
+    count(frames=len(spill_rows))
+
+    return fov_imgs, spill_rows
+
+
 def get_tif_metadata_nd2ToTIFF(tif):
     """This function pulls out the metadata from a tif file and returns it as a dictionary.
     This if tiff files as exported by the mm3 function mm3_nd2ToTIFF.py. All the metdata
@@ -203,109 +426,395 @@ def get_tif_metadata_elements(tif):
     }
 
     # get the fov and t simply from the file name
-    idata["fov"] = int(tif.fname.split("xy")[1].split(".tif")[0])
-    idata["t"] = int(tif.fname.split("xy")[0].split("t")[-1])
-
-    # a page is plane, or stack, in the tiff. The other metdata is hidden down in there.
-    for page in tif:
-        for tag in page.tags.values():
-            # print("Checking tag",tag.name,tag.value)
-            t = tag.name, tag.value
-            t_string = ""
-            time_string = ""
-            # Interesting tag names: 65330, 65331 (binary data; good stuff), 65332
-            # we wnat to work with the tag of the name 65331
-            # if the tag name is not in the set of tegs we find interesting then skip this cycle of the loop
-            if tag.name not in (
-                "65331",
-                "65332",
-                "strip_byte_counts",
-                "image_width",
-                "orientation",
-                "compression",
-                "new_subfile_type",
-                "fill_order",
-                "max_sample_value",
-                "bits_per_sample",
-                "65328",
-                "65333",
-            ):
-                # print("*** " + tag.name)
-                # print(tag.value)
-                pass
-            # if tag.name == '65330':
-            #    return tag.value
-            if tag.name in ("65331"):
-                # make info list a list of the tag values 0 to 65535 by zipoing up a paired list of two bytes, at two byte intervals i.e. ::2
-                # note that 0X100 is hex for 256
-                infolist = [
-                    a + b * 0x100 for a, b in zip(tag.value[0::2], tag.value[1::2])
-                ]
-                # get char values for each element in infolist
-                for c_entry in range(0, len(infolist)):
-                    # the element corresponds to an ascii char for a letter or bracket (and a few other things)
-                    if infolist[c_entry] < 127 and infolist[c_entry] > 64:
-                        # add the letter to the unicode string t_string
-                        t_string += chr(infolist[c_entry])
-                    # elif infolist[c_entry] == 0:
-                    #    continue
-                    else:
-                        t_string += " "
-
-                # this block will find the dTimeAbsolute and print the subsequent integers
-                # index 170 is counting seconds, and rollover of index 170 leads to increment of index 171
-                # rollover of index 171 leads to increment of index 172
-                # get the position of the array by finding the index of the t_string at which dTimeAbsolute is listed not that 2*len(dTimeAbsolute)=26
-                # print(t_string)
-
-                arraypos = t_string.index("dXPos") * 2 + 16
-                xarr = tag.value[arraypos : arraypos + 4]
-                b = "".join(chr(i) for i in xarr)
-                idata["x"] = float(struct.unpack("<f", b)[0])
-
-                arraypos = t_string.index("dYPos") * 2 + 16
-                yarr = tag.value[arraypos : arraypos + 4]
-                b = "".join(chr(i) for i in yarr)
-                idata["y"] = float(struct.unpack("<f", b)[0])
-
-                arraypos = t_string.index("dTimeAbsolute") * 2 + 26
-                shortarray = tag.value[arraypos + 2 : arraypos + 10]
-                b = "".join(chr(i) for i in shortarray)
-                idata["jd"] = float(struct.unpack("<d", b)[0])
-
-                # extract plane names
-                il = [a + b * 0x100 for a, b in zip(tag.value[0::2], tag.value[1::2])]
-                li = [a + b * 0x100 for a, b in zip(tag.value[1::2], tag.value[2::2])]
-
-                strings = list(zip(il, li))
-
-                allchars = ""
-                for c_entry in range(0, len(strings)):
-                    if 31 < strings[c_entry][0] < 127:
-                        allchars += chr(strings[c_entry][0])
-                    elif 31 < strings[c_entry][1] < 127:
-                        allchars += chr(strings[c_entry][1])
-                    else:
-                        allchars += " "
+    fname = os.path.basename(tif.filename)
+    idata["fov"] = int(fname.split("xy")[1].split(".tif")[0])
+    idata["t"] = int(fname.split("xy")[0].split("t")[-1])
+
+    # The other metadata is in the binary tag 65331. Every page has the same copy,
+    # so only the first one is read
+    tag = tif.pages[0].tags.get(65331)
+    if tag is not None:
+        idata.update(parse_elements_tag(tag.value))
+
+    return idata
 
-                allchars = re.sub(" +", " ", allchars)
 
-                words = allchars.split(" ")
+# byte offsets of the values in the Elements metadata tag, by length of the tag.
+# Files from one acquisition have the same layout so the search is done once.
+elements_offsets_cache = {}
 
-                planes = []
-                for idx in [
-                    i for i, x in enumerate(words) if x == "sOpticalConfigName"
-                ]:
-                    planes.append(words[idx + 1])
 
-                idata["planes"] = planes
+def find_elements_name(blob, name):
+    """Returns the byte offset of the first occurence of name, as UTF-16LE starting
+    on an even byte, in an Elements metadata tag. Raises ValueError if it is missing.
+    """
+
+    pattern = name.encode("utf-16-le")
+    offset = blob.find(pattern)
+    while offset >= 0 and offset % 2:
+        offset = blob.find(pattern, offset + 1)
+    if offset < 0:
+        raise ValueError("%s not found in Elements metadata." % name)
+
+    return offset
+
+
+def parse_elements_tag(blob):
+    """Pulls the stage position, the absolute time and the plane names out of the
+    binary Nikon Elements metadata tag (65331).
+
+    The values are read at fixed byte offsets after their names, which are UTF-16LE.
+    The plane names are the words after each sOpticalConfigName, reading the tag a
+    character at a time at either byte alignment.
+
+    returns:
+        dictionary of values:
+            'jd' (float)
+            'x' (float)
+            'y' (float)
+            'planes' (list of strings)
+
+    Called by
+    mm3_Compile.get_tif_metadata_elements
+    """
+
+    blob = bytes(bytearray(blob))
+
+    # find where the values are, or check the cached positions are still right
+    offsets = elements_offsets_cache.get(len(blob))
+    names = ("dXPos", "dYPos", "dTimeAbsolute")
+    if offsets is None or any(
+        blob[offset : offset + 2 * len(name)] != name.encode("utf-16-le")
+        for name, offset in zip(names, offsets)
+    ):
+        offsets = [find_elements_name(blob, name) for name in names]
+        elements_offsets_cache[len(blob)] = offsets
+
+    idata = {
+        "x": float(struct.unpack_from("<f", blob, offsets[0] + 16)[0]),
+        "y": float(struct.unpack_from("<f", blob, offsets[1] + 16)[0]),
+        "jd": float(struct.unpack_from("<d", blob, offsets[2] + 28)[0]),
+    }
+
+    # read the 16 bit characters at both alignments, and take the even aligned one
+    # if it is printable, otherwise the odd aligned one
+    values = np.frombuffer(blob, dtype=np.uint8).astype(np.uint16)
+    n_chars = (len(values) - 1) // 2
+    even_chars = values[0 : 2 * n_chars : 2] + values[1 : 2 * n_chars : 2] * 0x100
+    odd_chars = (
+        values[1 : 2 * n_chars + 1 : 2] + values[2 : 2 * n_chars + 1 : 2] * 0x100
+    )
+    chars = np.full(n_chars, ord(" "), dtype=np.uint8)
+    odd_printable = (odd_chars > 31) & (odd_chars < 127)
+    chars[odd_printable] = odd_chars[odd_printable]
+    even_printable = (even_chars > 31) & (even_chars < 127)
+    chars[even_printable] = even_chars[even_printable]
+
+    words = re.sub(" +", " ", chars.tobytes().decode("ascii")).split(" ")
+    idata["planes"] = [
+        words[idx + 1]
+        for idx, word in enumerate(words[:-1])
+        if word == "sOpticalConfigName"
+    ]
 
     return idata
 
 
+### Functions for the persistent TIFF metadata index ###
+# The index is a SQLite database in the analysis directory with one row per analyzed TIFF.
+# Rows are keyed by the image directory and file name, and remember the size and
+# modification time of the file when it was analyzed, so a rerun only has to analyze new
+# or changed files. Its user_version is raised each time rows are merged in, which tells
+# load_metadata_table when its cached table is out of date.
+def metadata_index_dir(params):
+    """Returns the image directory the rows of the TIFF metadata index are keyed by."""
+
+    return os.path.abspath(str(params["TIFF_dir"]))
+
+
+def open_metadata_index(params):
+    """Opens (and creates if needed) the TIFF metadata index in the analysis directory.
+
+    Returns
+    index : sqlite3.Connection
+    """
+
+    index = sqlite3.connect(os.path.join(params["ana_dir"], "TIFF_metadata.db"))
+
+    # indexes from before the rows were keyed by directory are made again
+    columns = [row[1] for row in index.execute("PRAGMA table_info(images)")]
+    if columns and "tiff_dir" not in columns:
+        with index:
+            index.execute("DROP TABLE images")
+
+    index.execute(
+        "CREATE TABLE IF NOT EXISTS images ("
+        "tiff_dir TEXT, "
+        "filename TEXT, "
+        "size INTEGER, "
+        "mtime_ns INTEGER, "
+        "fov INTEGER, "
+        "t INTEGER, "
+        "jd REAL, "
+        "x REAL, "
+        "y REAL, "
+        "planes TEXT, "
+        "shape TEXT, "
+        "PRIMARY KEY (tiff_dir, filename))"
+    )
+
+    return index
+
+
+def get_file_stamps(params, filenames):
+    """Returns the (size, mtime_ns) stamp of each raw TIFF, which is what the index
+    uses to decide if a file needs to be analyzed again.
+    """
+
+    stamps = {}
+    for fn in filenames:
+        stat = os.stat(os.path.join(params["TIFF_dir"], fn))
+        stamps[fn] = (stat.st_size, stat.st_mtime_ns)
+
+    return stamps
+
+
+def load_metadata_index(params, filenames=None):
+    """Loads image information from the TIFF metadata index, of the images in
+    params['TIFF_dir'].
+
+    Parameters
+    filenames : list or None
+        Only return these files. All indexed files are returned if None.
+
+    Returns
+    analyzed_imgs : dict
+        image information as returned by get_tif_params, keyed by file name.
+    stamps : dict
+        (size, mtime_ns) of each file at the time it was analyzed.
+    """
+
+    analyzed_imgs = {}
+    stamps = {}
+
+    index = open_metadata_index(params)
+    try:
+        for row in index.execute(
+            "SELECT filename, size, mtime_ns, fov, t, jd, x, y, planes, shape "
+            "FROM images WHERE tiff_dir = ?",
+            (metadata_index_dir(params),),
+        ):
+            fn = row[0]
+            stamps[fn] = (row[1], row[2])
+            analyzed_imgs[fn] = {
+                "filepath": os.path.join(params["TIFF_dir"], fn),
+                "fov": row[3],
+                "t": row[4],
+                "jd": row[5],
+                "x": row[6],
+                "y": row[7],
+                "planes": json.loads(row[8]),
+                "shape": json.loads(row[9]),
+            }
+    finally:
+        index.close()
+
+    if filenames is not None:
+        analyzed_imgs = {
+            fn: analyzed_imgs[fn] for fn in filenames if fn in analyzed_imgs
+        }
+        stamps = {fn: stamps[fn] for fn in analyzed_imgs}
+
+    return analyzed_imgs, stamps
+
+
+def update_metadata_index(params, analyzed_imgs, stamps):
+    """Merges newly analyzed images into the TIFF metadata index, and raises its
+    version (user_version). Images whose analysis failed are not stored so they are
+    tried again next time.
+
+    Parameters
+    analyzed_imgs : dict
+        image information as returned by get_tif_params, keyed by file name.
+    stamps : dict
+        (size, mtime_ns) of each file, as returned by get_file_stamps.
+    """
+
+    tiff_dir = metadata_index_dir(params)
+    rows = []
+    for fn, img_v in six.iteritems(analyzed_imgs):
+        if not img_v or "fov" not in img_v:
+            continue
+        rows.append(
+            (
+                tiff_dir,
+                fn,
+                int(stamps[fn][0]),
+                int(stamps[fn][1]),
+                int(img_v["fov"]),
+                int(img_v["t"]),
+                float(img_v["jd"]),
+                float(img_v["x"]),
+                float(img_v["y"]),
+                json.dumps(list(img_v["planes"])),
+                json.dumps([int(dim) for dim in img_v["shape"]]),
+            )
+        )
+
+    index = open_metadata_index(params)
+    try:
+        with index:  # commits the transaction
+            index.executemany(
+                "INSERT OR REPLACE INTO images VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            version = index.execute("PRAGMA user_version").fetchone()[0]
+            index.execute("PRAGMA user_version = %d" % (version + 1))
+    finally:
+        index.close()
+
+    return len(rows)
+
+
+### Functions for the columnar metadata table ###
+# The metadata of the images as a NumPy structured array with a row per image, sorted by
+# FOV and then time. The rows of an FOV are contiguous, so selecting them is a slice
+# (see metadata_fov_index) and the time table and masks do not loop over a dict of dicts.
+def metadata_table_dtype(filename_len):
+    """Returns the dtype of a metadata table with file names up to filename_len long."""
+
+    return np.dtype(
+        [
+            ("filename", "U%d" % max(filename_len, 1)),
+            ("fov", np.int32),
+            ("t", np.int32),
+            ("jd", np.float64),
+            ("x", np.float64),
+            ("y", np.float64),
+            ("shape", np.int32, (2,)),
+            ("n_planes", np.int32),
+        ]
+    )
+
+
+def make_metadata_table(analyzed_imgs):
+    """Makes a metadata table from image information as returned by get_tif_params.
+    Images whose analysis failed are left out.
+
+    Returns
+    metadata_table : np.ndarray
+        structured array (see metadata_table_dtype) sorted by fov and t.
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    rows = [
+        (
+            fn,
+            img_v["fov"],
+            img_v["t"],
+            img_v["jd"],
+            img_v["x"],
+            img_v["y"],
+            tuple(img_v["shape"]),
+            len(img_v["planes"]),
+        )
+        for fn, img_v in six.iteritems(analyzed_imgs)
+        if img_v and "fov" in img_v
+    ]
+    filename_len = max([len(row[0]) for row in rows] + [1])
+    metadata_table = np.array(rows, dtype=metadata_table_dtype(filename_len))
+
+    # sort by fov then t, images with the same time keep their order
+    order = np.lexsort((metadata_table["t"], metadata_table["fov"]))
+
+    return metadata_table[order]
+
+
+def load_metadata_table(params, filenames=None):
+    """Loads the metadata table of the images of params['TIFF_dir'] in the TIFF
+    metadata index. The table is cached as TIFF_metadata_table.npz in the analysis
+    directory with the version of the index it was made from, and is remade when the
+    version of the index has changed since.
+
+    Parameters
+    filenames : list or None
+        Only return these files. All indexed files are returned if None.
+
+    Returns
+    metadata_table : np.ndarray
+        structured array (see metadata_table_dtype) sorted by fov and t.
+    """
+
+    table_path = os.path.join(params["ana_dir"], "TIFF_metadata_table.npz")
+    tiff_dir = metadata_index_dir(params)
+
+    index = open_metadata_index(params)
+    try:
+        version = index.execute("PRAGMA user_version").fetchone()[0]
+
+        metadata_table = None
+        if os.path.exists(table_path):
+            try:
+                with np.load(table_path) as table_file:
+                    if (
+                        int(table_file["version"]) == version
+                        and str(table_file["tiff_dir"]) == tiff_dir
+                    ):
+                        metadata_table = table_file["table"]
+            except (OSError, KeyError, ValueError):
+                metadata_table = None
+
+        if metadata_table is None:
+            rows = index.execute(
+                "SELECT filename, fov, t, jd, x, y, shape, planes FROM images "
+                "WHERE tiff_dir = ? ORDER BY fov, t",
+                (tiff_dir,),
+            ).fetchall()
+
+            filename_len = max([len(row[0]) for row in rows] + [1])
+            metadata_table = np.array(
+                [
+                    row[:6] + (tuple(json.loads(row[6])), len(json.loads(row[7])))
+                    for row in rows
+                ],
+                dtype=metadata_table_dtype(filename_len),
+            )
+            np.savez(
+                table_path,
+                table=metadata_table,
+                version=np.array(version, dtype=np.int64),
+                tiff_dir=np.array(tiff_dir),
+            )
+    finally:
+        index.close()
+
+    if filenames is not None:
+        metadata_table = metadata_table[
+            np.isin(metadata_table["filename"], list(filenames))
+        ]
+
+    return metadata_table
+
+
+def metadata_fov_index(metadata_table):
+    """Returns the slice of the rows of each FOV in a metadata table, by FOV id."""
+
+    fovs, starts, counts = np.unique(
+        metadata_table["fov"], return_index=True, return_counts=True
+    )
+
+    return {
+        int(fov): slice(int(start), int(start + count))
+        for fov, start, count in zip(fovs, starts, counts)
+    }
+
+
 ### Functions for dealing with cross-correlations, which are used to determine empty/full channels ###
 # calculate cross correlation between pixels in channel stack
-def channel_xcorr(params, fov_id, peak_id):
+def channel_xcorr(params, fov_id, peak_id, drift=None):
     """
     Function calculates the cross correlation of images in a
     stack to the first image in the stack. The output is an
@@ -313,34 +822,230 @@ def channel_xcorr(params, fov_id, peak_id):
     correlation between that image and the first image.
 
     The very first value should be 1.
+
+    This is channel_xcorr_fov for a single peak. The drift of the FOV is read from
+    drift.npz if not given, so pass it (load_drift(params).get(fov_id)) when
+    calling this for many peaks.
     """
 
-    pad_size = params["compile"]["alignment_pad"]
+    if drift is None:
+        drift = load_drift(params).get(fov_id)
+
+    return channel_xcorr_fov(params, fov_id, [peak_id], drift=drift)[peak_id]
+
+
+# which time points are used for cross correlations
+def xcorr_sample_indices(n_images):
+    """Returns the indices of the images of a channel stack used to calculate cross
+    correlations. If there are more images than number_of_images, number_of_images
+    images evenly spaced across the range are used.
+
+    Called by
+    mm3_Compile.channel_xcorr_fov
+    mm3_Compile.collect_xcorr_samples
+    """
 
     # Use this number of images to calculate cross correlations
     number_of_images = 20
 
-    # load the phase contrast images
-    image_data = load_stack(params, fov_id, peak_id, color=params["phase_plane"])
+    sample_indices = np.arange(n_images)
+    if n_images > number_of_images:
+        spacing = int(n_images / number_of_images)
+        sample_indices = sample_indices[::spacing][:number_of_images]
 
-    # if there are more images than number_of_images, use number_of_images images evenly
-    # spaced across the range
-    if image_data.shape[0] > number_of_images:
-        spacing = int(image_data.shape[0] / number_of_images)
-        image_data = image_data[::spacing, :, :]
-        if image_data.shape[0] > number_of_images:
-            image_data = image_data[:number_of_images, :, :]
+    return sample_indices
 
-    # we will compare all images to this one, needs to be padded to account for image drift
-    first_img = np.pad(image_data[0, :, :], pad_size, mode="reflect")
 
-    xcorr_array = []  # array holds cross correlation vaues
-    for img in image_data:
-        # use match_template to find all cross correlations for the
-        # current image against the first image.
-        xcorr_array.append(np.max(match_template(first_img, img)))
+# keep the images used for cross correlations while slicing
+def collect_xcorr_samples(
+    params, xcorr_samples, peak, channel_stack, t_index, n_images
+):
+    """Adds the phase images of a sliced block which are used for cross correlations
+    (see xcorr_sample_indices) to xcorr_samples[peak], so they do not have to be
+    loaded again. Nothing is kept if cross correlations are not calculated.
 
-    return xcorr_array
+    Parameters
+    channel_stack : np.ndarray
+        block of channel slices in the form [t, y, x, c].
+    t_index : int
+        time index of the first slice of the block in the channel stack.
+    n_images : int
+        number of images in the whole channel stack.
+
+    Called by
+    mm3_Compile.hdf5_stack_slice_and_write
+    mm3_Compile.tiff_stack_slice_and_write
+    mm3_Compile.zarr_stack_slice_and_write
+    """
+
+    if not params["compile"]["do_crosscorrs"]:
+        return
+
+    phase_index = int(params["phase_plane"][1:]) - 1
+    sample_indices = xcorr_sample_indices(n_images)
+    sample_indices = sample_indices[
+        (sample_indices >= t_index) & (sample_indices < t_index + len(channel_stack))
+    ]
+
+    xcorr_samples.setdefault(peak, []).append(
+        channel_stack[sample_indices - t_index, :, :, phase_index]
+    )
+
+
+# estimate the stage drift while slicing
+def collect_drift(params, drift, image_block):
+    """Estimates the drift of the phase planes of a block of raw images from the first
+    image of the FOV with phase_correlation_shifts, and adds it to drift['shifts'].
+    The drift is only estimated if params['compile']['do_drift'] is set.
+
+    Parameters
+    drift : dict
+        'reference', the phase plane of the first image, and 'shifts', int array
+        (t, 2) of the (dy, dx) drift of the images so far. Empty at the first block.
+    image_block : np.ndarray
+        block of raw images in the form [t, y, x, c].
+
+    Called by
+    mm3_Compile.hdf5_stack_slice_and_write
+    mm3_Compile.tiff_stack_slice_and_write
+    mm3_Compile.zarr_stack_slice_and_write
+    """
+
+    if "do_drift" not in params["compile"] or not params["compile"]["do_drift"]:
+        return
+
+    phase_index = int(params["phase_plane"][1:]) - 1
+    phase_block = image_block[:, :, :, phase_index]
+
+    if "reference" not in drift:
+        drift["reference"] = phase_block[0]
+        drift["shifts"] = np.zeros((0, 2), dtype=int)
+
+    # the channels look the same shifted by their separation, so the drift is
+    # only looked for up to half of it
+    block_shifts = phase_correlation_shifts(
+        drift["reference"],
+        phase_block,
+        max_shift=int(params["compile"]["channel_separation"] / 2),
+    )
+    drift["shifts"] = np.concatenate([drift["shifts"], block_shifts])
+
+
+def save_drift(params, fov_drifts):
+    """Saves the drift of the FOVs found while slicing to drift.npz in the analysis
+    directory, next to the channel masks. FOVs already in the file and not in
+    fov_drifts are kept. It is loaded with load_drift.
+
+    Parameters
+    fov_drifts : dict
+        int array (t, 2) of the (dy, dx) drift of each image, by FOV id.
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    drifts = load_drift(params)
+    drifts.update(fov_drifts)
+
+    fov_ids = sorted(drifts.keys())
+    np.savez(
+        os.path.join(params["ana_dir"], "drift.npz"),
+        fov_ids=np.array(fov_ids, dtype=int),
+        **{"shifts_%d" % fov_id: drifts[fov_id] for fov_id in fov_ids}
+    )
+
+    information("Saved drift for %d FOVs." % len(fov_drifts))
+
+
+# calculate cross correlations for all channels in an FOV
+def channel_xcorr_fov(params, fov_id, peak_ids, xcorr_samples=None, drift=None):
+    """Calculates the cross correlation of images in the channel stacks of an FOV to
+    the first image in the stack, as channel_xcorr does for one channel.
+
+    The images are compared with match_template_fft, which correlates the images
+    of all channels of the same size in one FFT pass. If the drift of the FOV is
+    known the images are only compared within a pixel of the drift (see
+    match_template_at), as the drift is only estimated to the pixel.
+
+    Parameters
+    peak_ids : list
+        channels to calculate cross correlations for.
+    xcorr_samples : dict
+        images already sampled while slicing (see collect_xcorr_samples), as a list
+        of arrays per peak. Channels which are not in it are loaded.
+    drift : np.ndarray
+        (dy, dx) drift of each image of the FOV, as returned by load_drift.
+
+    Returns
+    xcorrs : dict
+        list of the best cross correlation of each image to the first, per peak.
+
+    Called by
+    mm3_Compile.compile
+    mm3_Compile.channel_xcorr
+    """
+
+    pad_size = params["compile"]["alignment_pad"]
+
+    # drift of the sampled images from the first one
+    sample_drift = None
+    if drift is not None and len(drift) > 0:
+        sample_drift = drift[xcorr_sample_indices(len(drift))]
+        sample_drift = sample_drift - sample_drift[0]
+
+    # get the sampled phase contrast images for each channel
+    peak_stacks = {}
+    for peak_id in peak_ids:
+        if xcorr_samples and peak_id in xcorr_samples:
+            peak_stacks[peak_id] = np.concatenate(xcorr_samples[peak_id], axis=0)
+        else:
+            # load the phase contrast images
+            image_data = load_stack(
+                params, fov_id, peak_id, color=params["phase_plane"]
+            )
+            peak_stacks[peak_id] = image_data[xcorr_sample_indices(len(image_data))]
+
+    # channels which are the same size are done together
+    shape_peaks = {}
+    for peak_id, image_data in six.iteritems(peak_stacks):
+        shape_peaks.setdefault(image_data.shape, []).append(peak_id)
+
+    xcorrs = {}
+    for shape_peak_ids in shape_peaks.values():
+        image_stacks = np.stack([peak_stacks[peak_id] for peak_id in shape_peak_ids])
+
+        # we will compare all images to the first, needs to be padded to account for image drift
+        first_imgs = np.pad(
+            image_stacks[:, 0],
+            ((0, 0), (pad_size, pad_size), (pad_size, pad_size)),
+            mode="reflect",
+        )
+
+        if sample_drift is not None and len(sample_drift) == image_stacks.shape[1]:
+            # the best cross correlation within a pixel of where the drift puts
+            # each image on the first
+            positions = pad_size - sample_drift
+            xcorr_arrays = np.max(
+                [
+                    match_template_at(
+                        first_imgs[:, np.newaxis], image_stacks, positions + (dy, dx)
+                    )
+                    for dy in (-1, 0, 1)
+                    for dx in (-1, 0, 1)
+                ],
+                axis=0,
+            )
+        else:
+            # the best cross correlation for all images against the first image
+            xcorr_maps = match_template_fft(first_imgs[:, np.newaxis], image_stacks)
+            xcorr_arrays = xcorr_maps.max(axis=(-2, -1))
+
+        for peak_id, xcorr_array in zip(shape_peak_ids, xcorr_arrays):
+            xcorrs[peak_id] = list(xcorr_array)
+
+    count(peaks=len(peak_ids))
+
+    return xcorrs
 
 
 ### functions about trimming, padding, and manipulating images
@@ -400,63 +1105,122 @@ def cut_slice(image_data, channel_loc):
     return channel_slice
 
 
+# loads a raw image as it is sliced
+def load_raw_image(params, image_params):
+    """Loads a raw TIFF and fixes its orientation the same way as for channel finding.
+    If image_params has a 'spill' entry, (spill path, row) as made by read_fov_frames,
+    the already oriented image is loaded from the spill instead.
+
+    Returns
+    image_data : np.ndarray
+        image in the form [y, x, c].
+
+    Called by
+    mm3_Compile.load_image_blocks
+    """
+
+    if "spill" in image_params:
+        # fused compiling, the image was read and oriented for channel finding
+        spill_path, row = image_params["spill"]
+        image_data = np.array(np.load(spill_path, mmap_mode="r")[row])
+
+    else:
+        # load the tif
+        with tiff.TiffFile(image_params["filepath"]) as tif:
+            image_data = tif.asarray()
+
+        # channel finding was also done on images after orientation was fixed
+        image_data = fix_orientation(params, image_data)
+
+    # add additional axis if the image is flat
+    if len(image_data.shape) == 2:
+        image_data = np.expand_dims(image_data, 0)
+
+    # change axis so it goes Y, X, Plane
+    image_data = np.rollaxis(image_data, 0, 3)
+
+    return image_data
+
+
+# loads the images of an FOV a few at a time
+def load_image_blocks(params, images_to_write, analyzed_imgs):
+    """Generator which loads the raw images to slice in blocks of consecutive time points,
+    so only a window of the FOV is in memory at once. The window size in frames is
+    params['compile']['slice_window']; None loads the whole FOV as one block.
+
+    Yields
+    t_index : int
+        position of the first image of the block in images_to_write.
+    image_block : np.ndarray
+        images in the form [t, y, x, c].
+
+    Called by
+    mm3_Compile.hdf5_stack_slice_and_write
+    mm3_Compile.tiff_stack_slice_and_write
+    """
+
+    window = None
+    if "slice_window" in params["compile"]:
+        window = params["compile"]["slice_window"]
+        if window == "None":
+            window = None
+    if window is None:
+        window = len(images_to_write)
+    window = max(int(window), 1)
+
+    for t_index in range(0, len(images_to_write), window):
+        image_block = []
+        for image in images_to_write[t_index : t_index + window]:
+            # analyzed_imgs dictionary will be found in main scope. [0] is the key, [1] is t
+            image_params = analyzed_imgs[image[0]]
+            information("Loading %s." % image_params["filepath"].split("/")[-1])
+
+            # add it to list. The images should be in time order
+            image_block.append(load_raw_image(params, image_params))
+        count(files=len(image_block), frames=len(image_block))
+
+        yield t_index, np.stack(image_block, axis=0)
+
+
 # same thing as tiff_stack_slice_and_write but do it for hdf5
 def hdf5_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_imgs):
     """Writes out 4D stacks of TIFF images to an HDF5 file.
+    The channel datasets are created for all time points, and filled as blocks of
+    images are loaded and sliced.
+
+    Returns
+    xcorr_samples : dict
+        phase images used for cross correlations, see collect_xcorr_samples.
+    drift : np.ndarray
+        drift of each image, see collect_drift. None if it was not estimated.
 
     Called by
     __main__
     """
 
-    # make an array of images and then concatenate them into one big stack
-    image_fov_stack = []
-
     # make arrays for filenames and times
     image_filenames = []
     image_times = []  # times is still an integer but may be indexed arbitrarily
     image_jds = []  # jds = julian dates (times)
 
-    # go through list of images, load and fix them, and create arrays of metadata
-    for n, image in enumerate(images_to_write):
-        image_name = image[0]  # [0] is the key, [1] is jd
-
-        # analyzed_imgs dictionary will be found in main scope.
+    # go through list of images and create arrays of metadata
+    for image in images_to_write:
+        image_name = image[0]  # [0] is the key, [1] is t
         image_params = analyzed_imgs[image_name]
-        information("Loading %s." % image_params["filepath"].split("/")[-1])
 
         # add information to metadata arrays
         image_filenames.append(image_name)
         image_times.append(image_params["t"])
         image_jds.append(image_params["jd"])
 
-        # declare identification variables for saving using first image
-        if n == 1:
-            # same across fov
-            fov_id = image_params["fov"]
-            x_loc = image_params["x"]
-            y_loc = image_params["y"]
-            image_shape = image_params["shape"]
-            image_planes = image_params["planes"]
-
-        # load the tif and store it in array
-        with tiff.TiffFile(image_params["filepath"]) as tif:
-            image_data = tif.asarray()
-
-        # channel finding was also done on images after orientation was fixed
-        image_data = fix_orientation(params, image_data)
-
-        # add additional axis if the image is flat
-        if len(image_data.shape) == 2:
-            image_data = np.expand_dims(image_data, 0)
-
-        # change axis so it goes X, Y, Plane
-        image_data = np.rollaxis(image_data, 0, 3)
-
-        # add it to list. The images should be in time order
-        image_fov_stack.append(image_data)
-
-    # concatenate the list into one big ass stack
-    image_fov_stack = np.stack(image_fov_stack, axis=0)
+    # declare identification variables for saving using first image
+    # same across fov
+    image_params = analyzed_imgs[images_to_write[0][0]]
+    fov_id = image_params["fov"]
+    x_loc = image_params["x"]
+    y_loc = image_params["y"]
+    image_shape = image_params["shape"]
+    image_planes = image_params["planes"]
 
     # create the HDF5 file for the FOV, first time this is being done.
     with h5py.File(
@@ -476,7 +1240,7 @@ def hdf5_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_
         # this is for things that change across time, for these create a dataset
         h5ds = h5f.create_dataset(
             "filenames",
-            data=np.expand_dims(image_filenames, 1),
+            data=np.expand_dims(np.array(image_filenames, dtype="S100"), 1),
             chunks=True,
             maxshape=(None, 1),
             dtype="S100",
@@ -503,128 +1267,548 @@ def hdf5_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_
             fletcher32=True,
         )
 
-        # cut out the channels as per channel masks for this fov
-        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
-            # information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
-            information("Slicing and saving channel peak %d." % peak)
+        # phase images kept for the cross correlations, and the drift of the images
+        xcorr_samples = {}
+        drift = {}
+
+        for t_index, image_block in load_image_blocks(
+            params, images_to_write, analyzed_imgs
+        ):
+            collect_drift(params, drift, image_block)
+
+            # cut out the channels as per channel masks for this fov
+            for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+                # slice out channel.
+                # The function should recognize the shape length as 4 and cut all time points
+                channel_stack = cut_slice(image_block, channel_loc)
+                collect_xcorr_samples(
+                    params,
+                    xcorr_samples,
+                    peak,
+                    channel_stack,
+                    t_index,
+                    len(images_to_write),
+                )
+                t_slice = np.s_[t_index : t_index + channel_stack.shape[0]]
+
+                if t_index == 0:
+                    information("Slicing and saving channel peak %d." % peak)
+
+                    # create group for this channel
+                    h5g = h5f.create_group("channel_%04d" % peak)
+
+                    # add attribute for peak_id, channel location
+                    h5g.attrs.create("peak_id", peak)
+                    h5g.attrs.create("channel_loc", channel_loc)
+                else:
+                    h5g = h5f["channel_%04d" % peak]
+
+                # save a different dataset for all colors
+                for color_index in range(channel_stack.shape[3]):
+                    dataset_name = "p%04d_c%1d" % (peak, color_index + 1)
+
+                    if t_index == 0:
+                        # create the dataset for all time points. Review docs for these options.
+                        stack_shape = (len(images_to_write),) + channel_stack.shape[1:3]
+                        h5ds = h5g.create_dataset(
+                            dataset_name,
+                            shape=stack_shape,
+                            dtype=channel_stack.dtype,
+                            **hdf5_dataset_kwargs(params, stack_shape)
+                        )
+                    else:
+                        h5ds = h5g[dataset_name]
+
+                    h5ds[t_slice] = channel_stack[:, :, :, color_index]
+
+    count(peaks=len(channel_masks[fov_id]))
+
+    return xcorr_samples, drift.get("shifts")
+
+
+# same thing as hdf5_stack_slice_and_write but for a zarr store
+def zarr_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_imgs):
+    """Writes out 4D stacks of TIFF images to a Zarr store per FOV, laid out like the
+    HDF5 file. The channel arrays are created for all time points, and filled as
+    blocks of images are loaded and sliced.
+
+    Returns
+    xcorr_samples : dict
+        phase images used for cross correlations, see collect_xcorr_samples.
+    drift : np.ndarray
+        drift of each image, see collect_drift. None if it was not estimated.
+
+    Called by
+    __main__
+    """
+
+    # declare identification variables for saving using first image
+    # same across fov
+    image_params = analyzed_imgs[images_to_write[0][0]]
+    fov_id = image_params["fov"]
+
+    zgroup = open_zarr_fov(params, fov_id, mode="w")
+
+    # add in metadata for this FOV
+    # these attributes should be common for all channel
+    zgroup.attrs.update(
+        {
+            "fov_id": int(fov_id),
+            "stage_x_loc": image_params["x"],
+            "stage_y_loc": image_params["y"],
+            "image_shape": [int(dim) for dim in image_params["shape"]],
+            "planes": list(image_params["planes"]),
+            "peaks": [int(peak) for peak in sorted(channel_masks[fov_id].keys())],
+        }
+    )
+
+    # this is for things that change across time
+    zgroup.array(
+        "filenames",
+        np.expand_dims(np.array([image[0] for image in images_to_write], "S100"), 1),
+    )
+    zgroup.array(
+        "times",
+        np.expand_dims([analyzed_imgs[image[0]]["t"] for image in images_to_write], 1),
+    )
+    zgroup.array(
+        "times_jd",
+        np.expand_dims(
+            [analyzed_imgs[image[0]]["jd"] for image in images_to_write], 1
+        ).astype(float),
+    )
+
+    # phase images kept for the cross correlations, and the drift of the images
+    xcorr_samples = {}
+    drift = {}
+
+    for t_index, image_block in load_image_blocks(
+        params, images_to_write, analyzed_imgs
+    ):
+        collect_drift(params, drift, image_block)
+
+        # cut out the channels as per channel masks for this fov
+        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+            # slice out channel.
+            # The function should recognize the shape length as 4 and cut all time points
+            channel_stack = cut_slice(image_block, channel_loc)
+            collect_xcorr_samples(
+                params,
+                xcorr_samples,
+                peak,
+                channel_stack,
+                t_index,
+                len(images_to_write),
+            )
+            t_slice = np.s_[t_index : t_index + channel_stack.shape[0]]
+
+            if t_index == 0:
+                information("Slicing and saving channel peak %d." % peak)
+
+                # create group for this channel
+                zchnl = zgroup.create_group("channel_%04d" % peak)
+
+                # add attribute for peak_id, channel location
+                zchnl.attrs["peak_id"] = int(peak)
+                zchnl.attrs["channel_loc"] = [
+                    [int(px) for px in loc] for loc in channel_loc
+                ]
+            else:
+                zchnl = zgroup["channel_%04d" % peak]
+
+            # save a different array for all colors
+            for color_index in range(channel_stack.shape[3]):
+                array_name = "p%04d_c%1d" % (peak, color_index + 1)
+
+                if t_index == 0:
+                    zarray = create_zarr_stack(
+                        params,
+                        zchnl,
+                        array_name,
+                        (len(images_to_write),) + channel_stack.shape[1:3],
+                        channel_stack.dtype,
+                    )
+                else:
+                    zarray = zchnl[array_name]
+
+                zarray[t_slice] = channel_stack[:, :, :, color_index]
+
+    count(peaks=len(channel_masks[fov_id]))
+
+    return xcorr_samples, drift.get("shifts")
+
+
+# slice_and_write cuts up the image files a few at a time and writes them out to tiff stacks
+def tiff_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_imgs):
+    """Writes out 4D stacks of TIFF images per channel.
+    Loads the tiffs from an FOV a block of time points at a time (see load_image_blocks).
+    The slices are collected in memory mapped staging files next to the channel stacks,
+    which are written out as TIFFs once all time points are sliced.
+
+    Returns
+    xcorr_samples : dict
+        phase images used for cross correlations, see collect_xcorr_samples.
+    drift : np.ndarray
+        drift of each image, see collect_drift. None if it was not estimated.
+
+    Called by
+    __main__
+    """
+
+    # declare identification variables for saving using first image
+    fov_id = analyzed_imgs[images_to_write[0][0]]["fov"]
+
+    # staging arrays for each channel, [t, y, x, c]
+    channel_stagings = {}
+
+    # phase images kept for the cross correlations, and the drift of the images
+    xcorr_samples = {}
+    drift = {}
+
+    for t_index, image_block in load_image_blocks(
+        params, images_to_write, analyzed_imgs
+    ):
+        collect_drift(params, drift, image_block)
+
+        # cut out the channels as per channel masks for this fov
+        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+            # slice out channel.
+            # The function should recognize the shape length as 4 and cut all time points
+            channel_stack = cut_slice(image_block, channel_loc)
+            collect_xcorr_samples(
+                params,
+                xcorr_samples,
+                peak,
+                channel_stack,
+                t_index,
+                len(images_to_write),
+            )
+
+            if t_index == 0:
+                channel_stagings[peak] = np.lib.format.open_memmap(
+                    os.path.join(
+                        params["chnl_dir"],
+                        params["experiment_name"]
+                        + "_xy%03d_p%04d_staging.npy" % (fov_id, peak),
+                    ),
+                    mode="w+",
+                    dtype=channel_stack.dtype,
+                    shape=(len(images_to_write),) + channel_stack.shape[1:],
+                )
+
+            channel_stagings[peak][
+                t_index : t_index + channel_stack.shape[0]
+            ] = channel_stack
+
+    for peak, channel_staging in six.iteritems(channel_stagings):
+        information("Saving channel peak %d." % peak)
+
+        # save a different time stack for all colors
+        for color_index in range(channel_staging.shape[3]):
+            # this is the filename for the channel
+            # # chnl_dir and p will be looked for in the scope above (__main__)
+            channel_filename = os.path.join(
+                params["chnl_dir"],
+                params["experiment_name"]
+                + "_xy%03d_p%04d_c%1d.tif" % (fov_id, peak, color_index + 1),
+            )
+            # save stack
+            tiff.imsave(
+                channel_filename, channel_staging[:, :, :, color_index], compress=4
+            )
+
+        # remove the staging file
+        staging_filename = channel_staging.filename
+        del channel_staging
+        channel_stagings[peak] = None
+        os.remove(staging_filename)
+
+    count(peaks=len(channel_masks[fov_id]))
+
+    return xcorr_samples, drift.get("shifts")
+
+
+# add frames to the end of an hdf5 dataset or zarr array
+def append_frames(stack, frames):
+    """Appends frames along the time axis of an HDF5 dataset or Zarr array, which can
+    both be resized (the HDF5 datasets are made with maxshape None in t)."""
+
+    n_t = stack.shape[0]
+    stack.resize((n_t + len(frames),) + tuple(stack.shape[1:]))
+    stack[n_t:] = frames
+
+
+# slices new images of an fov and adds them to the end of the channel stacks
+def append_stack_frames(
+    params, images_to_append, channel_masks, analyzed_imgs, reference_params=None
+):
+    """Slices images with the channel masks Compile already made and appends them to
+    the channel stacks of the FOV, for watch_tiff_dir. The images must come after the
+    last time point in the stacks. The HDF5 datasets or Zarr arrays are resized in
+    place; TIFF stacks can not be added to.
+
+    Parameters
+    images_to_append : list
+        [filename, t] of the new images of one FOV, in time order.
+    reference_params : dict
+        image information of the first image of the FOV, which the drift of the new
+        images is estimated from (see collect_drift). None to not estimate drift.
+
+    Returns
+    drift : np.ndarray
+        (dy, dx) drift of each new image. None if it was not estimated.
+
+    Called by
+    mm3_Compile.watch_tiff_dir
+    """
+
+    fov_id = analyzed_imgs[images_to_append[0][0]]["fov"]
+
+    drift = {}
+    if reference_params is not None and params["compile"]["do_drift"]:
+        phase_index = int(params["phase_plane"][1:]) - 1
+        drift["reference"] = load_raw_image(params, reference_params)[:, :, phase_index]
+        drift["shifts"] = np.zeros((0, 2), dtype=int)
+
+    if params["output"] == "HDF5":
+        store = h5py.File(
+            os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id),
+            "a",
+            libver="earliest",
+        )
+    elif params["output"] == "Zarr":
+        store = open_zarr_fov(params, fov_id, mode="a")
+    else:
+        raise ValueError("Only HDF5 and Zarr channel stacks can be added to.")
+
+    try:
+        append_frames(
+            store["filenames"],
+            np.expand_dims(
+                np.array([image[0] for image in images_to_append], "S100"), 1
+            ),
+        )
+        append_frames(
+            store["times"],
+            np.expand_dims(
+                [analyzed_imgs[image[0]]["t"] for image in images_to_append], 1
+            ),
+        )
+        append_frames(
+            store["times_jd"],
+            np.expand_dims(
+                [analyzed_imgs[image[0]]["jd"] for image in images_to_append], 1
+            ).astype(float),
+        )
+
+        for t_index, image_block in load_image_blocks(
+            params, images_to_append, analyzed_imgs
+        ):
+            collect_drift(params, drift, image_block)
+
+            for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+                channel_stack = cut_slice(image_block, channel_loc)
 
-            # create group for this channel
-            h5g = h5f.create_group("channel_%04d" % peak)
+                for color_index in range(channel_stack.shape[3]):
+                    append_frames(
+                        store[
+                            "channel_%04d/p%04d_c%1d" % (peak, peak, color_index + 1)
+                        ],
+                        channel_stack[:, :, :, color_index],
+                    )
 
-            # add attribute for peak_id, channel location
-            h5g.attrs.create("peak_id", peak)
-            h5g.attrs.create("channel_loc", channel_loc)
+    finally:
+        if params["output"] == "HDF5":
+            store.close()
 
-            # channel masks should only contain ints, but you can use this for a hard fix
-            # for i in range(len(channel_loc)):
-            #     for j in range(len(channel_loc[i])):
-            #         channel_loc[i][j] = int(channel_loc[i][j])
+    count(peaks=len(channel_masks[fov_id]))
 
-            # slice out channel.
-            # The function should recognize the shape length as 4 and cut all time points
-            channel_stack = cut_slice(image_fov_stack, channel_loc)
+    return drift.get("shifts")
 
-            # save a different dataset for all colors
-            for color_index in range(channel_stack.shape[3]):
 
-                # create the dataset for the image. Review docs for these options.
-                h5ds = h5g.create_dataset(
-                    "p%04d_c%1d" % (peak, color_index + 1),
-                    data=channel_stack[:, :, :, color_index],
-                    chunks=(1, channel_stack.shape[1], channel_stack.shape[2]),
-                    maxshape=(None, channel_stack.shape[1], channel_stack.shape[2]),
-                    compression="gzip",
-                    shuffle=True,
-                    fletcher32=True,
-                )
+# choose which images are used for finding channels
+def select_channel_detection_images(params, analyzed_imgs):
+    """Picks the images of each FOV which channel detection is run on.
+
+    Channels do not move much over an experiment, so the consensus masks can be made from
+    a sample of the images. The number of images per FOV is set by
+    params['compile']['channel_detection_frames']; they are spaced evenly in time.
+    If it is None (or not set) all images are used.
 
-                # h5ds.attrs.create('plane', image_planes[color_index].encode('utf8'))
+    Returns
+    detection_imgs : list
+        keys of analyzed_imgs to find channels in, sorted by FOV and time.
+
+    Called by
+    mm3_Compile.find_image_channels
+    """
 
-                # write the data even though we have more to write (free up memory)
-                h5f.flush()
+    n_frames = None
+    if "channel_detection_frames" in params["compile"]:
+        n_frames = params["compile"]["channel_detection_frames"]
+        if n_frames == "None":
+            n_frames = None
 
-    return
+    # group the successfully analyzed images by fov
+    fov_imgs = {}
+    for fn, img_v in six.iteritems(analyzed_imgs):
+        if not img_v or "fov" not in img_v:
+            continue
+        fov_imgs.setdefault(img_v["fov"], []).append((img_v["t"], fn))
 
+    detection_imgs = []
+    for fov in sorted(fov_imgs.keys()):
+        fns = [fn for t, fn in sorted(fov_imgs[fov])]
 
-# slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
-def tiff_stack_slice_and_write(params, images_to_write, channel_masks, analyzed_imgs):
-    """Writes out 4D stacks of TIFF images per channel.
-    Loads all tiffs from and FOV into memory and then slices all time points at once.
+        # take images evenly spaced across the time range
+        if n_frames is not None and len(fns) > n_frames:
+            fn_indices = np.unique(
+                np.around(np.linspace(0, len(fns) - 1, max(int(n_frames), 1)))
+            )
+            fns = [fns[int(i)] for i in fn_indices]
+
+        detection_imgs += fns
+
+    return detection_imgs
+
+
+# find channels in the sampled images
+def find_image_channels(params, analyzed_imgs, graph=None):
+    """Runs channel detection on the images chosen by select_channel_detection_images
+    and adds the channel locations to their entry in analyzed_imgs under 'channels'.
+    Images which already have channel locations are not analyzed again.
+    The detection tasks are run on graph, a TaskGraph, if given.
 
     Called by
-    __main__
+    mm3_Compile.compile
     """
 
-    # make an array of images and then concatenate them into one big stack
-    image_fov_stack = []
-
-    # go through list of images and get the file path
-    for n, image in enumerate(images_to_write):
-        # analyzed_imgs dictionary will be found in main scope. [0] is the key, [1] is jd
-        image_params = analyzed_imgs[image[0]]
+    detection_imgs = [
+        fn
+        for fn in select_channel_detection_images(params, analyzed_imgs)
+        if "channels" not in analyzed_imgs[fn]
+    ]
+
+    information("Finding channels in %d images." % len(detection_imgs))
+
+    # the images of one fov are analyzed together
+    fov_imgs = {}
+    for fn in detection_imgs:
+        fov_imgs.setdefault(analyzed_imgs[fn]["fov"], []).append(fn)
+
+    # use the compile task graph, or a graph just for this
+    own_graph = graph is None
+    if own_graph:
+        graph = TaskGraph(params["num_analyzers"], params)
+
+    for fov, fns in six.iteritems(fov_imgs):
+        graph.add(
+            ("channels", fov),
+            get_fov_channels,
+            args=(params, fns),
+            labels={"fov": fov},
+        )
 
-        information("Loading %s." % image_params["filepath"].split("/")[-1])
+    graph.run()
 
-        if n == 1:
-            # declare identification variables for saving using first image
-            fov_id = image_params["fov"]
+    if own_graph:
+        graph.close()
 
-        # load the tif and store it in array
-        with tiff.TiffFile(image_params["filepath"]) as tif:
-            image_data = tif.asarray()
+    # put the channel locations into the image information if successful
+    for fov in fov_imgs.keys():
+        if ("channels", fov) in graph.results:
+            for fn, chnl_loc_dict in six.iteritems(graph.results[("channels", fov)]):
+                analyzed_imgs[fn]["channels"] = chnl_loc_dict
+        else:
+            warning("Failed finding channels for FOV %d" % fov)
 
-        # channel finding was also done on images after orientation was fixed
-        image_data = fix_orientation(params, image_data)
+    return analyzed_imgs
 
-        # add additional axis if the image is flat
-        if len(image_data.shape) == 2:
-            image_data = np.expand_dims(image_data, 0)
 
-        # change axis so it goes Y, X, Plane
-        image_data = np.rollaxis(image_data, 0, 3)
+# find the connected regions of the union of channel rectangles
+def channel_mask_regions(chnl_rects):
+    """Finds the connected regions of the union of a set of rectangles, as ndi.label
+    would on a mask with the rectangles drawn in (pixels connect to their 4 neighbours).
 
-        # add it to list. The images should be in time order
-        image_fov_stack.append(image_data)
+    Regions can only join rectangles which share covered columns, so the rectangles
+    are first split into runs of continuously covered columns, which for a mother
+    machine are single channels (or one channel from each side). Within a run,
+    rectangles which overlap or share an edge are joined.
 
-    # concatenate the list into one big ass stack
-    image_fov_stack = np.stack(image_fov_stack, axis=0)
+    Parameters
+    chnl_rects : list
+        [y1, y2, x1, x2] of each rectangle, with the ends exclusive like slices.
 
-    # cut out the channels as per channel masks for this fov
-    for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
-        # information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
-        information("Slicing and saving channel peak %d." % peak)
+    Returns
+    regions : list
+        [min_row, max_row, min_col, max_col] of each region (ends inclusive), in the
+        order ndi.label would number them.
 
-        # channel masks should only contain ints, but you can use this for hard fix
-        # for i in range(len(channel_loc)):
-        #     for j in range(len(channel_loc[i])):
-        #         channel_loc[i][j] = int(channel_loc[i][j])
+    Called by
+    mm3_Compile.make_masks
+    """
 
-        # slice out channel.
-        # The function should recognize the shape length as 4 and cut all time points
-        channel_stack = cut_slice(image_fov_stack, channel_loc)
+    chnl_rects = np.array(chnl_rects, dtype=np.int64).reshape(-1, 4)
+    # rectangles which do not cover any pixels do not add to the mask
+    chnl_rects = chnl_rects[
+        (chnl_rects[:, 0] < chnl_rects[:, 1]) & (chnl_rects[:, 2] < chnl_rects[:, 3])
+    ]
+    if len(chnl_rects) == 0:
+        return []
+    # many images have the same channel rectangles
+    chnl_rects = np.unique(chnl_rects, axis=0)
+    y1, y2, x1, x2 = chnl_rects.T
+
+    # number of rectangles covering each column, and the runs of covered columns
+    n_cols = x2.max() + 1
+    coverage = np.cumsum(
+        np.bincount(x1, minlength=n_cols) - np.bincount(x2, minlength=n_cols)
+    )
+    run_ids = np.cumsum(np.diff(np.concatenate([[0], coverage > 0]).astype(int)) == 1)
+    rect_runs = run_ids[x1]
+
+    regions = []
+    for run in np.unique(rect_runs):
+        run_rects = np.flatnonzero(rect_runs == run)
+        ry1, ry2, rx1, rx2 = y1[run_rects], y2[run_rects], x1[run_rects], x2[run_rects]
+
+        # rectangles touch if they overlap in one direction and overlap or meet in the
+        # other. Meeting only at a corner does not connect them.
+        x_overlap = np.minimum(rx2[:, None], rx2) - np.maximum(rx1[:, None], rx1)
+        y_overlap = np.minimum(ry2[:, None], ry2) - np.maximum(ry1[:, None], ry1)
+        touching = ((x_overlap > 0) & (y_overlap >= 0)) | (
+            (x_overlap >= 0) & (y_overlap > 0)
+        )
+        n_regions, rect_labels = connected_components(
+            csr_matrix(touching), directed=False
+        )
 
-        # save a different time stack for all colors
-        for color_index in range(channel_stack.shape[3]):
-            # this is the filename for the channel
-            # # chnl_dir and p will be looked for in the scope above (__main__)
-            channel_filename = os.path.join(
-                params["chnl_dir"],
-                params["experiment_name"]
-                + "_xy%03d_p%04d_c%1d.tif" % (fov_id, peak, color_index + 1),
-            )
-            # save stack
-            tiff.imsave(
-                channel_filename, channel_stack[:, :, :, color_index], compress=4
+        for region in range(n_regions):
+            in_region = rect_labels == region
+            min_row = ry1[in_region].min()
+            # ndi.label numbers regions by their first pixel in raster order
+            first_col = rx1[in_region & (ry1 == min_row)].min()
+            regions.append(
+                (
+                    (int(min_row), int(first_col)),
+                    [
+                        int(min_row),
+                        int(ry2[in_region].max() - 1),
+                        int(rx1[in_region].min()),
+                        int(rx2[in_region].max() - 1),
+                    ],
+                )
             )
 
-    return
+    return [region for first_pixel, region in sorted(regions)]
 
 
 # make masks from initial set of images (same images as clusters)
-def make_masks(params, analyzed_imgs):
+def make_masks(params, analyzed_imgs, metadata_table):
     """
     Make masks goes through the channel locations in the image metadata and builds a consensus
     Mask for each image per fov, which it returns as dictionary named channel_masks.
+    Only images which have had channels found (those with a 'channels' entry) contribute.
     The keys in this dictionary are fov id, and the values is a another dictionary. This dict's keys are channel locations (peaks) and the values is a [2][2] array:
     [[minrow, maxrow],[mincol, maxcol]] of pixel locations designating the corner of each mask
     for each channel on the whole image
@@ -635,6 +1819,8 @@ def make_masks(params, analyzed_imgs):
     Parameters
     analyzed_imgs : dict
         image information created by get_params
+    metadata_table : np.ndarray
+        metadata table of the images, made by make_metadata_table
 
     Returns
     channel_masks : dict
@@ -657,18 +1843,11 @@ def make_masks(params, analyzed_imgs):
     channel_masks = {}
 
     # get the size of the images (hope they are the same)
-    for img_k in analyzed_imgs.keys():
-        img_v = analyzed_imgs[img_k]
-        image_rows = img_v["shape"][0]  # x pixels
-        image_cols = img_v["shape"][1]  # y pixels
-        break  # just need one. using iteritems mean the whole dict doesn't load
-
-    # get the fov ids
-    fovs = []
-    for img_k in analyzed_imgs.keys():
-        img_v = analyzed_imgs[img_k]
-        if img_v["fov"] not in fovs:
-            fovs.append(img_v["fov"])
+    image_rows = int(metadata_table["shape"][0, 0])  # x pixels
+    image_cols = int(metadata_table["shape"][0, 1])  # y pixels
+
+    # get the fov ids and the rows of their images in the table
+    fov_index = metadata_fov_index(metadata_table)
 
     # max width and length across all fovs. channels will get expanded by these values
     # this important for later updates to the masks, which should be the same
@@ -676,23 +1855,20 @@ def make_masks(params, analyzed_imgs):
     max_chnl_mask_wid = 0
 
     # for each fov make a channel_mask dictionary from consensus mask
-    for fov in fovs:
-        # initialize a the dict and consensus mask
+    for fov, fov_rows in six.iteritems(fov_index):
+        # initialize a the dict and the channel rectangles of all images
         channel_masks_1fov = (
             {}
         )  # dict which holds channel masks {peak : [[y1, y2],[x1,x2]],...}
-        consensus_mask = np.zeros([image_rows, image_cols])  # mask for labeling
+        chnl_rects = []  # [y1, y2, x1, x2] for each channel in each image
 
-        # bring up information for each image
-        for img_k in analyzed_imgs.keys():
+        # bring up information for each image of the fov
+        for img_k in metadata_table["filename"][fov_rows].tolist():
             img_v = analyzed_imgs[img_k]
-            # skip this one if it is not of the current fov
-            if img_v["fov"] != fov:
+            # skip this one if channels were not found
+            if "channels" not in img_v:
                 continue
 
-            # for each channel in each image make a single mask
-            img_chnl_mask = np.zeros([image_rows, image_cols])
-
             # and add the channel mask to it
             for chnl_peak, peak_ends in six.iteritems(img_v["channels"]):
                 # pull out the peak location and top and bottom location
@@ -702,44 +1878,17 @@ def make_masks(params, analyzed_imgs):
                 y1 = max(peak_ends["closed_end_px"] - chan_lp, 0)
                 y2 = min(peak_ends["open_end_px"] + chan_lp, image_rows)
 
-                # add it to the mask for this image
-                img_chnl_mask[y1:y2, x1:x2] = 1
-
-            # add it to the consensus mask
-            consensus_mask += img_chnl_mask
-
-        # Normalize concensus mask between 0 and 1.
-        consensus_mask = consensus_mask.astype("float32") / float(
-            np.amax(consensus_mask)
-        )
-
-        # threshhold and homogenize each channel mask within the mask, label them
-        # label when value is above 0.1 (so 90% occupancy), transpose.
-        # the [0] is for the array ([1] is the number of regions)
-        # It transposes and then transposes again so regions are labeled left to right
-        # clear border it to make sure the channels are off the edge
-        consensus_mask = ndi.label(consensus_mask)[0]
-
-        # go through each label
-        for label in np.unique(consensus_mask):
-            if label == 0:  # label zero is the background
-                continue
-            binary_core = consensus_mask == label
-
-            # clean up the rough edges
-            poscols = np.any(binary_core, axis=0)  # column positions where true (any)
-            posrows = np.any(binary_core, axis=1)  # row positions where true (any)
+                # add it to the rectangles for this fov
+                chnl_rects.append([y1, y2, x1, x2])
 
+        # the consensus mask is the union of the channel rectangles of all images, each
+        # connected region of it is a channel. The regions are found from the rectangles
+        # directly, without drawing the mask
+        for min_row, max_row, min_col, max_col in channel_mask_regions(chnl_rects):
             # channel_id givin by horizontal position
             # this is important. later updates to the positions will have to check
             # if their channels contain this median value to match up
-            channel_id = int(np.median(np.where(poscols)[0]))
-
-            # store the edge locations of the channel mask in the dictionary. Will be ints
-            min_row = np.min(np.where(posrows)[0])
-            max_row = np.max(np.where(posrows)[0])
-            min_col = np.min(np.where(poscols)[0])
-            max_col = np.max(np.where(poscols)[0])
+            channel_id = int(np.median(np.arange(min_col, max_col + 1)))
 
             # if the min/max cols are within the image bounds,
             # add the mask, as 4 points, to the dictionary
@@ -828,158 +1977,306 @@ def load_channel_masks(params):
     return channel_masks
 
 
+def load_planning_tables(params):
+    """Loads the metadata table and channel masks Compile made, which the memory
+    planner (see _planner) estimates the memory of later steps from.
+
+    Returns
+    metadata_table : np.ndarray
+        see load_metadata_table. None if there is no metadata index.
+    channel_masks : dict
+        see load_channel_masks. None if there are no channel masks.
+
+    Called by
+    mm3_Subtract.subtract
+    mm3_Segment.segmentOTSU
+    """
+
+    if not os.path.exists(os.path.join(params["ana_dir"], "TIFF_metadata.db")):
+        return None, None
+    if not (
+        os.path.exists(os.path.join(params["ana_dir"], "channel_masks.yaml"))
+        or os.path.exists(os.path.join(params["ana_dir"], "channel_masks.pkl"))
+    ):
+        return None, None
+
+    return load_metadata_table(params), load_channel_masks(params)
+
+
 # make a lookup time table for converting nominal time to elapsed time in seconds
-def make_time_table(params, analyzed_imgs):
+def make_time_table(params, metadata_table, ts=None):
     """
-    Loops through the analyzed images and uses the jd time in the metadata to find the elapsed
-    time in seconds that each picture was taken. This is later used for more accurate elongation
-    rate calculation.
+    Uses the jd time in the metadata table to find the elapsed time in seconds that each
+    picture was taken. This is later used for more accurate elongation rate calculation.
 
     Parametrs
     ---------
-    analyzed_imgs : dict
-        The output of get_tif_params.
+    metadata_table : np.ndarray
+        The output of make_metadata_table.
+    ts : np.ndarray
+        time point each row is put at in the time table, metadata_table['t'] if None.
     params['use_jd'] : boolean
         If set to True, 'jd' time will be used from the image metadata to use to create time table. Otherwise the 't' index will be used, and the parameter 'seconds_per_time_index' will be used from the parameters.yaml file to convert to seconds.
 
     Returns
     -------
-    time_table : dict
-        Look up dictionary with keys for the FOV and then the time point.
+    time_table : TimeTable
+        Look up table with keys for the FOV and then the time point.
     """
     information("Making time table...")
 
-    # initialize
-    time_table = {}
-
-    first_time = float("inf")
-
-    # need to go through the data once to find the first time
-    for iname, idata in six.iteritems(analyzed_imgs):
-        if params["use_jd"]:
-            if idata["jd"] < first_time:
-                first_time = idata["jd"]
-        else:
-            if idata["t"] < first_time:
-                first_time = idata["t"]
-
-        # init dictionary for specific times per FOV
-        if idata["fov"] not in time_table:
-            time_table[idata["fov"]] = {}
-
-    for iname, idata in six.iteritems(analyzed_imgs):
-        if params["use_jd"]:
-            # convert jd time to elapsed time in seconds
-            t_in_seconds = np.around(
-                (idata["jd"] - first_time) * 24 * 60 * 60, decimals=0
-            ).astype("uint32")
-        else:
-            t_in_seconds = np.around(
-                (idata["t"] - first_time) * params["seconds_per_time_index"], decimals=0
-            ).astype("uint32")
+    # convert jd time to elapsed time in seconds
+    if params["use_jd"]:
+        times = metadata_table["jd"]
+        first_time = times.min() if len(times) > 0 else 0
+        elapsed = (times - first_time) * 24 * 60 * 60
+    else:
+        times = metadata_table["t"]
+        first_time = times.min() if len(times) > 0 else 0
+        elapsed = (times - first_time) * params["seconds_per_time_index"]
+    t_in_seconds = np.around(elapsed, decimals=0).astype("uint32")
 
-        time_table[int(idata["fov"])][int(idata["t"])] = int(t_in_seconds)
+    if ts is None:
+        ts = metadata_table["t"]
+    time_table = TimeTable.from_arrays(metadata_table["fov"], ts, t_in_seconds)
 
-    # save to .pkl. This pkl will be loaded into the params
-    # with open(os.path.join(params['ana_dir'], 'time_table.pkl'), 'wb') as time_table_file:
-    #     pickle.dump(time_table, time_table_file, protocol=pickle.HIGHEST_PROTOCOL)
-    # with open(os.path.join(params['ana_dir'], 'time_table.txt'), 'w') as time_table_file:
-    #     pprint(time_table, stream=time_table_file)
+    # save to .npz, which Track loads, and to .yaml for people to read
+    time_table.save(os.path.join(params["ana_dir"], "time_table.npz"))
     with open(
         os.path.join(params["ana_dir"], "time_table.yaml"), "w"
     ) as time_table_file:
         yaml.dump(
-            data=time_table, stream=time_table_file, default_flow_style=False, tags=None
+            data=time_table.to_dict(),
+            stream=time_table_file,
+            default_flow_style=False,
+            tags=None,
         )
     information("Time table saved.")
 
     return time_table
 
 
+def make_stack_time_table(params, stack_files):
+    """Makes the time table of the images in the channel stacks, with make_time_table.
+    The images of an FOV are put at consecutive time points from the first one, so
+    there is a time point for each frame of the stacks even if a time point was
+    skipped while watching.
+
+    Parameters
+    stack_files : dict
+        file names of the images in the stacks of each FOV, in stack order.
+
+    Called by
+    mm3_Compile.watch_tiff_dir
+    """
+
+    metadata_table = load_metadata_table(
+        params, [fn for fns in stack_files.values() for fn in fns]
+    )
+
+    # the rows are sorted by fov and t, which is the stack order
+    ts = metadata_table["t"].copy()
+    for fov_rows in metadata_fov_index(metadata_table).values():
+        ts[fov_rows] = ts[fov_rows][0] + np.arange(len(ts[fov_rows]))
+
+    return make_time_table(params, metadata_table, ts)
+
+
 # finds the location of channels in a tif
 def find_channel_locs(params, image_data):
     """Finds the location of channels from a phase contrast image. The channels are returned in
     a dictionary where the key is the x position of the channel in pixel and the value is a
     dicionary with the open and closed end in pixels in y.
 
+    This is find_channel_locs_stack for a single image.
 
     Called by
     mm3_Compile.get_tif_params
 
     """
 
+    return find_channel_locs_stack(params, np.expand_dims(image_data, 0))[0]
+
+
+# mexican hat wavelet, which is the template channels are matched against
+def ricker_wavelet(points, a):
+    """Returns a Ricker (Mexican hat) wavelet of length points and width parameter a.
+    This is the wavelet find_peaks_cwt uses by default.
+    """
+
+    amplitude = 2 / (np.sqrt(3 * a) * (np.pi ** 0.25))
+    x = np.arange(points) - (points - 1.0) / 2
+    return amplitude * (1 - (x / a) ** 2) * np.exp(-(x ** 2) / (2 * a ** 2))
+
+
+# finds channel peaks in the x projections of many images at once
+def find_channel_peaks(params, projections_x):
+    """Finds the x positions of channels in the x projections of a set of images.
+
+    All projections are filtered at once with a matched filter: they are convolved (by FFT)
+    with a Mexican hat the width of a channel, and local maxima of the response which are
+    the largest within half a channel separation and whose response is
+    params['compile']['channel_detection_snr'] times the noise level are kept.
+
+    Parameters
+    projections_x : np.ndarray
+        2D array (images, columns) of the image data summed along y.
+
+    Returns
+    peaks : list
+        list with a sorted array of channel x positions for each projection.
+
+    Called by
+    mm3_Compile.find_channel_locs_stack
+    """
+
     # declare temp variables from yaml parameter dict.
     chan_w = params["compile"]["channel_width"]
     chan_sep = params["compile"]["channel_separation"]
-    crop_wp = int(params["compile"]["channel_width_pad"] + chan_w / 2)
     chan_snr = params["compile"]["channel_detection_snr"]
 
+    projections_x = np.atleast_2d(projections_x).astype(np.float64)
+    n_cols = projections_x.shape[1]
+
+    # the template has zero mean, so the flat background gives no response
+    template_len = int(min(10 * chan_w, n_cols))
+    template = ricker_wavelet(template_len, chan_w / 2.0)
+
+    # pad with the edge values so the image border does not look like a channel
+    pad = template_len // 2
+    padded = np.pad(projections_x, ((0, 0), (pad, pad)), mode="edge")
+
+    # convolve all projections at once. The template is symmetric, so this is also
+    # the correlation with the template
+    n_fft = padded.shape[1] + template_len - 1
+    response = np.fft.irfft(
+        np.fft.rfft(padded, n_fft, axis=1) * np.fft.rfft(template, n_fft),
+        n_fft,
+        axis=1,
+    )
+    start = pad + (template_len - 1) // 2
+    response = response[:, start : start + n_cols]
+
+    # non-maximum suppression, channels are at least a separation apart
+    nms_size = 2 * max(int(chan_sep / 2), 1) + 1
+    local_max = ndi.maximum_filter1d(response, nms_size, axis=1, mode="nearest")
+
+    # the noise in each projection is estimated from the differences of neighbouring
+    # columns (robust to the channel edges), and carried through the filter
+    noise = np.median(np.abs(np.diff(projections_x, axis=1)), axis=1, keepdims=True)
+    noise = noise / (0.6745 * np.sqrt(2)) * np.linalg.norm(template)
+    noise = np.maximum(noise, np.finfo(np.float64).eps)
+
+    is_peak = (response == local_max) & (response > 0) & (response / noise >= chan_snr)
+
+    return [np.flatnonzero(frame_peaks) for frame_peaks in is_peak]
+
+
+# finds the location of channels in a stack of images
+def find_channel_locs_stack(params, image_stack):
+    """Finds the location of channels in each image of a stack of phase contrast images.
+    For each image the channels are returned in a dictionary where the key is the x position
+    of the channel in pixel and the value is a dicionary with the open and closed end in
+    pixels in y.
+
+    The channels of all images are found together with find_channel_peaks.
+
+    Parameters
+    image_stack : np.ndarray
+        3D array (images, y, x) of phase images which have had their orientation fixed.
+
+    Returns
+    chnl_loc_dicts : list
+        list of channel location dictionaries, one per image.
+
+    Called by
+    mm3_Compile.find_channel_locs
+    mm3_Compile.find_channel_locs_chunked
+    """
+
+    # declare temp variables from yaml parameter dict.
+    chan_w = params["compile"]["channel_width"]
+    chan_sep = params["compile"]["channel_separation"]
+    crop_wp = int(params["compile"]["channel_width_pad"] + chan_w / 2)
+
     # Detect peaks in the x projection (i.e. find the channels)
-    projection_x = image_data.sum(axis=0).astype(np.int32)
-    # find_peaks_cwt is a function which attempts to find the peaks in a 1-D array by
-    # convolving it with a wave. here the wave is the default Mexican hat wave
-    # but the minimum signal to noise ratio is specified
-    # *** The range here should be a parameter or changed to a fraction.
-    peaks = find_peaks_cwt(
-        projection_x, np.arange(chan_w - 5, chan_w + 5), min_snr=chan_snr
+    projections_x = np.stack(
+        [image_data.sum(axis=0, dtype=np.int64) for image_data in image_stack]
     )
+    all_peaks = find_channel_peaks(params, projections_x)
+
+    chnl_loc_dicts = []
+    for image_data, peaks in zip(image_stack, all_peaks):
+        # If the left-most peak position is within half of a channel separation,
+        # discard the channel from the list.
+        if len(peaks) and peaks[0] < (chan_sep / 2):
+            peaks = peaks[1:]
+        # If the diference between the right-most peak position and the right edge
+        # of the image is less than half of a channel separation, discard the channel.
+        if len(peaks) and image_data.shape[1] - peaks[-1] < (chan_sep / 2):
+            peaks = peaks[:-1]
+
+        # Find the average channel ends for the y-projected image
+        projection_y = image_data.sum(axis=1, dtype=np.int64)
+        # find derivative, must use int because it was unsigned 16b before.
+        proj_y_d = np.diff(projection_y)
+        # use the top third to look for closed end, is pixel location of highest deriv
+        onethirdpoint_y = int(projection_y.shape[0] / 3.0)
+        default_closed_end_px = int(proj_y_d[:onethirdpoint_y].argmax())
+        # use bottom third to look for open end, pixel location of lowest deriv
+        twothirdpoint_y = int(projection_y.shape[0] * 2.0 / 3.0)
+        default_open_end_px = int(twothirdpoint_y + proj_y_d[twothirdpoint_y:].argmin())
+        default_length = default_open_end_px - default_closed_end_px  # used for checks
+
+        # dict for channel dimensions
+        chnl_loc_dict = {}
+        # key is peak location, value is dict with {'closed_end_px': px, 'open_end_px': px}
+
+        if len(peaks) == 0:
+            chnl_loc_dicts.append(chnl_loc_dict)
+            continue
 
-    # If the left-most peak position is within half of a channel separation,
-    # discard the channel from the list.
-    if peaks[0] < (chan_sep / 2):
-        peaks = peaks[1:]
-    # If the diference between the right-most peak position and the right edge
-    # of the image is less than half of a channel separation, discard the channel.
-    if image_data.shape[1] - peaks[-1] < (chan_sep / 2):
-        peaks = peaks[:-1]
-
-    # Find the average channel ends for the y-projected image
-    projection_y = image_data.sum(axis=1)
-    # find derivative, must use int32 because it was unsigned 16b before.
-    proj_y_d = np.diff(projection_y.astype(np.int32))
-    # use the top third to look for closed end, is pixel location of highest deriv
-    onethirdpoint_y = int(projection_y.shape[0] / 3.0)
-    default_closed_end_px = proj_y_d[:onethirdpoint_y].argmax()
-    # use bottom third to look for open end, pixel location of lowest deriv
-    twothirdpoint_y = int(projection_y.shape[0] * 2.0 / 3.0)
-    default_open_end_px = twothirdpoint_y + proj_y_d[twothirdpoint_y:].argmin()
-    default_length = default_open_end_px - default_closed_end_px  # used for checks
-
-    # go through peaks and assign information
-    # dict for channel dimensions
-    chnl_loc_dict = {}
-    # key is peak location, value is dict with {'closed_end_px': px, 'open_end_px': px}
-
-    for peak in peaks:
-        # set defaults
-        chnl_loc_dict[peak] = {
-            "closed_end_px": default_closed_end_px,
-            "open_end_px": default_open_end_px,
-        }
-        # redo the previous y projection finding with just this channel
-        channel_slice = image_data[:, peak - crop_wp : peak + crop_wp]
-        slice_projection_y = channel_slice.sum(axis=1)
-        slice_proj_y_d = np.diff(slice_projection_y.astype(np.int32))
-        slice_closed_end_px = slice_proj_y_d[:onethirdpoint_y].argmax()
-        slice_open_end_px = twothirdpoint_y + slice_proj_y_d[twothirdpoint_y:].argmin()
+        # redo the previous y projection finding with just each channel. The column
+        # sums of all channel slices come from one cumulative sum across x
+        cum_x = np.zeros((image_data.shape[0], image_data.shape[1] + 1), dtype=np.int64)
+        np.cumsum(image_data, axis=1, out=cum_x[:, 1:])
+        x1 = np.clip(peaks - crop_wp, 0, image_data.shape[1])
+        x2 = np.clip(peaks + crop_wp, 0, image_data.shape[1])
+        slice_projections_y = cum_x[:, x2] - cum_x[:, x1]  # (y, peaks)
+        slice_proj_y_d = np.diff(slice_projections_y, axis=0)
+        slice_closed_end_px = slice_proj_y_d[:onethirdpoint_y].argmax(axis=0)
+        slice_open_end_px = (
+            twothirdpoint_y + slice_proj_y_d[twothirdpoint_y:].argmin(axis=0)
+        )
         slice_length = slice_open_end_px - slice_closed_end_px
 
         # check if these values make sense. If so, use them. If not, use default
         # make sure lenght is not 30 pixels bigger or smaller than default
         # *** This 15 should probably be a parameter or at least changed to a fraction.
-        if slice_length + 15 < default_length or slice_length - 15 > default_length:
-            continue
         # make sure ends are greater than 15 pixels from image edge
-        if slice_closed_end_px < 15 or slice_open_end_px > image_data.shape[0] - 15:
-            continue
+        use_slice = (
+            (slice_length + 15 >= default_length)
+            & (slice_length - 15 <= default_length)
+            & (slice_closed_end_px >= 15)
+            & (slice_open_end_px <= image_data.shape[0] - 15)
+        )
 
-        # if you made it to this point then update the entry
-        chnl_loc_dict[peak] = {
-            "closed_end_px": slice_closed_end_px,
-            "open_end_px": slice_open_end_px,
-        }
+        # go through peaks and assign information
+        for i, peak in enumerate(peaks):
+            if use_slice[i]:
+                chnl_loc_dict[int(peak)] = {
+                    "closed_end_px": int(slice_closed_end_px[i]),
+                    "open_end_px": int(slice_open_end_px[i]),
+                }
+            else:
+                chnl_loc_dict[int(peak)] = {
+                    "closed_end_px": default_closed_end_px,
+                    "open_end_px": default_open_end_px,
+                }
+
+        chnl_loc_dicts.append(chnl_loc_dict)
 
-    return chnl_loc_dict
+    return chnl_loc_dicts
 
 
 # define function for flipping the images on an FOV by FOV basis
@@ -1036,6 +2333,277 @@ def fix_orientation(params, image_data):
     return image_data
 
 
+### Watching the image directory during an acquisition ###
+def watch_tiff_dir(
+    params, metadata_table, channel_masks, user_spec_fovs=(), t_start=None, t_end=None
+):
+    """Watches the image directory for new TIFFs after Compile, while the microscope is
+    still acquiring, and adds them to the channel stacks as they come. Each poll the
+    new images are analyzed for their metadata, sliced with the channel masks already
+    made and appended to the stacks (see append_stack_frames), and the metadata index,
+    drift and time table are extended. Later steps can be run on the stacks so far.
+
+    Polls every params['compile']['watch_interval'] seconds, and stops once no new
+    image has come for params['compile']['watch_timeout'] seconds, or with Ctrl-C.
+    As it blocks until then, watching is only done when compile is run from a script
+    (params['compile']['watch']), not from the Compile widget.
+
+    The stacks have one frame per time point, so only the time points following the
+    last one in the stacks of an FOV are added. Images which come before a missing
+    time point are held until it comes, or until it has been missing for
+    params['compile']['watch_gap_timeout'] seconds, after which it is skipped.
+    Images of a time point before the last one in the stacks are left out, as they
+    can not be put in the stacks in order. The time table is made from the images in
+    the stacks, keyed by their position in the stacks. Only HDF5 and Zarr stacks can
+    be added to, so nothing is watched with TIFF output.
+
+    Parameters
+    metadata_table : np.ndarray
+        metadata of the images Compile sliced, see make_metadata_table.
+    channel_masks : dict
+        the channel masks Compile made, see make_masks.
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    p = params
+
+    interval = 30.0
+    if "watch_interval" in p["compile"]:
+        interval = float(p["compile"]["watch_interval"])
+    timeout = 3600.0
+    if "watch_timeout" in p["compile"]:
+        timeout = float(p["compile"]["watch_timeout"])
+    gap_timeout = 300.0
+    if "watch_gap_timeout" in p["compile"]:
+        gap_timeout = float(p["compile"]["watch_gap_timeout"])
+    # files changed more recently may still be being written
+    settle = 5.0
+
+    if p["output"] == "TIFF":
+        warning(
+            "TIFF channel stacks can not be added to, use HDF5 or Zarr output to "
+            "watch for new images."
+        )
+        return
+
+    # the last time point in the stacks and the first image of each fov
+    fov_index = metadata_fov_index(metadata_table)
+    watch_fovs = [
+        fov_id
+        for fov_id in sorted(channel_masks.keys())
+        if fov_id in fov_index and (not user_spec_fovs or fov_id in user_spec_fovs)
+    ]
+    last_ts = {
+        fov_id: int(metadata_table["t"][fov_index[fov_id]].max())
+        for fov_id in watch_fovs
+    }
+    first_imgs, _ = load_metadata_index(
+        params,
+        [
+            str(metadata_table["filename"][fov_index[fov_id]][0])
+            for fov_id in watch_fovs
+        ],
+    )
+    first_imgs = {img_v["fov"]: img_v for img_v in first_imgs.values()}
+    fov_drifts = load_drift(params)
+
+    # the images in the stacks of each fov, in stack order, which the time table is
+    # made from, and the images held until the time points before them come
+    stack_files = {
+        fov_id: metadata_table["filename"][fov_rows].tolist()
+        for fov_id, fov_rows in six.iteritems(fov_index)
+    }
+    held_imgs = {fov_id: {} for fov_id in watch_fovs}
+    gap_starts = {}  # when each fov started waiting for a missing time point
+
+    seen_files = set(metadata_table["filename"].tolist())
+    failed_stamps = {}  # files which could not be analyzed are tried once they change
+
+    run_timer = start_run(params, "watch")
+    graph = TaskGraph(plan_workers(params), params)
+
+    information(
+        "Watching %s for new images every %.0f s. Stop with Ctrl-C."
+        % (p["TIFF_dir"], interval)
+    )
+
+    n_poll = 0
+    last_new_time = time.time()
+    try:
+        while time.time() - last_new_time < timeout:
+            n_poll += 1
+
+            # scanned every poll, the directory time may not show the newest files
+            catalog = load_catalog(p["TIFF_dir"], p["ana_dir"], rescan=True)
+            found_files = catalog.query(
+                fovs=user_spec_fovs, t_start=t_start, t_end=t_end
+            )
+            new_files = [fn for fn in found_files if fn not in seen_files]
+            file_stamps = get_file_stamps(params, new_files)
+            new_files = [
+                fn
+                for fn in new_files
+                if time.time() - file_stamps[fn][1] / 1e9 > settle
+                and failed_stamps.get(fn) != file_stamps[fn]
+            ]
+
+            # held images are looked at again, for the gap timeout
+            if not new_files and not any(held_imgs.values()):
+                time.sleep(interval)
+                continue
+            if new_files:
+                last_new_time = time.time()
+
+            # analyze the new images
+            for fn in new_files:
+                graph.add(
+                    ("metadata", fn, n_poll),
+                    get_tif_params,
+                    args=(params, fn, False),
+                    labels={"file": fn},
+                )
+            graph.run()
+
+            new_imgs = {}
+            for fn in new_files:
+                new_imgs[fn] = graph.results.pop(("metadata", fn, n_poll), False)
+                if not new_imgs[fn] or "fov" not in new_imgs[fn]:
+                    failed_stamps[fn] = file_stamps[fn]
+                else:
+                    seen_files.add(fn)
+                    failed_stamps.pop(fn, None)
+            update_metadata_index(params, new_imgs, file_stamps)
+
+            # hold the new images of each fov until they can go onto its stacks
+            late_images = {}
+            for fn, img_v in six.iteritems(new_imgs):
+                if not img_v or img_v.get("fov") not in last_ts:
+                    continue
+                if img_v["t"] <= last_ts[img_v["fov"]]:
+                    late_images[img_v["fov"]] = late_images.get(img_v["fov"], 0) + 1
+                else:
+                    held_imgs[img_v["fov"]][img_v["t"]] = (fn, img_v, file_stamps[fn])
+            for fov_id, n_late in six.iteritems(late_images):
+                warning(
+                    "Leaving out %d images of FOV %d which came after later time "
+                    "points were added." % (n_late, fov_id)
+                )
+
+            # slice the images following the last time point of each fov onto the end
+            # of its stacks
+            fov_appends = {}
+            for fov_id in watch_fovs:
+                if not held_imgs[fov_id]:
+                    gap_starts.pop(fov_id, None)
+                    continue
+
+                next_t = last_ts[fov_id] + 1
+                if next_t not in held_imgs[fov_id]:
+                    gap_starts.setdefault(fov_id, time.time())
+                    if time.time() - gap_starts[fov_id] < gap_timeout:
+                        continue
+                    warning(
+                        "Time points %d to %d of FOV %d did not come in %.0f s, going "
+                        "on without them."
+                        % (
+                            next_t,
+                            min(held_imgs[fov_id]) - 1,
+                            fov_id,
+                            gap_timeout,
+                        )
+                    )
+                    next_t = min(held_imgs[fov_id])
+                gap_starts.pop(fov_id, None)
+
+                send_to_write = []
+                while next_t in held_imgs[fov_id]:
+                    fn, img_v, file_stamps[fn] = held_imgs[fov_id].pop(next_t)
+                    new_imgs[fn] = img_v
+                    send_to_write.append([fn, next_t])
+                    next_t += 1
+
+                fov_appends[fov_id] = send_to_write
+                graph.add(
+                    ("appending", fov_id, n_poll),
+                    append_stack_frames,
+                    args=(
+                        params,
+                        send_to_write,
+                        {fov_id: channel_masks[fov_id]},
+                        {image[0]: new_imgs[image[0]] for image in send_to_write},
+                        first_imgs.get(fov_id),
+                    ),
+                    labels={"fov": fov_id},
+                )
+            graph.run()
+
+            appended_fovs = {}
+            for fov_id, send_to_write in six.iteritems(fov_appends):
+                if ("appending", fov_id, n_poll) in graph.failed:
+                    warning("Failed adding new images to FOV %d" % fov_id)
+                    continue
+                if ("appending", fov_id, n_poll) not in graph.results:
+                    continue
+                new_drift = graph.results.pop(("appending", fov_id, n_poll))
+                last_ts[fov_id] = send_to_write[-1][1]
+                stack_files[fov_id].extend(image[0] for image in send_to_write)
+                appended_fovs[fov_id] = send_to_write
+                if new_drift is not None and fov_id in fov_drifts:
+                    fov_drifts[fov_id] = np.concatenate([fov_drifts[fov_id], new_drift])
+
+            if appended_fovs:
+                new_drifts = {
+                    fov_id: fov_drifts[fov_id]
+                    for fov_id in appended_fovs
+                    if fov_id in fov_drifts
+                }
+                if new_drifts:
+                    save_drift(params, new_drifts)
+                if p["compile"]["do_time_table"]:
+                    make_stack_time_table(params, stack_files)
+
+                # how long the images waited to be added, from when they were written
+                latencies = [
+                    time.time() - file_stamps[image[0]][1] / 1e9
+                    for send_to_write in appended_fovs.values()
+                    for image in send_to_write
+                ]
+                run_timer.counts.update(
+                    frames=len(latencies), polls=1, fovs=len(appended_fovs)
+                )
+                information(
+                    "Added %d images to %d FOVs, %.1f s to %.1f s after they were "
+                    "written."
+                    % (
+                        len(latencies),
+                        len(appended_fovs),
+                        min(latencies),
+                        max(latencies),
+                    )
+                )
+
+            time.sleep(interval)
+
+        information("No new images for %.0f s, stopped watching." % timeout)
+        n_held = sum(len(fov_held) for fov_held in held_imgs.values())
+        if n_held:
+            warning(
+                "%d images were not added, as time points before them did not come."
+                % n_held
+            )
+
+    except KeyboardInterrupt:
+        information("Stopped watching.")
+
+    finally:
+        graph.close()
+        run_timer.stop()
+
+    print_run_summary(params)
+
+
 def compile(params):
     """mm3_Compile.py locates and slices out mother machine channels into image stacks."""
 
@@ -1079,236 +2647,385 @@ def compile(params):
     elif p["output"] == "HDF5":
         if not os.path.exists(p["hdf5_dir"]):
             os.makedirs(p["hdf5_dir"])
+    elif p["output"] == "Zarr":
+        if not os.path.exists(p["zarr_dir"]):
+            os.makedirs(p["zarr_dir"])
+    # later steps read the stacks in the format they are sliced in
+    if p["compile"]["do_slicing"]:
+        save_output_format(params)
+
+    # time each stage of the run, see _report
+    run_timer = start_run(params, "compile")
+
+    # fused compiling reads each raw image only once, see read_fov_frames
+    fused = False
+    if "fused" in p["compile"]:
+        fused = p["compile"]["fused"]
+    if fused and not (
+        p["compile"]["do_metadata"]
+        and p["compile"]["do_channel_masks"]
+        and p["compile"]["do_slicing"]
+    ):
+        warning(
+            "Fused compiling needs metadata, channel masks and slicing to be done. "
+            "Images will be read separately for each step."
+        )
+        fused = False
+    n_frames = None
+    if "channel_detection_frames" in p["compile"]:
+        n_frames = p["compile"]["channel_detection_frames"]
+    if fused and (n_frames is None or n_frames == "None"):
+        warning(
+            "Fused compiling needs channel_detection_frames to be set, otherwise all "
+            "images would be kept until the channel masks are made. "
+            "Images will be read separately for each step."
+        )
+        fused = False
+    fov_files = {}  # files of each fov read by fused compiling
+    spill_rows = {}  # (spill path, row) of the images read by fused compiling
+
+    # all the parallel work of compile is run on one pool. Tasks of later stages
+    # start as soon as the tasks they need are done. Only as many workers as fit in
+    # the memory budget are started, see _planner
+    n_workers = plan_workers(params)
+    if n_workers < p["num_analyzers"]:
+        information("Using %d workers to stay within the memory budget." % n_workers)
+    graph = TaskGraph(n_workers, params)
 
-    # declare information variables
-    analyzed_imgs = {}  # for storing get_params pool results.
+    try:
+        # declare information variables
+        analyzed_imgs = {}  # for storing get_params pool results.
 
-    ### process TIFFs for metadata #################################################################
-    if not p["compile"]["do_metadata"]:
-        information("Loading image parameters dictionary.")
+        ### process TIFFs for metadata #################################################################
+        if not p["compile"]["do_metadata"]:
+            information("Loading image parameters dictionary.")
 
-        with open(
-            os.path.join(p["ana_dir"], "TIFF_metadata.pkl"), "rb"
-        ) as tiff_metadata:
-            analyzed_imgs = pickle.load(tiff_metadata)
+            if os.path.exists(os.path.join(p["ana_dir"], "TIFF_metadata.db")):
+                analyzed_imgs, _ = load_metadata_index(params)
+            else:
+                # analyses from before the metadata index was used
+                with open(
+                    os.path.join(p["ana_dir"], "TIFF_metadata.pkl"), "rb"
+                ) as tiff_metadata:
+                    analyzed_imgs = pickle.load(tiff_metadata)
 
-    else:
-        information("Finding image parameters.")
-
-        # get all the TIFFs in the folder
-        found_files = glob.glob(os.path.join(p["TIFF_dir"], "*.tif"))  # get all tiffs
-        found_files = [
-            filepath.split("/")[-1] for filepath in found_files
-        ]  # remove pre-path
-        found_files = sorted(found_files)  # should sort by timepoint
-
-        # keep images starting at this timepoint
-        if t_start is not None:
-            information("Removing images before time {}".format(t_start))
-            # go through list and find first place where timepoint is equivalent to t_start
-            for n, ifile in enumerate(found_files):
-                string = re.compile(
-                    "t{:0=3}xy|t{:0=4}xy".format(t_start, t_start)
-                )  # account for 3 and 4 digit
-                # if re.search == True then a match was found
-                if re.search(string, ifile):
-                    # cut off every file name prior to this one and quit the loop
-                    found_files = found_files[n:]
-                    break
-
-        # remove images after this timepoint
-        if t_end is not None:
-            information("Removing images after time {}".format(t_end))
-            # go through list and find first place where timepoint is equivalent to t_end
-            for n, ifile in enumerate(found_files):
-                string = re.compile(
-                    "t%03dxy|t%04dxy" % (t_end, t_end)
-                )  # account for 3 and 4 digit
-                if re.search(string, ifile):
-                    found_files = found_files[:n]
-                    break
-
-        # if user has specified only certain FOVs, filter for those
-        if len(user_spec_fovs) > 0:
-            information("Filtering TIFFs by FOV.")
-            fitered_files = []
-            for fov_id in user_spec_fovs:
-                fov_string = "xy%02d" % fov_id  # xy01
-                fitered_files += [ifile for ifile in found_files if fov_string in ifile]
-
-            found_files = fitered_files[:]
-
-        # get information for all these starting tiffs
-        if len(found_files) > 0:
-            information("Found %d image files." % len(found_files))
         else:
-            warning("No TIFF files found")
+            information("Finding image parameters.")
+
+            # get the TIFFs in the folder from the catalog, which is only scanned again
+            # if files were added or removed since
+            catalog = load_catalog(p["TIFF_dir"], p["ana_dir"])
 
-        # initialize pool for analyzing image metadata
-        pool = Pool(p["num_analyzers"])
+            # keep images from t_start to t_end
+            if t_start is not None:
+                information("Removing images before time {}".format(t_start))
+            if t_end is not None:
+                information("Removing images after time {}".format(t_end))
 
-        # loop over images and get information
-        for fn in found_files:
-            # get_params gets the image metadata and puts it in analyzed_imgs dictionary
-            # for each file name. True means look for channels
+            # if user has specified only certain FOVs, filter for those
+            if len(user_spec_fovs) > 0:
+                information("Filtering TIFFs by FOV.")
 
-            # This is the non-parallelized version (useful for debug)
-            # analyzed_imgs[fn] = get_tif_params(fn, True)
+            found_files = catalog.query(
+                fovs=user_spec_fovs, t_start=t_start, t_end=t_end
+            )
+
+            # get information for all these starting tiffs
+            if len(found_files) > 0:
+                information("Found %d image files." % len(found_files))
+            else:
+                warning("No TIFF files found")
 
-            # Parallelized
-            analyzed_imgs[fn] = pool.apply_async(
-                get_tif_params, args=(params, fn, True)
+            # only analyze files which are new or have changed since they were indexed
+            file_stamps = get_file_stamps(params, found_files)
+            analyzed_imgs, index_stamps = load_metadata_index(params, found_files)
+            files_to_analyze = [
+                fn for fn in found_files if index_stamps.get(fn) != file_stamps[fn]
+            ]
+            information(
+                "%d image files already indexed, analyzing %d new or changed files."
+                % (len(found_files) - len(files_to_analyze), len(files_to_analyze))
             )
 
-        information("Waiting for image analysis pool to be finished.")
+            new_imgs = {}  # for storing get_params results.
+            fused_imgs = {}  # image information with channels from fused compiling
+
+            if fused:
+                # channels are found along with the metadata, on all images of an fov
+                for fov_id in catalog.fov_ids():
+                    if len(user_spec_fovs) > 0 and fov_id not in user_spec_fovs:
+                        continue
+                    fns = catalog.query(fovs=[fov_id], t_start=t_start, t_end=t_end)
+                    if fns:
+                        fov_files[fov_id] = fns
+
+                # read the metadata and the detection images of each fov in one task,
+                # see read_fov_frames. Indexed images are only read if they changed
+                analyze_set = set(files_to_analyze)
+                for fov_id, fns in six.iteritems(fov_files):
+                    indexed_imgs = {
+                        fn: analyzed_imgs[fn]
+                        for fn in fns
+                        if fn in analyzed_imgs and fn not in analyze_set
+                    }
+                    graph.add(
+                        ("reading", fov_id),
+                        read_fov_frames,
+                        args=(params, fov_id, fns, indexed_imgs),
+                        labels={"fov": fov_id},
+                    )
+
+            else:
+                # loop over images and get information
+                for fn in files_to_analyze:
+                    # get_params gets the image metadata and puts it in new_imgs dictionary
+                    # for each file name. False means only the TIFF tags are read, channels
+                    # are found later on a subset of images
+
+                    # This is the non-parallelized version (useful for debug)
+                    # new_imgs[fn] = get_tif_params(fn, False)
+
+                    # Parallelized
+                    graph.add(
+                        ("metadata", fn),
+                        get_tif_params,
+                        args=(params, fn, False),
+                        labels={"file": fn},
+                    )
+
+            information("Waiting for image analysis to be finished.")
+
+            graph.run()
 
-        pool.close()  # tells the process nothing more will be added.
-        pool.join()  # blocks script until everything has been processed and workers exit
+            information("Image analysis finished, getting results.")
 
-        information("Image analysis pool finished, getting results.")
+            # get results and put them in a dictionary
+            if fused:
+                for fov_id, fns in six.iteritems(fov_files):
+                    if ("reading", fov_id) in graph.results:
+                        fov_imgs, fov_rows = graph.results.pop(("reading", fov_id))
+                        fused_imgs.update(fov_imgs)
+                        new_imgs.update(
+                            {fn: fov_imgs[fn] for fn in fns if fn in analyze_set}
+                        )
+                        for fn, row in six.iteritems(fov_rows):
+                            spill_rows[fn] = (fused_spill_path(params, fov_id), row)
+                    else:
+                        warning("Failed reading FOV %d" % fov_id)
+                        new_imgs.update({fn: False for fn in fns if fn in analyze_set})
 
-        # get results from the pool and put them in a dictionary
-        for fn in analyzed_imgs.keys():
-            result = analyzed_imgs[fn]
-            if result.successful():
-                analyzed_imgs[
-                    fn
-                ] = result.get()  # put the metadata in the dict if it's good
             else:
-                analyzed_imgs[fn] = False  # put a false there if it's bad
+                for fn in files_to_analyze:
+                    if ("metadata", fn) in graph.results:
+                        # put the metadata in the dict if it's good
+                        new_imgs[fn] = graph.results.pop(("metadata", fn))
+                    else:
+                        new_imgs[fn] = False  # put a false there if it's bad
 
-        # save metadata to a .pkl and a human readable txt file
-        information("Saving metadata from analyzed images...")
-        with open(
-            os.path.join(p["ana_dir"], "TIFF_metadata.pkl"), "wb"
-        ) as tiff_metadata:
-            pickle.dump(analyzed_imgs, tiff_metadata, protocol=pickle.HIGHEST_PROTOCOL)
-        with open(
-            os.path.join(p["ana_dir"], "TIFF_metadata.txt"), "w"
-        ) as tiff_metadata:
-            pprint(analyzed_imgs, stream=tiff_metadata)
-        information("Saved metadata from analyzed images.")
-
-    ### Make table for jd time to FOV and time point
-    if not p["compile"]["do_time_table"]:
-        information("Skipping time table creation.")
-    else:
-        time_table = make_time_table(params, analyzed_imgs)
+            # merge the new results into the index
+            information("Saving metadata from analyzed images...")
+            with stage_timer(params, "metadata_index"):
+                update_metadata_index(params, new_imgs, file_stamps)
+            information("Saved metadata from analyzed images.")
 
-    ### Make consensus channel masks and get other shared metadata #################################
-    if not p["compile"]["do_channel_masks"] and p["compile"]["do_slicing"]:
-        channel_masks = load_channel_masks(params)
+            # keep the images in file order
+            analyzed_imgs.update(new_imgs)
+            analyzed_imgs.update(fused_imgs)
+            analyzed_imgs = {fn: analyzed_imgs[fn] for fn in found_files}
 
-    elif p["compile"]["do_channel_masks"]:
+        # the metadata as a table with the images of each fov together
+        metadata_table = make_metadata_table(analyzed_imgs)
 
-        # only calculate channels masks from images before t_end in case it is specified
-        if t_start:
-            analyzed_imgs = {
-                fn: i_metadata
-                for fn, i_metadata in six.iteritems(analyzed_imgs)
-                if i_metadata["t"] >= t_start
-            }
-        if t_end:
-            analyzed_imgs = {
-                fn: i_metadata
-                for fn, i_metadata in six.iteritems(analyzed_imgs)
-                if i_metadata["t"] <= t_end
-            }
+        ### Make table for jd time to FOV and time point
+        if not p["compile"]["do_time_table"]:
+            information("Skipping time table creation.")
+        else:
+            with stage_timer(params, "time_table"):
+                time_table = make_time_table(params, metadata_table)
 
-        # Uses channelinformation from the already processed image data
-        channel_masks = make_masks(params, analyzed_imgs)
+        ### Make consensus channel masks and get other shared metadata #################################
+        if not p["compile"]["do_channel_masks"] and p["compile"]["do_slicing"]:
+            channel_masks = load_channel_masks(params)
 
-    ### Slice and write TIFF files into channels ###################################################
-    if p["compile"]["do_slicing"]:
+        elif p["compile"]["do_channel_masks"]:
+
+            # only calculate channels masks from images before t_end in case it is specified
+            if t_start:
+                metadata_table = metadata_table[metadata_table["t"] >= t_start]
+            if t_end:
+                metadata_table = metadata_table[metadata_table["t"] <= t_end]
+            analyzed_imgs = {
+                fn: analyzed_imgs[fn] for fn in metadata_table["filename"].tolist()
+            }
 
-        information("Saving channel slices.")
+            # find channels in a sample of the images of each fov
+            analyzed_imgs = find_image_channels(params, analyzed_imgs, graph)
 
-        # do it by FOV. Not set up for multiprocessing
-        for fov, peaks in six.iteritems(channel_masks):
+            # Uses channelinformation from the already processed image data
+            with stage_timer(params, "channel_masks"):
+                channel_masks = make_masks(params, analyzed_imgs, metadata_table)
 
-            # skip fov if not in the group
-            if user_spec_fovs and fov not in user_spec_fovs:
-                continue
+        ### Slice and write TIFF files into channels ###################################################
+        if p["compile"]["do_slicing"]:
 
-            information("Loading images for FOV %03d." % fov)
+            information("Saving channel slices.")
 
-            # get filenames just for this fov along with the julian date of acquistion
-            send_to_write = [
-                [k, v["t"]] for k, v in six.iteritems(analyzed_imgs) if v["fov"] == fov
+            slice_fovs = [
+                fov
+                for fov in channel_masks.keys()
+                if not user_spec_fovs or fov in user_spec_fovs
             ]
 
-            # sort the filenames by jdn
-            send_to_write = sorted(send_to_write, key=lambda time: time[1])
+            # do it by FOV, with as many FOVs at once and as many frames at a time as
+            # there is memory for
+            slicing_plan = plan_slicing(
+                params, metadata_table, channel_masks, slice_fovs, n_workers
+            )
+            print_plan("Slicing", slicing_plan)
+            p["compile"]["slice_window"] = slicing_plan["window"]
+            information("Slicing %d FOVs at a time." % slicing_plan["processes"])
+            graph.set_group_limit("slicing", slicing_plan["processes"])
 
             if p["output"] == "TIFF":
-                # This is for loading the whole raw tiff stack and then slicing through it
-                tiff_stack_slice_and_write(
-                    params, send_to_write, channel_masks, analyzed_imgs
-                )
-
+                # This is for loading the raw tiff stack and then slicing through it
+                slice_and_write = tiff_stack_slice_and_write
             elif p["output"] == "HDF5":
                 # Or write it to hdf5
-                hdf5_stack_slice_and_write(
-                    params, send_to_write, channel_masks, analyzed_imgs
-                )
-
-        information("Channel slices saved.")
-
-    ### Cross correlations ########################################################################
-    if p["compile"]["do_crosscorrs"]:
-        # a nested dict to hold cross corrs per channel per fov.
-        crosscorrs = {}
+                slice_and_write = hdf5_stack_slice_and_write
+            elif p["output"] == "Zarr":
+                # Or write it to a zarr store
+                slice_and_write = zarr_stack_slice_and_write
+
+            fov_index = metadata_fov_index(metadata_table)
+            for fov in slice_fovs:
+                if fov not in fov_index:
+                    warning("No images for FOV %d." % fov)
+                    continue
+
+                # only send the information for this fov to the worker
+                fov_filenames = metadata_table["filename"][fov_index[fov]].tolist()
+                fov_imgs = {k: analyzed_imgs[k] for k in fov_filenames}
+                if fused:
+                    # slice from the images read with the metadata
+                    fov_imgs = {
+                        k: dict(v, spill=spill_rows[k]) if k in spill_rows else v
+                        for k, v in six.iteritems(fov_imgs)
+                    }
+                fov_masks = {fov: channel_masks[fov]}
+
+                # get filenames just for this fov along with the time point, the table
+                # is sorted by time
+                send_to_write = [
+                    [k, t]
+                    for k, t in zip(
+                        fov_filenames, metadata_table["t"][fov_index[fov]].tolist()
+                    )
+                ]
 
-        # for each fov find cross correlations (sending to pull)
-        for fov_id in user_spec_fovs:
-            information("Calculating cross correlations for FOV %d." % fov_id)
+                # the slicers return the images used for cross correlations
+                graph.add(
+                    ("slicing", fov),
+                    slice_and_write,
+                    args=(params, send_to_write, fov_masks, fov_imgs),
+                    group="slicing",
+                    labels={"fov": fov},
+                )
 
-            # nested dict keys are peak_ids and values are cross correlations
-            crosscorrs[fov_id] = {}
+        ### Cross correlations ########################################################################
+        if p["compile"]["do_crosscorrs"]:
+            # a nested dict to hold cross corrs per channel per fov.
+            crosscorrs = {}
 
-            # initialize pool for analyzing image metadata
-            pool = Pool(p["num_analyzers"])
+            # find cross correlations for the channels of each fov
+            xcorr_fovs = [
+                fov_id
+                for fov_id in sorted(channel_masks.keys())
+                if not user_spec_fovs or fov_id in user_spec_fovs
+            ]
 
-            # find all peak ids in the current FOV
-            for peak_id in sorted(channel_masks[fov_id].keys()):
-                information("Calculating cross correlations for peak %d." % peak_id)
+            # drift of the fovs which are not sliced now, from an earlier run
+            saved_drifts = load_drift(params)
 
+            for fov_id in xcorr_fovs:
                 # linear loop
-                # crosscorrs[fov_id][peak_id] = channel_xcorr(fov_id, peak_id)
+                # crosscorrs[fov_id] = channel_xcorr_fov(params, fov_id, peak_ids)
+
+                # all peaks of the fov are done together, as soon as the fov is sliced
+                # using the images the slicer kept
+                if ("slicing", fov_id) in graph:
+                    xcorr_deps = [("slicing", fov_id)]
+                    fov_samples = graph.output(("slicing", fov_id), 0)
+                    fov_drift = graph.output(("slicing", fov_id), 1)
+                else:
+                    xcorr_deps = []
+                    fov_samples = None
+                    fov_drift = saved_drifts.get(fov_id)
 
-                # multiprocessing verion
-                crosscorrs[fov_id][peak_id] = pool.apply_async(
-                    channel_xcorr,
+                graph.add(
+                    ("xcorr", fov_id),
+                    channel_xcorr_fov,
                     args=(
                         params,
                         fov_id,
-                        peak_id,
+                        sorted(channel_masks[fov_id].keys()),
+                        fov_samples,
+                        fov_drift,
                     ),
+                    deps=xcorr_deps,
+                    labels={"fov": fov_id},
                 )
 
-            information(
-                "Waiting for cross correlation pool to finish for FOV %d." % fov_id
-            )
+        ### Run slicing and cross correlations ########################################################
+        information("Waiting for slicing and cross correlations to finish.")
+        graph.run()
+    finally:
+        graph.close()
+
+        # the spilled images are not needed once they are sliced
+        if fused:
+            for fov_id in fov_files.keys():
+                if os.path.exists(fused_spill_path(params, fov_id)):
+                    os.remove(fused_spill_path(params, fov_id))
+            spill_dir = os.path.join(p["ana_dir"], "fused_spill")
+            if os.path.isdir(spill_dir) and not os.listdir(spill_dir):
+                os.rmdir(spill_dir)
 
-            pool.close()  # tells the process nothing more will be added.
-            pool.join()  # blocks script until everything has been processed and workers exit
+    if p["compile"]["do_slicing"]:
+        fov_drifts = {}
+        for fov in slice_fovs:
+            if ("slicing", fov) in graph.failed:
+                warning("Failed slicing FOV %d" % fov)
+            elif ("slicing", fov) in graph.results:
+                if graph.results[("slicing", fov)][1] is not None:
+                    fov_drifts[fov] = graph.results[("slicing", fov)][1]
 
-            information("Finished cross correlations for FOV %d." % fov_id)
+        if fov_drifts:
+            save_drift(params, fov_drifts)
 
-        # get results from the pool and put the results in the dictionary if succesful
-        for fov_id, peaks in six.iteritems(crosscorrs):
-            for peak_id, result in six.iteritems(peaks):
-                if result.successful():
-                    # put the results, with the average, and a guess if the channel
-                    # is full into the dictionary
-                    crosscorrs[fov_id][peak_id] = {
-                        "ccs": result.get(),
-                        "cc_avg": np.average(result.get()),
-                        "full": np.average(result.get())
-                        < p["compile"]["channel_picking_threshold"],
-                    }
-                else:
-                    crosscorrs[fov_id][peak_id] = False  # put a false there if it's bad
+        information("Channel slices saved.")
+
+    if p["compile"]["do_crosscorrs"]:
+        information("Finished cross correlations.")
+
+        # get results and put the results in the dictionary if succesful
+        for fov_id in xcorr_fovs:
+            if ("xcorr", fov_id) not in graph.results:
+                warning("Failed cross correlations for FOV %d" % fov_id)
+                crosscorrs[fov_id] = {
+                    peak_id: False for peak_id in sorted(channel_masks[fov_id].keys())
+                }
+                continue
+
+            crosscorrs[fov_id] = {}
+            for peak_id, xcorr_array in six.iteritems(graph.results[("xcorr", fov_id)]):
+                # put the results, with the average, and a guess if the channel
+                # is full into the dictionary
+                crosscorrs[fov_id][peak_id] = {
+                    "ccs": xcorr_array,
+                    "cc_avg": np.average(xcorr_array),
+                    "full": np.average(xcorr_array)
+                    < p["compile"]["channel_picking_threshold"],
+                }
 
         # linear loop for debug
         # get results from the pool and put the results in the dictionary if succesful
@@ -1369,6 +3086,18 @@ def compile(params):
     with open(os.path.join(p["ana_dir"], "specs.yaml"), "w") as specs_file:
         yaml.dump(data=specs, stream=specs_file, default_flow_style=False, tags=None)
 
+    run_timer.counts.update(fovs=len(specs))
+    run_timer.stop()
+    print_run_summary(params)
+
+    ### Watch for images still being acquired #####################################################
+    if "watch" in p["compile"] and p["compile"]["watch"]:
+        if not (p["compile"]["do_channel_masks"] or p["compile"]["do_slicing"]):
+            channel_masks = load_channel_masks(params)
+        watch_tiff_dir(
+            params, metadata_table, channel_masks, user_spec_fovs, t_start, t_end
+        )
+
     information("Finished.")
 
 
@@ -1384,6 +3113,11 @@ def compile_gen_params(
     channel_width,
     channel_separation,
     xcorr_threshold,
+    output="TIFF",
+    memory_limit=None,
+    watch=False,
+    hdf5_compression="gzip",
+    hdf5_t_chunk=1,
 ):
     # global params
     params = dict()
@@ -1393,7 +3127,7 @@ def compile_gen_params(
     params["analysis_directory"] = analysis_directory
     params["FOV"] = FOV
     params["TIFF_source"] = image_format
-    params["output"] = "TIFF"
+    params["output"] = output
     params["phase_plane"] = phase_plane
     params["seconds_per_time_index"] = seconds_per_frame
 
@@ -1407,13 +3141,35 @@ def compile_gen_params(
     params["compile"]["channel_width"] = channel_width
     params["compile"]["channel_separation"] = channel_separation
     params["compile"]["channel_detection_snr"] = 1
+    # all images are used to find channels. set to a number of images per fov to
+    # sample them instead, which fused compiling needs
+    params["compile"]["channel_detection_frames"] = None
     params["compile"]["channel_length_pad"] = 10
     params["compile"]["channel_width_pad"] = 10
+    params["compile"]["slice_window"] = 20
+    params["compile"]["slice_memory_limit"] = None
+    params["compile"]["fused"] = False
     params["compile"]["do_crosscorrs"] = True
     params["compile"]["channel_picking_threshold"] = xcorr_threshold
     params["compile"]["alignment_pad"] = 10
+    params["compile"]["do_drift"] = True
+    # keep adding new images to the stacks while acquiring, see watch_tiff_dir. Only
+    # for scripts, as compile does not return until watching stops
+    params["compile"]["watch"] = watch
+    params["compile"]["watch_interval"] = 30
+    params["compile"]["watch_timeout"] = 3600
+    params["compile"]["watch_gap_timeout"] = 300
+
+    # layout of the HDF5 stacks, see hdf5_dataset_kwargs
+    params["hdf5"] = dict()
+    params["hdf5"]["compression"] = hdf5_compression
+    params["hdf5"]["compression_level"] = None
+    params["hdf5"]["t_chunk"] = hdf5_t_chunk
+    params["hdf5"]["fletcher32"] = True
 
     params["num_analyzers"] = multiprocessing.cpu_count()
+    # GB the analysis may use, see _planner. None for half of the physical memory
+    params["memory_limit"] = memory_limit
 
     # useful folder shorthands for opening files
     params["TIFF_dir"] = os.path.join(
@@ -1423,6 +3179,7 @@ def compile_gen_params(
         params["experiment_directory"], params["analysis_directory"]
     )
     params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+    params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
     params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
     params["empty_dir"] = os.path.join(params["ana_dir"], "empties")
     params["sub_dir"] = os.path.join(params["ana_dir"], "subtracted")
@@ -1464,6 +3221,26 @@ def compile_gen_params(
         "tooltip": "Required. Location (within working directory) for outputting analysis. 'working directory/analysis/' by default."
     },
     output_prefix={"tooltip": "Optional. Prefix for output files"},
+    output={
+        "choices": ["TIFF", "HDF5", "Zarr"],
+        "tooltip": "Format for the channel stacks and later analysis images.",
+    },
+    memory_limit={
+        "widget_type": "FloatSpinBox",
+        "min": 0,
+        "max": 4096,
+        "step": 0.5,
+        "tooltip": "Optional. Memory in GB the analysis may use. Fewer workers and smaller batches are used to stay within it. 0 uses half of the physical memory.",
+    },
+    hdf5_compression={
+        "choices": ["gzip", "lzf", "blosc-lz4", "blosc-zstd", "None"],
+        "tooltip": "HDF5 output only. Compression of the stacks. The Blosc codecs need the hdf5plugin package.",
+    },
+    hdf5_t_chunk={
+        "min": 1,
+        "max": 1000,
+        "tooltip": "HDF5 output only. Time points stored together. Larger chunks compress better, smaller ones are quicker to read a few frames from.",
+    },
 )
 def Compile(
     experiment_directory=Path(),
@@ -1477,6 +3254,10 @@ def Compile(
     channel_width: int = 10,
     channel_separation: int = 45,
     xcorr_threshold=0.99,
+    output="TIFF",
+    memory_limit=0.0,
+    hdf5_compression="gzip",
+    hdf5_t_chunk: int = 1,
 ):
     """Performs Mother Machine Analysis"""
     params = compile_gen_params(
@@ -1491,6 +3272,10 @@ def Compile(
         channel_width,
         channel_separation,
         xcorr_threshold,
+        output,
+        memory_limit or None,
+        hdf5_compression=hdf5_compression,
+        hdf5_t_chunk=hdf5_t_chunk,
     )
 
     compile(params)
@@ -15,6 +15,12 @@ try:
     import cPickle as pickle
 except:
     import pickle
+
+# registers the Blosc filters with h5py, so HDF5 files written with them can be read
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 from pathlib import Path
 import re
 from scipy import ndimage as ndi
@@ -97,11 +103,13 @@ def get_time(filepath):
 
 
 # loads and image stack from TIFF or HDF5 using mm3 conventions
-def load_stack(params, fov_id, peak_id, color="c1", image_return_number=None):
+def load_stack(
+    params, fov_id, peak_id, color="c1", image_return_number=None, frames=None
+):
     """
     Loads an image stack.
 
-    Supports reading TIFF stacks or HDF5 files.
+    Supports reading TIFF stacks, HDF5 files or Zarr stores.
 
     Parameters
     ----------
@@ -116,6 +124,8 @@ def load_stack(params, fov_id, peak_id, color="c1", image_return_number=None):
         sub : subtracted images
         seg : segmented images
         empty : get the empty channel for this fov, slightly different
+    frames : tuple
+        (t_start, t_end) to only read those frames of the stack, None for all.
 
     Returns
     -------
@@ -132,13 +142,18 @@ def load_stack(params, fov_id, peak_id, color="c1", image_return_number=None):
             )
 
             with tiff.TiffFile(os.path.join(params["empty_dir"], img_filename)) as tif:
-                img_stack = tif.asarray()
+                img_stack = read_tiff_frames(tif, frames)
 
         if params["output"] == "HDF5":
             with h5py.File(
                 os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id), "r"
             ) as h5f:
-                img_stack = h5f[color][:]
+                img_stack = h5f[color][frame_slice(frames)]
+
+        if params["output"] == "Zarr":
+            img_stack = open_zarr_fov(params, fov_id, mode="r")[color][
+                frame_slice(frames)
+            ]
 
         return img_stack
 
@@ -186,7 +201,7 @@ def load_stack(params, fov_id, peak_id, color="c1", image_return_number=None):
             )
 
         with tiff.TiffFile(os.path.join(img_dir, img_filename)) as tif:
-            img_stack = tif.asarray()
+            img_stack = read_tiff_frames(tif, frames)
 
     if params["output"] == "HDF5":
         with h5py.File(
@@ -194,24 +209,413 @@ def load_stack(params, fov_id, peak_id, color="c1", image_return_number=None):
         ) as h5f:
             # normal naming
             # need to use [:] to get a copy, else it references the closed hdf5 dataset
-            img_stack = h5f["channel_%04d/p%04d_%s" % (peak_id, peak_id, color)][:]
+            img_stack = h5f["channel_%04d/p%04d_%s" % (peak_id, peak_id, color)][
+                frame_slice(frames)
+            ]
+
+    if params["output"] == "Zarr":
+        # same naming as HDF5. Slicing reads the frames from the store
+        zgroup = open_zarr_fov(params, fov_id, mode="r")
+        img_stack = zgroup["channel_%04d/p%04d_%s" % (peak_id, peak_id, color)][
+            frame_slice(frames)
+        ]
 
     return img_stack
 
 
-# load the time table and add it to the global params
+def frame_slice(frames):
+    """The slice of the frames (t_start, t_end) of a stack, all if None."""
+
+    if frames is None:
+        return np.s_[:]
+    return np.s_[frames[0] : frames[1]]
+
+
+def read_tiff_frames(tif, frames=None):
+    """Reads the frames (t_start, t_end) of a TIFF stack with one page per frame, all
+    if None. Only the pages of those frames are decoded.
+
+    Called by
+    load_stack
+    """
+
+    if frames is None:
+        return tif.asarray()
+
+    n_pages = len(tif.pages)
+    pages = range(min(frames[0], n_pages), min(frames[1], n_pages))
+    if len(pages) == 0:
+        return np.zeros((0,) + tif.pages[0].shape, dtype=tif.pages[0].dtype)
+
+    return tif.asarray(key=pages).reshape((len(pages),) + tif.pages[0].shape)
+
+
+def stack_length(params, fov_id, peak_id, color="c1"):
+    """Returns the number of frames of a channel stack Compile made, without reading
+    the frames.
+    """
+
+    if params["output"] == "TIFF":
+        img_filename = params["experiment_name"] + "_xy%03d_p%04d_%s.tif" % (
+            fov_id,
+            peak_id,
+            color,
+        )
+        with tiff.TiffFile(os.path.join(params["chnl_dir"], img_filename)) as tif:
+            return len(tif.pages)
+
+    if params["output"] == "HDF5":
+        with h5py.File(
+            os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id), "r"
+        ) as h5f:
+            return h5f["channel_%04d/p%04d_%s" % (peak_id, peak_id, color)].shape[0]
+
+    if params["output"] == "Zarr":
+        zgroup = open_zarr_fov(params, fov_id, mode="r")
+        return zgroup["channel_%04d/p%04d_%s" % (peak_id, peak_id, color)].shape[0]
+
+
+# options for creating hdf5 image stacks
+def hdf5_dataset_kwargs(params, shape):
+    """Returns the keyword arguments for h5py create_dataset for a (t, y, x) image stack.
+    The layout can be set in params['hdf5'] with the keys
+        compression : 'gzip' (default), 'lzf', 'blosc-lz4', 'blosc-zstd' or None.
+            The Blosc codecs need the hdf5plugin package.
+        compression_level : level for gzip and Blosc. Default is the codec's default.
+        t_chunk : number of time points per chunk. Default is 1.
+        fletcher32 : store checksums with each chunk. Default is True.
+    The defaults are the layout mm3 has always written.
+    """
+
+    hdf5_options = {
+        "compression": "gzip",
+        "compression_level": None,
+        "t_chunk": 1,
+        "fletcher32": True,
+    }
+    if "hdf5" in params:
+        hdf5_options.update(params["hdf5"])
+
+    t_chunk = max(min(int(hdf5_options["t_chunk"]), shape[0]), 1)
+    compression = hdf5_options["compression"]
+    compression_level = hdf5_options["compression_level"]
+
+    dataset_kwargs = {
+        "chunks": (t_chunk, shape[1], shape[2]),
+        "maxshape": (None, shape[1], shape[2]),
+        "fletcher32": bool(hdf5_options["fletcher32"]),
+    }
+
+    if compression in ("gzip", "lzf"):
+        dataset_kwargs["compression"] = compression
+        dataset_kwargs["shuffle"] = True
+        if compression == "gzip" and compression_level is not None:
+            dataset_kwargs["compression_opts"] = int(compression_level)
+
+    elif compression in ("blosc-lz4", "blosc-zstd"):
+        if hdf5plugin is None:
+            raise ImportError(
+                "HDF5 %s compression needs the hdf5plugin package." % compression
+            )
+
+        # blosc does its own shuffling
+        dataset_kwargs.update(
+            hdf5plugin.Blosc(
+                cname=compression.split("-")[1],
+                clevel=5 if compression_level is None else int(compression_level),
+                shuffle=hdf5plugin.Blosc.SHUFFLE,
+            )
+        )
+
+    elif compression not in (None, "None"):
+        raise ValueError("Unknown HDF5 compression %s." % compression)
+
+    return dataset_kwargs
+
+
+# Zarr output is optional, it is only imported when used
+def import_zarr():
+    """Imports the zarr package, which is needed for the Zarr output."""
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(
+            "Zarr output needs the zarr package. Install it with 'pip install zarr'."
+        )
+
+    return zarr
+
+
+# opens the zarr store of an FOV
+def open_zarr_fov(params, fov_id, mode="a"):
+    """Opens the Zarr store for an FOV. It is laid out like the HDF5 file for the FOV,
+    with a group per channel holding a (t, y, x) array per image type.
+    Arrays are only read when they are sliced, so frame ranges can be read lazily.
+    """
+
+    zarr = import_zarr()
+
+    return zarr.open_group(
+        os.path.join(params["zarr_dir"], "xy%03d.zarr" % fov_id), mode=mode
+    )
+
+
+# create an image stack in a zarr group
+def create_zarr_stack(params, zgroup, name, shape, dtype):
+    """Creates (replacing any existing) a (t, y, x) array in a Zarr group.
+    Arrays are compressed with Blosc zstd and chunked by a number of time points,
+    params['zarr']['t_chunk'] (16 by default), and the whole image in y and x.
+    """
+
+    from numcodecs import Blosc
+
+    t_chunk = 16
+    if "zarr" in params and "t_chunk" in params["zarr"]:
+        t_chunk = int(params["zarr"]["t_chunk"])
+
+    return zgroup.create_dataset(
+        name,
+        shape=shape,
+        chunks=(max(min(t_chunk, shape[0]), 1), shape[1], shape[2]),
+        dtype=dtype,
+        compressor=Blosc(cname="zstd", clevel=5, shuffle=Blosc.BITSHUFFLE),
+        overwrite=True,
+    )
+
+
+# save an image stack to a zarr group
+def save_zarr_stack(params, fov_id, name, img_stack):
+    """Saves a (t, y, x) image stack to the Zarr store of an FOV. name is the path of
+    the array in the store, e.g. 'channel_0040/p0040_sub_c1' or 'empty_c1'.
+    """
+
+    zgroup = open_zarr_fov(params, fov_id)
+    zarray = create_zarr_stack(params, zgroup, name, img_stack.shape, img_stack.dtype)
+    zarray[:] = img_stack
+
+    return zarray
+
+
+# guess the output format of the analysis from the analysis directory
+def save_output_format(params):
+    """Records the output format Compile writes the channel stacks in, as
+    output_format.yaml in the analysis directory, for infer_output_format."""
+
+    with open(os.path.join(params["ana_dir"], "output_format.yaml"), "w") as f:
+        yaml.dump(data={"output": params["output"]}, stream=f, default_flow_style=False)
+
+
+def infer_output_format(params):
+    """Returns the output format ('TIFF', 'HDF5' or 'Zarr') Compile used for the
+    channel stacks, as recorded by save_output_format. For analyses from before it
+    was recorded, it is judged from which output directory Compile made in the
+    analysis directory. Defaults to TIFF.
+    """
+
+    format_path = os.path.join(params["ana_dir"], "output_format.yaml")
+    if os.path.exists(format_path):
+        with open(format_path, "r") as f:
+            return yaml.safe_load(f)["output"]
+
+    for output, output_dir in (
+        ("Zarr", params["zarr_dir"]),
+        ("HDF5", params["hdf5_dir"]),
+        ("TIFF", params["chnl_dir"]),
+    ):
+        if os.path.isdir(output_dir) and os.listdir(output_dir):
+            return output
+
+    return "TIFF"
+
+
+# the time table made by Compile
+class TimeTable(object):
+    """Look up table for the elapsed time in seconds of each time point of each FOV,
+    made by mm3_Compile.make_time_table. It is used like the nested dictionary it
+    replaced, time_table[fov_id][t], but each FOV is an array of times indexed by
+    time point minus the first time point of the FOV, so a look up is an array index.
+    Time points which are missing for a FOV are -1 in its array.
+
+    It is saved as a .npz file with save, and loaded with TimeTable.load.
+    """
+
+    def __init__(self, first_ts, times):
+        """
+        Parameters
+        first_ts : dict
+            first time point of each FOV, by FOV id.
+        times : dict
+            array of elapsed times in seconds from the first time point, by FOV id.
+        """
+
+        self.first_ts = {
+            int(fov_id): int(first_t) for fov_id, first_t in first_ts.items()
+        }
+        self.times = {
+            int(fov_id): np.asarray(fov_times, dtype=np.int64)
+            for fov_id, fov_times in times.items()
+        }
+
+    @classmethod
+    def from_arrays(cls, fov_ids, ts, seconds):
+        """Makes a time table from the FOV id, time point and elapsed time of each
+        image, as arrays."""
+
+        fov_ids = np.asarray(fov_ids)
+        ts = np.asarray(ts, dtype=np.int64)
+        seconds = np.asarray(seconds, dtype=np.int64)
+
+        first_ts = {}
+        times = {}
+        for fov_id in np.unique(fov_ids):
+            fov_rows = fov_ids == fov_id
+            fov_ts = ts[fov_rows]
+            first_ts[fov_id] = fov_ts.min()
+            times[fov_id] = np.full(fov_ts.max() - fov_ts.min() + 1, -1, dtype=np.int64)
+            times[fov_id][fov_ts - fov_ts.min()] = seconds[fov_rows]
+
+        return cls(first_ts, times)
+
+    @classmethod
+    def from_dict(cls, time_table):
+        """Makes a time table from the nested dictionary {fov_id: {t: seconds}} used
+        before, as found in time_table.yaml or time_table.pkl."""
+
+        rows = [
+            (fov_id, t, seconds)
+            for fov_id, fov_times in time_table.items()
+            for t, seconds in fov_times.items()
+        ]
+        if not rows:
+            return cls({}, {})
+
+        return cls.from_arrays(*zip(*rows))
+
+    @classmethod
+    def load(cls, filename):
+        """Loads a time table saved with save."""
+
+        with np.load(filename) as time_table_file:
+            fov_ids = time_table_file["fov_ids"]
+            first_ts = dict(zip(fov_ids, time_table_file["first_ts"]))
+            times = {fov_id: time_table_file["times_%d" % fov_id] for fov_id in fov_ids}
+
+        return cls(first_ts, times)
+
+    def save(self, filename):
+        """Saves the time table as a .npz file."""
+
+        fov_ids = sorted(self.times.keys())
+        np.savez(
+            filename,
+            fov_ids=np.array(fov_ids, dtype=np.int64),
+            first_ts=np.array([self.first_ts[fov_id] for fov_id in fov_ids]),
+            **{"times_%d" % fov_id: self.times[fov_id] for fov_id in fov_ids}
+        )
+
+    def to_dict(self):
+        """Returns the time table as the nested dictionary {fov_id: {t: seconds}}."""
+
+        return {fov_id: dict(self[fov_id].items()) for fov_id in self.keys()}
+
+    def keys(self):
+        return sorted(self.times.keys())
+
+    def items(self):
+        return [(fov_id, self[fov_id]) for fov_id in self.keys()]
+
+    def __getitem__(self, fov_id):
+        return FOVTimes(self.first_ts[fov_id], self.times[fov_id])
+
+    def __contains__(self, fov_id):
+        return fov_id in self.times
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.times)
+
+
+class FOVTimes(object):
+    """The elapsed times of the time points of one FOV in a TimeTable. Indexed by time
+    point like a dictionary."""
+
+    def __init__(self, first_t, times):
+        self.first_t = first_t
+        self.times = times
+
+    def __getitem__(self, t):
+        index = int(t) - self.first_t
+        if index < 0 or index >= len(self.times) or self.times[index] < 0:
+            raise KeyError(t)
+
+        return int(self.times[index])
+
+    def get(self, t, default=None):
+        try:
+            return self[t]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return (np.flatnonzero(self.times >= 0) + self.first_t).tolist()
+
+    def values(self):
+        return self.times[self.times >= 0].tolist()
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def __contains__(self, t):
+        return self.get(t) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.times >= 0))
+
+
+# load the time table
 def load_time_table(ana_dir):
-    """Add the time table dictionary to the params global dictionary.
-    This is so it can be used during Cell creation.
+    """Loads the time table made by Compile, as a TimeTable. This is so it can be used
+    during Cell creation. Time tables from before time_table.npz was saved are loaded
+    from time_table.yaml or time_table.pkl.
     """
 
-    # try first for yaml, then for pkl
+    # try first for npz, then for yaml, then for pkl
+    if os.path.exists(os.path.join(ana_dir, "time_table.npz")):
+        return TimeTable.load(os.path.join(ana_dir, "time_table.npz"))
     try:
         with open(os.path.join(ana_dir, "time_table.yaml"), "rb") as time_table_file:
-            return yaml.safe_load(time_table_file)
+            return TimeTable.from_dict(yaml.safe_load(time_table_file))
     except:
         with open(os.path.join(ana_dir, "time_table.pkl"), "rb") as time_table_file:
-            return pickle.load(time_table_file)
+            return TimeTable.from_dict(pickle.load(time_table_file))
+
+
+# load the stage drift found by Compile
+def load_drift(params):
+    """Loads the stage drift of each FOV estimated by Compile (see
+    mm3_Compile.collect_drift) from drift.npz in the analysis directory.
+
+    Returns
+    drift : dict
+        int array (n_t, 2) of the (dy, dx) drift of each image of the FOV from the
+        first, in the order of the channel stacks, by FOV id. Empty if Compile did
+        not estimate drift.
+    """
+
+    drift_path = os.path.join(params["ana_dir"], "drift.npz")
+    if not os.path.exists(drift_path):
+        return {}
+
+    with np.load(drift_path) as drift_file:
+        return {
+            int(fov_id): drift_file["shifts_%d" % fov_id]
+            for fov_id in drift_file["fov_ids"]
+        }
 
 
 # function for loading the specs file
@@ -323,7 +727,9 @@ def segment_image(params, image):
         # here is the main algorithm
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            labeled_image = segmentation.random_walker(-1 * image, markers)
+            labeled_image = segmentation.random_walker(
+                -1 * image.astype("int32"), markers
+            )
         # put negative values back to zero for proper image
         labeled_image[labeled_image == -1] = 0
     except:
@@ -332,6 +738,213 @@ def segment_image(params, image):
     return labeled_image
 
 
+# normalized cross correlation of many templates at once
+def template_spectra(templates, image_shape):
+    """Transforms of templates (..., h, w) for match_template_fft against images of
+    shape image_shape (H, W), so templates used with many images (like the empty
+    channel of an FOV, which is aligned to every channel) are only transformed once.
+    """
+
+    templates = np.asarray(templates, dtype=np.float64)
+
+    return np.conj(np.fft.rfft2(templates, s=tuple(image_shape)))
+
+
+def match_template_fft(images, templates, spectra=None):
+    """Normalized cross correlation of templates against images. This is
+    skimage.feature.match_template (without pad_input), computed for many image and
+    template pairs in one FFT pass.
+
+    Parameters
+    images : np.ndarray
+        images of shape (..., H, W).
+    templates : np.ndarray
+        templates of shape (..., h, w), no larger than the images. The leading
+        dimensions of images and templates are broadcast against each other, e.g.
+        images (peaks, 1, H, W) and templates (peaks, t, h, w) correlates the t
+        templates of each peak with the image of that peak.
+    spectra : np.ndarray
+        the transforms of the templates for images of this size, from
+        template_spectra. They are computed here if None.
+
+    Returns
+    response : np.ndarray
+        correlation coefficients of shape (..., H - h + 1, W - w + 1), the position
+        is that of the top left corner of the template in the image.
+    """
+
+    images = np.asarray(images, dtype=np.float64)
+    templates = np.asarray(templates, dtype=np.float64)
+    img_h, img_w = images.shape[-2:]
+    tmpl_h, tmpl_w = templates.shape[-2:]
+    out_h, out_w = img_h - tmpl_h + 1, img_w - tmpl_w + 1
+
+    # sums of the image and the squared image under the template at each position
+    def window_sum(data):
+        integral = np.zeros(data.shape[:-2] + (img_h + 1, img_w + 1))
+        integral[..., 1:, 1:] = data.cumsum(axis=-2).cumsum(axis=-1)
+        return (
+            integral[..., tmpl_h:, tmpl_w:]
+            - integral[..., :out_h, tmpl_w:]
+            - integral[..., tmpl_h:, :out_w]
+            + integral[..., :out_h, :out_w]
+        )
+
+    image_window_sum = window_sum(images)
+    image_window_sum2 = window_sum(images ** 2)
+
+    template_mean = templates.mean(axis=(-2, -1), keepdims=True)
+    template_volume = tmpl_h * tmpl_w
+    template_ssd = np.sum((templates - template_mean) ** 2, axis=(-2, -1), keepdims=True)
+
+    # cross correlation by FFT. With the transform the size of the image, positions
+    # where the template is inside the image do not wrap around
+    if spectra is None:
+        spectra = template_spectra(templates, (img_h, img_w))
+    xcorr = np.fft.irfft2(np.fft.rfft2(images) * spectra, s=(img_h, img_w))[
+        ..., :out_h, :out_w
+    ]
+
+    numerator = xcorr - image_window_sum * template_mean
+    denominator = (
+        image_window_sum2 - image_window_sum ** 2 / template_volume
+    ) * template_ssd
+    denominator = np.sqrt(np.maximum(denominator, 0))
+
+    # avoid zero-division
+    mask = denominator > np.finfo(np.float64).eps
+    response = np.zeros(numerator.shape)
+    response[mask] = numerator[mask] / np.broadcast_to(denominator, mask.shape)[mask]
+
+    return response
+
+
+def match_template_at(images, templates, positions):
+    """Normalized cross correlation of templates against images at one position each,
+    the value match_template_fft gives at that position, without a search.
+
+    Parameters
+    images : np.ndarray
+        images of shape (..., H, W).
+    templates : np.ndarray
+        templates of shape (..., h, w), broadcast against images as in
+        match_template_fft.
+    positions : np.ndarray
+        integer (y, x) of the top left corner of each template in its image, of shape
+        (..., 2) broadcast against the leading dimensions. They are clipped so the
+        template is inside the image.
+
+    Returns
+    response : np.ndarray
+        correlation coefficients of shape (...).
+    """
+
+    images = np.asarray(images, dtype=np.float64)
+    templates = np.asarray(templates, dtype=np.float64)
+    img_h, img_w = images.shape[-2:]
+    tmpl_h, tmpl_w = templates.shape[-2:]
+
+    lead_shape = np.broadcast(
+        np.empty(images.shape[:-2]),
+        np.empty(templates.shape[:-2]),
+        np.empty(np.shape(positions)[:-1]),
+    ).shape
+    images = np.broadcast_to(images, lead_shape + (img_h, img_w)).reshape(
+        (-1, img_h, img_w)
+    )
+    templates = np.broadcast_to(templates, lead_shape + (tmpl_h, tmpl_w)).reshape(
+        (-1, tmpl_h, tmpl_w)
+    )
+    positions = np.broadcast_to(positions, lead_shape + (2,)).reshape((-1, 2))
+    ys = np.clip(positions[:, 0], 0, img_h - tmpl_h).astype(int)
+    xs = np.clip(positions[:, 1], 0, img_w - tmpl_w).astype(int)
+
+    # the part of each image under its template
+    rows = ys[:, np.newaxis] + np.arange(tmpl_h)
+    cols = xs[:, np.newaxis] + np.arange(tmpl_w)
+    windows = images[
+        np.arange(len(images))[:, np.newaxis, np.newaxis],
+        rows[:, :, np.newaxis],
+        cols[:, np.newaxis, :],
+    ]
+
+    windows = windows - windows.mean(axis=(-2, -1), keepdims=True)
+    templates = templates - templates.mean(axis=(-2, -1), keepdims=True)
+    numerator = np.sum(windows * templates, axis=(-2, -1))
+    denominator = np.sqrt(
+        np.sum(windows ** 2, axis=(-2, -1)) * np.sum(templates ** 2, axis=(-2, -1))
+    )
+
+    # avoid zero-division
+    mask = denominator > np.finfo(np.float64).eps
+    response = np.zeros(numerator.shape)
+    response[mask] = numerator[mask] / denominator[mask]
+
+    return response.reshape(lead_shape)
+
+
+def phase_correlation_shifts(reference, images, max_shift=None):
+    """Finds how far the content of each image is translated from reference, to the
+    nearest pixel, by FFT phase correlation of the row and column profiles (the mean
+    of each row and of each column) of the images.
+
+    Cells move and grow between images but the chip does not. Averaged over all
+    the channels of an image the cells mostly cancel out of the profiles, while the
+    channel ends and walls stay, so the profiles follow the stage and not the cells.
+    The ends of the profiles are tapered so they do not count as a match at no shift.
+
+    Parameters
+    reference : np.ndarray
+        image of shape (H, W).
+    images : np.ndarray
+        images of shape (n, H, W).
+    max_shift : int
+        only shifts up to this many pixels in y and x are considered. Images with
+        regular structure, like a row of channels, also match at shifts of the
+        period of the structure.
+
+    Returns
+    shifts : np.ndarray
+        int array (n, 2) of (dy, dx), such that images[i] is about reference moved
+        down by dy and right by dx.
+    """
+
+    reference = np.asarray(reference, dtype=np.float64)
+    images = np.asarray(images, dtype=np.float64)
+
+    shifts = []
+    for axis in (-1, -2):
+        # the profile along the other axis
+        ref_profile = reference.mean(axis=axis)
+        profiles = images.mean(axis=axis)
+        n = len(ref_profile)
+
+        # taper the outer eighth of each end
+        edge = max(n // 8, 1)
+        ramp = np.hanning(2 * edge)
+        window = np.ones(n)
+        window[:edge] = ramp[:edge]
+        window[-edge:] = ramp[edge:]
+
+        def spectrum(data):
+            data = data - data.mean(axis=-1, keepdims=True)
+            return np.fft.rfft(data * window)
+
+        # normalized cross power spectrum
+        cross_power = spectrum(profiles) * np.conj(spectrum(ref_profile))
+        cross_power /= np.maximum(np.abs(cross_power), np.finfo(np.float64).eps)
+        correlation = np.fft.irfft(cross_power, n=n)
+
+        # shifts past half the profile wrap around to negative shifts
+        profile_shifts = np.fft.ifftshift(np.arange(n) - n // 2)
+        if max_shift is not None:
+            correlation[:, np.abs(profile_shifts) > max_shift] = -np.inf
+
+        shifts.append(profile_shifts[correlation.argmax(axis=1)])
+
+    return np.stack(shifts, axis=1)
+
+
 def get_pad_distances(unet_shape, img_height, img_width):
     """Finds padding and trimming sizes to make the input image the same as the size expected by the U-net model.
 
@@ -508,6 +1121,11 @@ class Cell:
         self.width = None
         self.death = None
 
+        # fluorescence by channel, filled out by find_all_cell_intensities
+        self.area_mean_fluorescence = {}
+        self.volume_mean_fluorescence = {}
+        self.total_fluorescence = {}
+
     def grow(self, time_table, region, t):
         """Append data from a region to this cell.
         use cell.times[-1] to get most current value"""
@@ -544,10 +1162,12 @@ class Cell:
         """
         self.death = t
 
-    def divide(self, daughter1, daughter2, t):
+    def divide(self, params, time_table, daughter1, daughter2, t):
         """Divide the cell and update stats.
         daugther1 and daugther2 are instances of the Cell class.
-        daughter1 is the daugther closer to the closed end."""
+        daughter1 is the daugther closer to the closed end.
+        time_table is the time table of the experiment (see Compile), which the
+        absolute division time is taken from."""
 
         # put the daugther ids into the cell
         self.daughters = [daughter1.id, daughter2.id]
@@ -557,7 +1177,7 @@ class Cell:
 
         # update times
         self.times_w_div = self.times + [self.division_time]
-        self.abs_times.append(params["time_table"][self.fov][self.division_time])
+        self.abs_times.append(time_table[self.fov][self.division_time])
 
         # flesh out the stats for this cell
         # size at birth
@@ -909,11 +1529,21 @@ def filter_cells_containing_val_in_attr(Cells, attr, val):
 
 
 def find_all_cell_intensities(
-    Cells, specs, time_table, channel_name="sub_c2", apply_background_correction=True
+    params,
+    Cells,
+    specs,
+    time_table,
+    channel_name="sub_c2",
+    apply_background_correction=True,
+    seg_img="seg_unet",
 ):
     """
     Finds fluorescenct information for cells. All the cells in Cells
     should be from one fov/peak.
+
+    params are the parameters of the analysis, which the fluorescence and
+    segmentation stacks are loaded with. seg_img is the segmentation the cells were
+    tracked on, seg_unet or seg_otsu.
     """
 
     # iterate over each fov in specs
@@ -939,9 +1569,7 @@ def find_all_cell_intensities(
                 # median filter will be applied to every image
                 with warnings.catch_warnings():
                     warnings.simplefilter("ignore")
-                    median_filtered = median(
-                        fl_stack[frame, ...], selem=morphology.disk(1)
-                    )
+                    median_filtered = median(fl_stack[frame, ...], morphology.disk(1))
 
                 # subtract the gaussian-filtered image from true image to correct
                 #   uneven background fluorescence
@@ -953,7 +1581,7 @@ def find_all_cell_intensities(
                 else:
                     corrected_stack[frame, :, :] = median_filtered
 
-            seg_stack = load_stack(params, fov_id, peak_id, color="seg_unet")
+            seg_stack = load_stack(params, fov_id, peak_id, color=seg_img)
 
             # evaluate whether each cell is in this fov/peak combination
             for cell_id, cell in Cells.items():
@@ -1231,14 +1859,18 @@ def segmentUNet(params):
                 h5ds = h5g.create_dataset(
                     "p%04d_%s" % (peak_id, params["seg_img"]),
                     data=segmented_imgs,
-                    chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                    maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                    compression="gzip",
-                    shuffle=True,
-                    fletcher32=True,
+                    **hdf5_dataset_kwargs(params, segmented_imgs.shape)
                 )
                 h5f.close()
 
+            if params["output"] == "Zarr":
+                save_zarr_stack(
+                    params,
+                    fov_id,
+                    "channel_%04d/p%04d_%s" % (peak_id, peak_id, params["seg_img"]),
+                    segmented_imgs,
+                )
+
     information("Loading experiment parameters.")
     p = params
 
@@ -1690,6 +2322,7 @@ def SegmentUnet(
         params["experiment_directory"], params["analysis_directory"]
     )
     params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+    params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
     params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
     params["empty_dir"] = os.path.join(params["ana_dir"], "empties")
     params["sub_dir"] = os.path.join(params["ana_dir"], "subtracted")
@@ -1701,4 +2334,7 @@ def SegmentUnet(
     params["track_dir"] = os.path.join(params["ana_dir"], "tracking")
     params["foci_track_dir"] = os.path.join(params["ana_dir"], "tracking_foci")
 
+    # use the format Compile wrote the channels in
+    params["output"] = infer_output_format(params)
+
     segmentUNet(params)
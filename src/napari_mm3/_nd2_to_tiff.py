@@ -5,7 +5,6 @@ import dask.array as da
 import json
 import pims_nd2
 import tifffile as tiff
-import re
 import io
 import numpy as np
 
@@ -14,6 +13,7 @@ from magicgui import magic_factory
 from pathlib import Path
 from skimage import io
 from ._function import range_string_to_indices, information, julian_day_number
+from ._catalog import load_catalog
 
 
 def nd2ToTIFF(
@@ -247,25 +247,16 @@ def Nd2ToTIFF(
     viewer = napari.current_viewer()
     viewer.layers.clear()
 
-    image_name_list = [filename.name for filename in tif_dir.glob("*xy*")]
-    fov_regex = re.compile(r"xy\d*")
-    fovs = list(
-        sorted(
-            set(
-                int(fov_regex.search(filename).group()[2:])
-                for filename in image_name_list
-            )
-        )
-    )
+    # the TIFFs just written, by fov
+    catalog = load_catalog(tif_dir)
+    fovs = catalog.fov_ids()
     if fov_list:
         fovs = fov_list
 
     # Print out results!
     for fov_id in fovs:
-        # TODO: Can allow xy in any position via regex! But it currently does not
-        found_files = tif_dir.glob(f"*xy{fov_id:02d}.tif")
-
-        found_files = sorted(found_files)  # should sort by timepoint
+        # sorted by name, which is by timepoint. files of one row are left out
+        found_files = [tif_dir / fn for fn in catalog.query(fovs=[fov_id], suffix="")]
 
         sample = io.imread(found_files[0])
 
@@ -0,0 +1,406 @@
+"""Memory planning for the parallel steps of mm3.
+
+The frame shapes and plane counts of every image are known from the metadata
+table once Compile has analyzed the images, and the size of every channel from the
+channel masks. From those the memory one task of slicing, subtraction or
+segmentation needs can be estimated before it is started. The plan_* functions
+pick how many workers to use, how many FOVs to slice at once and how many frames
+to slice at a time so that the estimate fits in the memory budget, and raise a
+MemoryError if even the smallest setting would not fit, instead of running out of
+memory part way through.
+
+The budget is params['memory_limit'] in GB. If it is not set, half of the physical
+memory is used.
+"""
+
+import os
+import numpy as np
+
+from ._function import information
+
+# memory of a worker process with mm3 and its libraries imported, from the run report
+PROCESS_BYTES = 150 * 1024**2
+
+# frames per window slicing is first shrunk to, before fewer FOVs are sliced at once
+MIN_SLICE_WINDOW = 10
+
+# phase images kept per channel for the cross correlations, see xcorr_sample_indices
+XCORR_SAMPLES = 20
+
+
+def memory_budget(params):
+    """Returns the memory budget in bytes, params['memory_limit'] GB or half of the
+    physical memory if it is not set. For Compile params['compile']['slice_memory_limit']
+    is used if params['memory_limit'] is not set. None if there is no limit set and the
+    physical memory is not known."""
+
+    memory_limit = None
+    if "memory_limit" in params:
+        memory_limit = params["memory_limit"]
+        if memory_limit == "None":
+            memory_limit = None
+    if memory_limit is None and "compile" in params:
+        if "slice_memory_limit" in params["compile"]:
+            memory_limit = params["compile"]["slice_memory_limit"]
+            if memory_limit == "None":
+                memory_limit = None
+
+    if memory_limit is not None:
+        return float(memory_limit) * 1024**3
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def fov_frame_info(metadata_table, fov_id):
+    """Returns the number of frames of an FOV and the bytes of its largest frame with
+    all planes, from the metadata table. Images are 16 bit."""
+
+    fov_rows = metadata_table[metadata_table["fov"] == fov_id]
+    if len(fov_rows) == 0:
+        return 0, 0
+
+    frame_pixels = np.prod(fov_rows["shape"].astype(np.int64), axis=1)
+    frame_pixels *= np.maximum(fov_rows["n_planes"], 1)
+
+    return len(fov_rows), int(frame_pixels.max()) * 2
+
+
+def fov_n_planes(metadata_table, fov_id):
+    fov_rows = metadata_table[metadata_table["fov"] == fov_id]
+    return int(np.max(fov_rows["n_planes"], initial=1))
+
+
+def channel_plane_bytes(channel_masks, fov_id, peak_ids=None):
+    """Returns the bytes of one plane of one frame of each channel of an FOV, by peak,
+    from the channel masks [[y1, y2], [x1, x2]]."""
+
+    channel_bytes = {}
+    for peak_id, channel_loc in channel_masks[fov_id].items():
+        if peak_ids is not None and peak_id not in peak_ids:
+            continue
+        (y1, y2), (x1, x2) = channel_loc
+        channel_bytes[peak_id] = (int(y2) - int(y1)) * (int(x2) - int(x1)) * 2
+
+    return channel_bytes
+
+
+### Estimates ###
+def estimate_slicing_bytes(metadata_table, channel_masks, fov_id, window):
+    """Estimates the memory a slicing task for an FOV needs on top of its worker, with
+    images loaded window frames at a time (see load_image_blocks).
+
+    The frames of a window are held as a list and as a stacked block, and the slices
+    of the block are as large again. The phase images for the cross correlations are
+    kept for the whole FOV, and a whole channel stack is copied to write it out.
+    """
+
+    n_frames, frame_bytes = fov_frame_info(metadata_table, fov_id)
+    if n_frames == 0:
+        return 0
+    window = min(int(window), n_frames) if window else n_frames
+    n_planes = fov_n_planes(metadata_table, fov_id)
+    channel_bytes = channel_plane_bytes(channel_masks, fov_id)
+    if not channel_bytes:
+        return 3 * window * frame_bytes
+
+    samples_bytes = min(n_frames, XCORR_SAMPLES) * sum(channel_bytes.values())
+    write_bytes = n_frames * max(channel_bytes.values()) * n_planes
+
+    return 3 * window * frame_bytes + samples_bytes + write_bytes
+
+
+def estimate_subtraction_bytes(
+    metadata_table, channel_masks, fov_id, peak_ids, alignment_pad=0
+):
+    """Estimates the memory subtracting an FOV needs (see subtract), as the memory held
+    for the FOV while its channels are subtracted and the memory held for each of its
+    channels being subtracted. For the FOV the empty stack is shared with the workers
+    as a memory mapped stack in /dev/shm, with the transforms of the empty stack for
+    aligning it (see find_empty_offsets), which are single precision complex numbers
+    for about half of the padded channel. For a channel the stack is loaded and copied to a shared
+    stack, next to the shared output stack, so about three stacks are held. The
+    workers only hold a few frames each.
+
+    Returns
+    fov_bytes : int
+        memory held for the FOV.
+    peak_bytes : int
+        memory held for its largest channel.
+    """
+
+    n_frames = fov_frame_info(metadata_table, fov_id)[0]
+    channel_bytes = channel_plane_bytes(channel_masks, fov_id, peak_ids)
+    if n_frames == 0 or not channel_bytes:
+        return 0, 0
+
+    spectra_bytes = 0
+    for peak_id in channel_bytes.keys():
+        (y1, y2), (x1, x2) = channel_masks[fov_id][peak_id]
+        padded_y = int(y2) - int(y1) + 2 * alignment_pad
+        padded_x = int(x2) - int(x1) + 2 * alignment_pad
+        spectra_bytes = max(spectra_bytes, padded_y * (padded_x // 2 + 1) * 8)
+
+    stack_bytes = n_frames * max(channel_bytes.values())
+
+    return stack_bytes + n_frames * spectra_bytes, 3 * stack_bytes
+
+
+def estimate_segmentation_bytes(metadata_table, channel_masks, fov_id, peak_ids):
+    """Estimates the memory segmenting the largest channel of an FOV needs (see
+    segment_chnl_stack). The subtracted stack is 16 bit, the labeled frames are 64
+    bit integers held as a list and stacked before they are made 8 bit, and a frame
+    being segmented has a few float copies."""
+
+    n_frames = fov_frame_info(metadata_table, fov_id)[0]
+    channel_bytes = channel_plane_bytes(channel_masks, fov_id, peak_ids)
+    if n_frames == 0 or not channel_bytes:
+        return 0
+
+    # bytes per pixel of the stack, 2 subtracted, 8 + 8 labels and 1 segmented
+    channel_pixels = max(channel_bytes.values()) // 2
+    return n_frames * channel_pixels * 19 + 4 * channel_pixels * 8
+
+
+### Plans ###
+def plan_workers(params, budget=None):
+    """Returns how many worker processes fit in the memory budget next to the main
+    process, at most params['num_analyzers'].
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    if budget is None:
+        budget = memory_budget(params)
+    n_workers = max(int(params["num_analyzers"]), 1)
+    if budget is None:
+        return n_workers
+
+    n_fit = int((budget - PROCESS_BYTES) // PROCESS_BYTES)
+    if n_fit < 1:
+        raise MemoryError(
+            "A memory budget of %.2f GB does not leave room for a worker process, "
+            "%.2f GB are needed." % (budget / 1024.0**3, 2 * PROCESS_BYTES / 1024.0**3)
+        )
+
+    return min(n_workers, n_fit)
+
+
+def plan_slicing(params, metadata_table, channel_masks, fov_ids, n_workers):
+    """Picks how many FOVs to slice at once and the window of frames loaded at a time
+    (params['compile']['slice_window']) so that slicing fits in the memory budget
+    with n_workers worker processes. If it does not fit, the window is shrunk to
+    MIN_SLICE_WINDOW frames first, then fewer FOVs are sliced at once, and then the
+    window is shrunk to a single frame.
+
+    Returns
+    plan : dict
+        'processes', the number of FOVs sliced at once, 'window', the frames loaded
+        at a time (None for whole FOVs), and 'bytes', the estimated peak memory.
+
+    Raises
+    MemoryError
+        if slicing one FOV a frame at a time does not fit in the budget.
+
+    Called by
+    mm3_Compile.compile
+    """
+
+    window = None
+    if "slice_window" in params["compile"]:
+        window = params["compile"]["slice_window"]
+        if window == "None":
+            window = None
+
+    n_processes = max(min(n_workers, len(fov_ids)), 1)
+    budget = memory_budget(params)
+
+    def peak_bytes(n_processes, window):
+        # the largest FOVs may be sliced together
+        fov_bytes = sorted(
+            [
+                estimate_slicing_bytes(metadata_table, channel_masks, fov_id, window)
+                for fov_id in fov_ids
+            ],
+            reverse=True,
+        )
+        return (1 + n_workers) * PROCESS_BYTES + sum(fov_bytes[:n_processes])
+
+    if budget is None:
+        return {
+            "processes": n_processes,
+            "window": window,
+            "bytes": peak_bytes(n_processes, window),
+        }
+
+    max_frames = max(
+        [fov_frame_info(metadata_table, fov_id)[0] for fov_id in fov_ids] + [1]
+    )
+    window_frames = min(int(window), max_frames) if window else max_frames
+
+    while peak_bytes(n_processes, window_frames) > budget:
+        if window_frames > MIN_SLICE_WINDOW:
+            window_frames = max(window_frames // 2, MIN_SLICE_WINDOW)
+        elif n_processes > 1:
+            n_processes -= 1
+        elif window_frames > 1:
+            window_frames = max(window_frames // 2, 1)
+        else:
+            raise MemoryError(
+                "Slicing needs %.2f GB even one FOV and one frame at a time, which "
+                "is more than the memory budget of %.2f GB."
+                % (
+                    peak_bytes(1, 1) / 1024.0**3,
+                    budget / 1024.0**3,
+                )
+            )
+
+    if window is None and window_frames == max_frames:
+        window_frames = None
+    elif window is not None and window_frames == min(int(window), max_frames):
+        window_frames = window
+
+    return {
+        "processes": n_processes,
+        "window": window_frames,
+        "bytes": peak_bytes(n_processes, window_frames),
+    }
+
+
+def plan_subtraction(params, metadata_table, channel_masks, specs, fov_ids):
+    """Picks how many worker processes subtraction uses, and how many FOVs and how
+    many channels are subtracted at once, so that subtraction fits in the memory
+    budget (see estimate_subtraction_bytes). The channels of an FOV are split into
+    blocks of frames for the workers, so one channel keeps them busy, and two per
+    worker let the main process load and save channels while the workers subtract.
+    If it does not fit, fewer channels are subtracted at once first, then fewer FOVs,
+    and then fewer workers are used.
+
+    Returns
+    plan : dict
+        'processes', the number of workers, 'fovs', the number of FOVs subtracted at
+        once, 'peaks', the number of channels subtracted at once, 'bytes', the
+        estimated peak memory, and 'shared_bytes', the part of it in the stacks shared
+        with the workers (see make_scratch_dir).
+
+    Raises
+    MemoryError
+        if the largest channel does not fit in the budget with a single worker.
+
+    Called by
+    mm3_Subtract.subtract
+    """
+
+    alignment_pad = 0
+    if "subtract" in params and "alignment_pad" in params["subtract"]:
+        alignment_pad = int(params["subtract"]["alignment_pad"])
+
+    fov_bytes, peak_bytes = 0, 0
+    for fov_id in fov_ids:
+        if fov_id not in channel_masks:
+            continue
+        fov_estimate = estimate_subtraction_bytes(
+            metadata_table,
+            channel_masks,
+            fov_id,
+            [peak_id for peak_id, spec in specs[fov_id].items() if spec in (0, 1)],
+            alignment_pad,
+        )
+        fov_bytes = max(fov_bytes, fov_estimate[0])
+        peak_bytes = max(peak_bytes, fov_estimate[1])
+
+    n_workers = max(int(params["num_analyzers"]), 1)
+    n_fovs = max(min(n_workers, len(fov_ids)), 1)
+    n_peaks = 2 * n_workers
+
+    def peak_memory(n_workers, n_fovs, n_peaks):
+        return (
+            (1 + n_workers) * PROCESS_BYTES + n_fovs * fov_bytes + n_peaks * peak_bytes
+        )
+
+    budget = memory_budget(params)
+    if budget is not None:
+        while peak_memory(n_workers, n_fovs, n_peaks) > budget:
+            if n_peaks > n_fovs:
+                n_peaks -= 1
+            elif n_fovs > 1:
+                n_fovs -= 1
+                n_peaks = n_fovs
+            elif n_workers > 1:
+                n_workers -= 1
+            else:
+                raise MemoryError(
+                    "Subtraction needs %.2f GB for the largest channel with one "
+                    "worker, which is more than the memory budget of %.2f GB."
+                    % (
+                        peak_memory(1, 1, 1) / 1024.0**3,
+                        budget / 1024.0**3,
+                    )
+                )
+
+    return {
+        "processes": n_workers,
+        "fovs": n_fovs,
+        "peaks": n_peaks,
+        "bytes": peak_memory(n_workers, n_fovs, n_peaks),
+        "shared_bytes": n_fovs * fov_bytes + n_peaks * peak_bytes,
+    }
+
+
+def check_segmentation(params, metadata_table, channel_masks, specs, fov_ids):
+    """Checks that segmenting the largest channel fits in the memory budget.
+    Segmentation is done a channel at a time in the main process.
+
+    Returns
+    peak_bytes : int
+        the estimated peak memory.
+
+    Raises
+    MemoryError
+        if it does not fit.
+
+    Called by
+    mm3_Segment.segmentOTSU
+    """
+
+    stack_bytes = max(
+        [
+            estimate_segmentation_bytes(
+                metadata_table,
+                channel_masks,
+                fov_id,
+                [peak_id for peak_id, spec in specs[fov_id].items() if spec == 1],
+            )
+            for fov_id in fov_ids
+            if fov_id in channel_masks
+        ]
+        + [0]
+    )
+    peak_bytes = PROCESS_BYTES + stack_bytes
+
+    budget = memory_budget(params)
+    if budget is not None and peak_bytes > budget:
+        raise MemoryError(
+            "Segmentation needs %.2f GB for the largest channel, which is more than "
+            "the memory budget of %.2f GB."
+            % (peak_bytes / 1024.0**3, budget / 1024.0**3)
+        )
+
+    return peak_bytes
+
+
+def print_plan(step, plan):
+    """Prints what a plan picked."""
+
+    settings = ", ".join(
+        "%s %s" % (key, value)
+        for key, value in plan.items()
+        if not key.endswith("bytes")
+    )
+    information(
+        "%s plan: %s, estimated peak memory %.2f GB."
+        % (step, settings, plan["bytes"] / 1024.0**3)
+    )
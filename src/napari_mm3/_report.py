@@ -0,0 +1,333 @@
+"""Run report: how long each stage of an analysis took, what it processed and how
+much memory it used.
+
+Stages are timed with stage_timer, as a context manager or with start and stop.
+Each timed stage appends one JSON line to run_report.jsonl in the analysis
+directory when it stops, from whichever process ran it, so the tasks done by pool
+workers end up in the same file as the rest. Code inside a stage adds to its
+counters (files, frames, peaks, cells...) with count.
+
+The memory of a stage is the peak resident memory of its process while the stage
+ran, and how much that peak is above what the process held when the stage started.
+It is measured on Linux by resetting the peak (VmHWM) when a stage starts, and is
+None elsewhere.
+
+summarize_run_report adds the lines of one run up by stage, and print_run_summary
+prints that, e.g. at the end of Compile.
+"""
+
+import json
+import os
+import sys
+import time
+import traceback
+
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from ._function import information, warning
+
+# timers running in this process, innermost last
+_active_timers = []
+
+
+def report_path(params):
+    return os.path.join(params["ana_dir"], "run_report.jsonl")
+
+
+def start_run(params, name):
+    """Starts a new run in the report, and a timer for the whole of it. The run id is
+    put in params, so stages timed with these params (also in pool workers, which get
+    a copy of params) are part of this run.
+
+    Returns
+    timer : StageTimer
+        started timer named name. Stop it when the run is done.
+    """
+
+    params["run_id"] = "%s-%s-%d" % (name, time.strftime("%Y%m%dT%H%M%S"), os.getpid())
+
+    return stage_timer(params, name).start()
+
+
+def stage_timer(params, stage, **labels):
+    """Times a stage, e.g.
+
+        with stage_timer(params, "subtract", fov=fov_id):
+            ...
+
+    labels (fov, peak...) say which part of the data the stage worked on. The
+    record is appended to run_report.jsonl in params['ana_dir'] when the stage
+    stops.
+    """
+
+    return StageTimer(params, stage, labels)
+
+
+def count(**counts):
+    """Adds to the counters of the innermost stage running in this process, e.g.
+    count(frames=len(image_data)). Does nothing outside of a stage."""
+
+    if _active_timers:
+        _active_timers[-1].counts.update(counts)
+
+
+def peak_rss_mb(children=False):
+    """Peak resident memory of this process in MB over its lifetime, or with children
+    of the largest child process which has exited and been waited for (e.g. the
+    workers of a closed Pool). This is not reset by stage_timer, see memory_mb for
+    that. None where the resource module is not available (Windows)."""
+
+    if resource is None:
+        return None
+    # macOS reports bytes, Linux kB
+    unit = 1024.0**2 if sys.platform == "darwin" else 1024.0
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    return resource.getrusage(who).ru_maxrss / unit
+
+
+def memory_mb():
+    """Current resident memory of this process in MB, and its peak since the last
+    reset_peak_memory, from /proc/self/status. (None, None) where it is not
+    available."""
+
+    try:
+        with open("/proc/self/status") as status_file:
+            fields = dict(line.split(":", 1) for line in status_file if ":" in line)
+        return (
+            int(fields["VmRSS"].split()[0]) / 1024.0,
+            int(fields["VmHWM"].split()[0]) / 1024.0,
+        )
+    except (OSError, KeyError, ValueError, IndexError):
+        return None, None
+
+
+def reset_peak_memory():
+    """Resets the peak resident memory of this process (VmHWM) to the current one.
+    Returns False where that is not possible."""
+
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def io_bytes():
+    """Bytes read and written by this process so far, from /proc/self/io. This counts
+    what was asked of the operating system, whether or not it came from the disk
+    cache. (None, None) where it is not available."""
+
+    try:
+        with open("/proc/self/io") as io_file:
+            fields = dict(line.split(":", 1) for line in io_file if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class StageTimer(object):
+    """Times one stage, see stage_timer."""
+
+    def __init__(self, params, stage, labels):
+        self.params = params
+        self.stage = stage
+        self.labels = labels
+        self.counts = Counter()
+
+    def start(self):
+        self.start_time = time.time()
+        self.start_perf = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_io = io_bytes()
+
+        # resetting the peak for this stage loses it for the stages around it, so
+        # they keep what they have seen so far
+        start_rss, peak_rss = memory_mb()
+        for timer in _active_timers:
+            timer.update_peak(peak_rss)
+        self.start_rss = start_rss
+        self.peak_rss = None
+        self.peak_reset = start_rss is not None and reset_peak_memory()
+
+        _active_timers.append(self)
+        return self
+
+    def update_peak(self, peak_rss):
+        if self.peak_reset and peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+
+    def stop(self, error=None):
+        """Stops the timer and appends its record to the run report."""
+
+        if self in _active_timers:
+            _active_timers.remove(self)
+
+        end_io = io_bytes()
+        self.update_peak(memory_mb()[1])
+        record = {
+            "run_id": self.params.get("run_id"),
+            "stage": self.stage,
+            "labels": self.labels,
+            "pid": os.getpid(),
+            "start": self.start_time,
+            "seconds": time.perf_counter() - self.start_perf,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "counts": dict(self.counts),
+            "bytes_read": None,
+            "bytes_written": None,
+            "peak_rss_mb": self.peak_rss,
+            "rss_growth_mb": None,
+            "error": error,
+        }
+        if self.peak_rss is not None:
+            record["rss_growth_mb"] = max(self.peak_rss - self.start_rss, 0)
+        if end_io[0] is not None and self.start_io[0] is not None:
+            record["bytes_read"] = end_io[0] - self.start_io[0]
+            record["bytes_written"] = end_io[1] - self.start_io[1]
+
+        # one write per line, so lines from different processes do not mix
+        try:
+            with open(report_path(self.params), "a") as report_file:
+                report_file.write(json.dumps(record, default=str) + "\n")
+        except OSError as e:
+            warning("Could not write to the run report: %s" % e)
+
+        return record
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        error = None
+        if exc_type is not None:
+            error = "".join(
+                traceback.format_exception(exc_type, exc_value, exc_traceback)
+            )
+        self.stop(error)
+        return False
+
+
+def run_timed(params, stage, labels, func, *args):
+    """Calls func(*args) inside a stage_timer. Used by TaskGraph to time its tasks in
+    the pool workers."""
+
+    with stage_timer(params, stage, **labels):
+        return func(*args)
+
+
+def load_run_report(ana_dir, run_id=None):
+    """Loads the records of run_report.jsonl in ana_dir. Only the records of run_id
+    are returned if given, and of the last run started if run_id is 'last'."""
+
+    records = []
+    filename = os.path.join(ana_dir, "run_report.jsonl")
+    if not os.path.exists(filename):
+        return records
+
+    with open(filename, "r") as report_file:
+        for line in report_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # a line cut short by a crash
+                continue
+
+    if run_id == "last" and records:
+        run_id = max(records, key=lambda record: record["start"])["run_id"]
+    if run_id is not None:
+        records = [record for record in records if record["run_id"] == run_id]
+
+    return records
+
+
+def summarize_run_report(records):
+    """Adds up the records of a run by stage.
+
+    Returns
+    summary : dict
+        by stage, the number of tasks, their total and CPU seconds, the slowest task
+        and its labels, the summed counts and bytes, the number of processes, the
+        largest peak memory of any task and the most any task grew the memory of
+        its process by, and the number of failed tasks.
+    """
+
+    summary = {}
+    for record in sorted(records, key=lambda record: record["start"]):
+        stage = summary.setdefault(
+            record["stage"],
+            {
+                "tasks": 0,
+                "seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "slowest_seconds": 0.0,
+                "slowest_labels": {},
+                "counts": Counter(),
+                "bytes_read": 0,
+                "bytes_written": 0,
+                "processes": set(),
+                "peak_rss_mb": None,
+                "rss_growth_mb": None,
+                "failed": 0,
+            },
+        )
+        stage["tasks"] += 1
+        stage["seconds"] += record["seconds"]
+        stage["cpu_seconds"] += record["cpu_seconds"]
+        if record["seconds"] >= stage["slowest_seconds"]:
+            stage["slowest_seconds"] = record["seconds"]
+            stage["slowest_labels"] = record["labels"]
+        stage["counts"].update(record["counts"])
+        stage["bytes_read"] += record["bytes_read"] or 0
+        stage["bytes_written"] += record["bytes_written"] or 0
+        stage["processes"].add(record["pid"])
+        for key in ("peak_rss_mb", "rss_growth_mb"):
+            if record.get(key) is not None:
+                stage[key] = max(stage[key] or 0, record[key])
+        if record["error"]:
+            stage["failed"] += 1
+
+    for stage in summary.values():
+        stage["counts"] = dict(stage["counts"])
+        stage["processes"] = len(stage["processes"])
+
+    return summary
+
+
+def print_run_summary(params):
+    """Prints the summary of the run in params (see start_run) by stage."""
+
+    records = load_run_report(params["ana_dir"], params.get("run_id"))
+    for name, stage in summarize_run_report(records).items():
+        line = "%s: %d task%s in %.1f s (%.1f s CPU)" % (
+            name,
+            stage["tasks"],
+            "" if stage["tasks"] == 1 else "s",
+            stage["seconds"],
+            stage["cpu_seconds"],
+        )
+        if stage["tasks"] > 1:
+            line += ", slowest %s %.1f s" % (
+                " ".join("%s %s" % item for item in stage["slowest_labels"].items()),
+                stage["slowest_seconds"],
+            )
+        if stage["counts"]:
+            line += ", " + ", ".join(
+                "%d %s" % (n, key) for key, n in sorted(stage["counts"].items())
+            )
+        line += ", %.0f MB read, %.0f MB written" % (
+            stage["bytes_read"] / 1024.0**2,
+            stage["bytes_written"] / 1024.0**2,
+        )
+        if stage["peak_rss_mb"] is not None:
+            line += ", peak memory %.0f MB" % stage["peak_rss_mb"]
+        if stage["rss_growth_mb"] is not None:
+            line += " (up to %.0f MB more than at the start)" % stage["rss_growth_mb"]
+        if stage["failed"]:
+            line += ", %d failed" % stage["failed"]
+        information(line)
@@ -0,0 +1,254 @@
+import queue
+import traceback
+
+from multiprocessing import Pool
+
+from ._function import warning
+from ._report import run_timed
+
+
+class TaskOutput(object):
+    """Stands in for the result of a task in the arguments of another task.
+    It is replaced by the result, or the item of the result if item is given, when
+    the dependent task is started."""
+
+    def __init__(self, name, item=None):
+        self.name = name
+        self.item = item
+
+    def resolve(self, results):
+        result = results[self.name]
+        if self.item is not None:
+            result = result[self.item]
+        return result
+
+
+class TaskGraph(object):
+    """Runs tasks on one process pool, starting each as soon as the tasks it depends
+    on have finished. The pool is kept for the life of the graph, so one pool can
+    serve all the stages of an analysis, and a stage does not have to wait for the
+    stragglers of the stage before it to finish.
+
+    Tasks are added with add and run with run. Tasks can be given a group, and the
+    number of tasks of a group running at once can be limited with set_group_limit
+    (e.g. to limit memory). A task whose output stays in memory after it finishes can
+    keep its place in the group until a later task, e.g. the one which saves the
+    output, has finished too (hold_until). Tasks marked local are run in the main
+    process instead of the pool, which is useful for small steps that gather results.
+
+    Results are kept in results, by task name. Tasks that raised an exception, and
+    tasks that depend on them, are in failed instead.
+
+    If the graph is given params, every task is timed as a stage of the run report
+    (see _report), named after the task or the first item of its name.
+
+    Example
+    graph = TaskGraph(4)
+    graph.add("load", load_stack, args=(params, 1, 40))
+    graph.add("mean", np.mean, args=(graph.output("load"),), deps=["load"])
+    graph.run()
+    graph.close()
+    """
+
+    def __init__(self, processes, params=None):
+        self.pool = Pool(processes)
+        self.processes = processes
+        self.params = params
+
+        self.results = {}  # results of finished tasks by name
+        self.failed = set()  # names of tasks which failed or could not be run
+
+        self._pending = {}  # tasks waiting to be started, by name
+        self._order = []  # names of pending tasks in the order they were added
+        self._running = {}  # group of each running task, by name
+        self._hold_names = {}  # hold_until of running tasks, by name
+        self._holding = {}  # (group, hold_until) of finished tasks keeping their place
+        self._group_limits = {}
+        self._done = queue.Queue()  # (name, success, result) put by the pool callbacks
+
+    def __contains__(self, name):
+        return (
+            name in self._pending
+            or name in self._running
+            or name in self.results
+            or name in self.failed
+        )
+
+    def output(self, name, item=None):
+        """Returns a stand in for the result of task name, or result[item], for the
+        args of a task which depends on it."""
+
+        return TaskOutput(name, item)
+
+    def set_group_limit(self, group, limit):
+        """Limits how many tasks of group run at once."""
+
+        self._group_limits[group] = max(int(limit), 1)
+
+    def add(
+        self,
+        name,
+        func,
+        args=(),
+        deps=(),
+        group=None,
+        local=False,
+        labels=None,
+        hold_until=None,
+    ):
+        """Adds a task to the graph.
+
+        Parameters
+        name : hashable
+            unique name of the task, its result is kept under this name.
+        func : function
+            function to run. For tasks run in the pool it must be importable.
+        args : tuple
+            arguments for func. Values made with output are replaced by the result
+            of that task.
+        deps : list
+            names of the tasks which have to finish before this one starts.
+        group : hashable
+            group of the task, see set_group_limit.
+        local : bool
+            run the task in the main process.
+        labels : dict
+            labels of the task in the run report, e.g. {'fov': fov_id}.
+        hold_until : hashable
+            name of a task until which this task keeps its place in its group once
+            it has finished, see set_group_limit.
+        """
+
+        if name in self:
+            raise ValueError("Task %s was already added." % (name,))
+
+        self._pending[name] = {
+            "func": func,
+            "args": tuple(args),
+            "deps": list(deps),
+            "group": group,
+            "local": local,
+            "labels": labels or {},
+            "hold_until": hold_until,
+        }
+        self._order.append(name)
+
+    def run(self):
+        """Runs the tasks added so far and waits for them, and the tasks they add,
+        to finish."""
+
+        while self._pending or self._running:
+            self._start_ready()
+
+            if not self._running:
+                if self._pending:
+                    # whatever is left depends on tasks which are not in the graph
+                    for name in list(self._order):
+                        warning("Task %s has missing dependencies." % (name,))
+                        self._skip(name)
+                break
+
+            name, success, result = self._done.get()
+            group = self._running.pop(name)
+            hold_until = self._hold_names.pop(name, None)
+            if success and hold_until is not None:
+                self._holding[name] = (group, hold_until)
+            if success:
+                self.results[name] = result
+            else:
+                warning("Task %s failed:\n%s" % (name, result))
+                self.failed.add(name)
+
+    def close(self):
+        """Closes the pool and waits for its workers to exit."""
+
+        self.pool.close()
+        self.pool.join()
+
+    def _start_ready(self):
+        """Starts every pending task whose dependencies are finished and whose group
+        has room, in the order they were added."""
+
+        changed = True
+        while changed:
+            changed = False
+            for name in list(self._order):
+                task = self._pending[name]
+
+                # tasks which depend on a failed task are not run
+                if any(dep in self.failed for dep in task["deps"]):
+                    warning("Skipping task %s, a task it depends on failed." % (name,))
+                    self._skip(name)
+                    changed = True
+                    continue
+
+                if not all(dep in self.results for dep in task["deps"]):
+                    continue
+
+                group = task["group"]
+                if group in self._group_limits:
+                    if self._group_size(group) >= self._group_limits[group]:
+                        continue
+
+                del self._pending[name]
+                self._order.remove(name)
+                self._running[name] = group
+                if task["hold_until"] is not None:
+                    self._hold_names[name] = task["hold_until"]
+
+                args = tuple(
+                    arg.resolve(self.results) if isinstance(arg, TaskOutput) else arg
+                    for arg in task["args"]
+                )
+
+                func = task["func"]
+                if self.params is not None:
+                    stage = name[0] if isinstance(name, tuple) else name
+                    args = (self.params, stage, task["labels"], func) + args
+                    func = run_timed
+
+                if task["local"]:
+                    # local tasks can add more tasks to the graph
+                    try:
+                        self._done.put((name, True, func(*args)))
+                    except Exception:
+                        self._done.put((name, False, traceback.format_exc()))
+                else:
+                    self.pool.apply_async(
+                        func,
+                        args=args,
+                        callback=self._callback(name),
+                        error_callback=self._error_callback(name),
+                    )
+
+    def _group_size(self, group):
+        """Number of tasks of group which are running, or have finished but keep their
+        place until another task has finished too."""
+
+        for name, (_, hold_until) in list(self._holding.items()):
+            if hold_until in self.results or hold_until in self.failed:
+                del self._holding[name]
+
+        return sum(1 for g in self._running.values() if g == group) + sum(
+            1 for g, _ in self._holding.values() if g == group
+        )
+
+    def _skip(self, name):
+        del self._pending[name]
+        self._order.remove(name)
+        self.failed.add(name)
+
+    def _callback(self, name):
+        return lambda result: self._done.put((name, True, result))
+
+    def _error_callback(self, name):
+        # the traceback from the worker is chained to the error
+        return lambda error: self._done.put(
+            (
+                name,
+                False,
+                "".join(
+                    traceback.format_exception(type(error), error, error.__traceback__)
+                ),
+            )
+        )
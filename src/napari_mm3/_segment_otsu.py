@@ -1,4 +1,4 @@
-from magicgui import magic_factory, magicgui
+from magicgui import magic_factory
 from pathlib import Path
 import multiprocessing
 import napari
@@ -8,13 +8,26 @@ import tifffile as tiff
 import h5py
 import numpy as np
 
-from ._function import information, warnings, load_specs, load_stack, segment_image
+from ._function import (
+    information,
+    warnings,
+    load_specs,
+    load_stack,
+    segment_image,
+    save_zarr_stack,
+    infer_output_format,
+    hdf5_dataset_kwargs,
+)
+from ._report import start_run, stage_timer, count, print_run_summary
+from ._planner import check_segmentation
+from ._compile import load_planning_tables
+
 
 # Do segmentation for an channel time stack
-def segment_chnl_stack(fov_id, peak_id):
+def segment_chnl_stack(params, fov_id, peak_id):
     """
     For a given fov and peak (channel), do segmentation for all images in the
-    subtracted .tif stack.
+    subtracted .tif stack. params are those of segmentOTSU.
 
     Called by
     mm3_Segment.py
@@ -29,6 +42,7 @@ def segment_chnl_stack(fov_id, peak_id):
     sub_stack = load_stack(
         params, fov_id, peak_id, color="sub_{}".format(params["phase_plane"])
     )
+    count(peaks=1, frames=len(sub_stack))
 
     # # set up multiprocessing pool to do segmentation. Will do everything before going on.
     # pool = Pool(processes=params['num_analyzers'])
@@ -58,18 +72,6 @@ def segment_chnl_stack(fov_id, peak_id):
         tiff.imsave(
             os.path.join(params["seg_dir"], seg_filename), segmented_imgs, compress=5
         )
-        # if fov_id==1:
-        viewer = napari.current_viewer()
-
-        viewer.add_labels(
-            segmented_imgs,
-            name="Segmented"
-            + "_xy%03d_p%04d" % (fov_id, peak_id)
-            + "_"
-            + str(params["seg_img"])
-            + ".tif",
-            visible=True,
-        )
 
     if params["output"] == "HDF5":
         h5f = h5py.File(os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id), "r+")
@@ -84,14 +86,32 @@ def segment_chnl_stack(fov_id, peak_id):
         h5ds = h5g.create_dataset(
             "p%04d_%s" % (peak_id, params["seg_img"]),
             data=segmented_imgs,
-            chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-            maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-            compression="gzip",
-            shuffle=True,
-            fletcher32=True,
+            **hdf5_dataset_kwargs(params, segmented_imgs.shape)
         )
         h5f.close()
 
+    if params["output"] == "Zarr":
+        save_zarr_stack(
+            params,
+            fov_id,
+            "channel_%04d/p%04d_%s" % (peak_id, peak_id, params["seg_img"]),
+            segmented_imgs,
+        )
+
+    # there is no viewer when run headless
+    viewer = napari.current_viewer()
+    if params["output"] in ("TIFF", "Zarr") and viewer is not None:
+        # if fov_id==1:
+        viewer.add_labels(
+            segmented_imgs,
+            name="Segmented"
+            + "_xy%03d_p%04d" % (fov_id, peak_id)
+            + "_"
+            + str(params["seg_img"])
+            + ".tif",
+            visible=True,
+        )
+
     information("Saved segmented channel %d." % peak_id)
 
     return True
@@ -121,6 +141,9 @@ def segmentOTSU(params):
     # set segmentation image name for saving and loading segmented images
     p["seg_img"] = "seg_otsu"
 
+    # time each stage of the run, see _report
+    run_timer = start_run(params, "segment")
+
     # load specs file
     specs = load_specs(params)
 
@@ -133,6 +156,16 @@ def segmentOTSU(params):
 
     information("Segmenting %d FOVs." % len(fov_id_list))
 
+    # stop before running out of memory, see _planner
+    metadata_table, channel_masks = load_planning_tables(params)
+    if metadata_table is not None:
+        peak_bytes = check_segmentation(
+            params, metadata_table, channel_masks, specs, fov_id_list
+        )
+        information(
+            "Segmentation estimated peak memory %.2f GB." % (peak_bytes / 1024.0**3)
+        )
+
     ### Do Segmentation by FOV and then peak #######################################################
     information("Segmenting channels using Otsu method.")
 
@@ -148,12 +181,19 @@ def segmentOTSU(params):
 
         for peak_id in ana_peak_ids:
             # send to segmentation
-            segment_chnl_stack(fov_id, peak_id)
+            with stage_timer(params, "segmentation", fov=fov_id, peak=peak_id):
+                segment_chnl_stack(params, fov_id, peak_id)
+
+    run_timer.counts.update(fovs=len(fov_id_list))
+    run_timer.stop()
+    print_run_summary(params)
 
     information("Finished segmentation.")
 
 
-@magicgui(
+# a factory, so the widget is only made when it is opened and the module can be
+# imported without a display. SegmentOtsu docks a new DebugOtsu() each time
+@magic_factory(
     auto_call=True,
     first_opening_size=dict(widget_type="SpinBox", step=1),
     OTSU_threshold=dict(widget_type="FloatSpinBox", min=0, max=2, step=0.01),
@@ -266,6 +306,8 @@ def SegmentOtsu(
     params["segment"]["second_opening_size"] = second_opening_size
     params["segment"]["min_object_size"] = min_object_size
     params["num_analyzers"] = multiprocessing.cpu_count()
+    # GB the analysis may use, see _planner. None for half of the physical memory
+    params["memory_limit"] = None
 
     # useful folder shorthands for opening files
     params["TIFF_dir"] = os.path.join(
@@ -275,6 +317,7 @@ def SegmentOtsu(
         params["experiment_directory"], params["analysis_directory"]
     )
     params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+    params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
     params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
     params["empty_dir"] = os.path.join(params["ana_dir"], "empties")
     params["sub_dir"] = os.path.join(params["ana_dir"], "subtracted")
@@ -282,9 +325,12 @@ def SegmentOtsu(
     params["cell_dir"] = os.path.join(params["ana_dir"], "cell_data")
     params["track_dir"] = os.path.join(params["ana_dir"], "tracking")
 
+    # use the format Compile wrote the channels in
+    params["output"] = infer_output_format(params)
+
     ## if debug is checked, clicking run will launch this new widget. need to pass fov & peak
     if params["interactive"]:
         viewer = napari.current_viewer()
-        viewer.window.add_dock_widget(DebugOtsu, name="debugotsu")
+        viewer.window.add_dock_widget(DebugOtsu(), name="debugotsu")
     else:
         segmentOTSU(params)
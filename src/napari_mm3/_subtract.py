@@ -1,12 +1,12 @@
 from magicgui import magic_factory
 from pathlib import Path
 from skimage.feature import match_template
-from multiprocessing.pool import Pool
 
 import tifffile as tiff
 import numpy as np
 import multiprocessing
 import os
+import shutil
 import napari
 import six
 import h5py
@@ -15,12 +15,23 @@ from ._function import (
     information,
     warning,
     load_stack,
+    stack_length,
     load_specs,
     range_string_to_indices,
+    save_zarr_stack,
+    infer_output_format,
+    hdf5_dataset_kwargs,
+    load_drift,
+    match_template_fft,
+    template_spectra,
 )
+from ._report import start_run, count, print_run_summary
+from ._scheduler import TaskGraph
+from ._planner import plan_subtraction, print_plan
+from ._compile import load_planning_tables
 
 
-def subtract_phase(params, cropped_channel, empty_channel):
+def subtract_phase(params, cropped_channel, empty_channel, offset=None):
     """subtract_phase aligns and subtracts a .
     Modified from subtract_phase_only by jt on 20160511
     The subtracted image returned is the same size as the image given. It may however include
@@ -30,13 +41,16 @@ def subtract_phase(params, cropped_channel, empty_channel):
 
     Parameters
     image_pair : tuple of length two with; (image, empty_mean)
+    offset : tuple
+        (y, x) position of the empty channel in the padded channel, see
+        find_empty_offset. It is searched for with match_template if not given.
 
     Returns
     channel_subtracted : np.array
         The subtracted image
 
     Called by
-    subtract_fov_stack
+    subtract_frames
     """
 
     # this is for aligning the empty channel to the cell channel.
@@ -46,11 +60,14 @@ def subtract_phase(params, cropped_channel, empty_channel):
     ]  # pixel size to use for padding (ammount that alignment could be off)
     padded_chnl = np.pad(cropped_channel, pad_size, mode="reflect")
 
-    # ### Align channel to empty using match template.
-    # use match template to get a correlation array and find the position of maximum overlap
-    match_result = match_template(padded_chnl, empty_channel)
-    # get row and colum of max correlation value in correlation array
-    y, x = np.unravel_index(np.argmax(match_result), match_result.shape)
+    if offset is not None:
+        y, x = offset
+    else:
+        # ### Align channel to empty using match template.
+        # use match template to get a correlation array and find the position of maximum overlap
+        match_result = match_template(padded_chnl, empty_channel)
+        # get row and colum of max correlation value in correlation array
+        y, x = np.unravel_index(np.argmax(match_result), match_result.shape)
 
     # pad the empty channel according to alignment to be overlayed on padded channel.
     empty_paddings = [
@@ -73,8 +90,201 @@ def subtract_phase(params, cropped_channel, empty_channel):
     return channel_subtracted
 
 
-def subtract_phase_helper(all_args):
-    return subtract_phase(*all_args)
+def find_empty_offset(params, image_data, empty_stack, n_samples=10):
+    """Finds the alignment of the empty channel to a channel once for the whole stack.
+    Stage drift moves the channel and the empty channel of an FOV together, so once
+    compile has measured it (see load_drift) the alignment between them does not
+    change with time. It is the median of the match_template alignment of n_samples
+    evenly spaced time points.
+
+    Returns
+    offset : tuple
+        (y, x) position of the empty channel in the padded channel, as used by
+        subtract_phase.
+
+    Called by
+    share_channel_stack
+    """
+
+    n_images = min(len(image_data), len(empty_stack))
+    sample_indices = np.unique(
+        np.linspace(0, n_images - 1, min(n_samples, n_images)).astype(int)
+    )
+
+    offsets = find_empty_offsets(
+        params, image_data[sample_indices], empty_stack[sample_indices]
+    )
+
+    y, x = np.round(np.median(offsets, axis=0)).astype(int)
+
+    return int(y), int(x)
+
+
+def find_empty_offsets(
+    params, image_data, empty_stack, empty_spectra=None, batch_size=16, tie=1e-6
+):
+    """Finds the alignment of the empty channel to each frame of a channel, as
+    subtract_phase does with match_template, but for batches of frames at once with
+    match_template_fft. The transforms of the empty frames can be given, as they are
+    the same for every channel of the FOV (see template_spectra).
+
+    Where the best alignment is not better than the next best by more than tie, the
+    FFT and match_template could pick different ones, so match_template is used for
+    that frame.
+
+    Parameters
+    empty_spectra : np.ndarray
+        template_spectra of the empty stack for the padded channel size.
+
+    Returns
+    offsets : np.ndarray
+        int array (t, 2) of the (y, x) position of the empty channel in each padded
+        frame, as used by subtract_phase.
+
+    Called by
+    find_empty_offset
+    subtract_frames
+    """
+
+    pad_size = params["subtract"]["alignment_pad"]
+
+    n_images = min(len(image_data), len(empty_stack))
+    offsets = np.zeros((n_images, 2), dtype=int)
+    for b_start in range(0, n_images, batch_size):
+        b_end = min(b_start + batch_size, n_images)
+        padded_chnls = np.pad(
+            image_data[b_start:b_end],
+            [[0, 0], [pad_size, pad_size], [pad_size, pad_size]],
+            mode="reflect",
+        )
+        empty_chnls = np.asarray(empty_stack[b_start:b_end])
+        spectra = None
+        if empty_spectra is not None:
+            spectra = empty_spectra[b_start:b_end]
+
+        match_results = match_template_fft(padded_chnls, empty_chnls, spectra)
+        match_results = match_results.reshape(len(match_results), -1)
+
+        # the best and the next best alignment of each frame
+        best = np.argmax(match_results, axis=1)
+        best_values = match_results[np.arange(len(best)), best]
+        match_results[np.arange(len(best)), best] = -np.inf
+        next_values = match_results.max(axis=1)
+
+        ys, xs = np.unravel_index(
+            best,
+            (
+                padded_chnls.shape[1] - empty_chnls.shape[1] + 1,
+                padded_chnls.shape[2] - empty_chnls.shape[2] + 1,
+            ),
+        )
+        offsets[b_start:b_end, 0] = ys
+        offsets[b_start:b_end, 1] = xs
+
+        for i in np.flatnonzero(best_values - next_values <= tie):
+            match_result = match_template(padded_chnls[i], empty_chnls[i])
+            offsets[b_start + i] = np.unravel_index(
+                np.argmax(match_result), match_result.shape
+            )
+
+    return offsets
+
+
+# memory mapped stacks the subtraction workers share
+def make_scratch_dir(params, n_bytes=None):
+    """Makes the directory for the stacks shared with the subtraction workers. It is
+    in /dev/shm where there is one with room for n_bytes, the most the shared stacks
+    take at once, so the stacks stay in memory, and in the analysis directory
+    otherwise. A memory map written past the space left in /dev/shm kills the process
+    (SIGBUS), so /dev/shm is not used if n_bytes is not known.
+
+    Called by
+    subtract
+    """
+
+    scratch_name = "mm3_subtract_%d" % os.getpid()
+    scratch_dir = os.path.join(params["ana_dir"], scratch_name)
+    if os.path.isdir("/dev/shm") and n_bytes is not None:
+        if shutil.disk_usage("/dev/shm").free > n_bytes:
+            scratch_dir = os.path.join("/dev/shm", scratch_name)
+        else:
+            information(
+                "%.2f GB do not fit in /dev/shm, sharing the stacks through %s."
+                % (n_bytes / 1024.0**3, params["ana_dir"])
+            )
+    if not os.path.exists(scratch_dir):
+        os.makedirs(scratch_dir)
+
+    return scratch_dir
+
+
+def share_stack(scratch_dir, name, shape, dtype, data=None):
+    """Creates a memory mapped .npy stack in scratch_dir which the workers can open by
+    its path, filled with data if given.
+
+    Returns
+    stack : np.memmap
+    """
+
+    stack = np.lib.format.open_memmap(
+        shared_stack_path(scratch_dir, name), mode="w+", dtype=dtype, shape=shape
+    )
+    if data is not None:
+        stack[:] = data
+
+    return stack
+
+
+def subtract_frames(params, stack_paths, t_start, t_end, offset=None):
+    """Subtracts (phase) the frames t_start to t_end of a channel stack shared with
+    share_stack and writes them to the shared output stack. Only the paths and frame
+    indices are sent to the worker, the frames are read from and written to the
+    memory maps. Without an offset each frame is aligned to the empty with
+    find_empty_offsets.
+
+    Parameters
+    stack_paths : tuple
+        paths of the channel, empty and output stacks, and of the transforms of the
+        empty stack (see template_spectra), which may be None.
+
+    Returns
+    n_frames : int
+        number of frames subtracted.
+
+    Called by
+    subtract
+    """
+
+    channel_path, empty_path, subtracted_path, spectra_path = stack_paths
+    image_data = np.load(channel_path, mmap_mode="r")
+    avg_empty_stack = np.load(empty_path, mmap_mode="r")
+    subtracted_stack = np.load(subtracted_path, mmap_mode="r+")
+
+    # the empty can be shorter than the channels the blocks are made for
+    t_end = min(t_end, len(subtracted_stack))
+    if t_end <= t_start:
+        return 0
+
+    if offset is None:
+        empty_spectra = None
+        if spectra_path is not None:
+            empty_spectra = np.load(spectra_path, mmap_mode="r")[t_start:t_end]
+        offsets = find_empty_offsets(
+            params,
+            image_data[t_start:t_end],
+            avg_empty_stack[t_start:t_end],
+            empty_spectra,
+        )
+    else:
+        offsets = [offset] * (t_end - t_start)
+
+    for t, frame_offset in zip(range(t_start, t_end), offsets):
+        subtracted_stack[t] = subtract_phase(
+            params, image_data[t], avg_empty_stack[t], tuple(frame_offset)
+        )
+    subtracted_stack.flush()
+
+    return t_end - t_start
 
 
 def subtract_fluor(params, cropped_channel, empty_channel):
@@ -87,55 +297,79 @@ def subtract_fluor(params, cropped_channel, empty_channel):
     Returns
     channel_subtracted : np.array
         The subtracted image.
+    """
+
+    return subtract_fluor_stack(
+        params, cropped_channel[np.newaxis], empty_channel[np.newaxis]
+    )[0]
+
+
+def fit_empty_stack(empty_stack, crop_size):
+    """Pads (with the edge values, evenly on both sides) or trims the frames of an empty
+    stack (t, y, x) so they are crop_size (y, x), the size of the channel.
 
     Called by
-    subtract_fov_stack
+    subtract_fluor_stack
     """
 
     # check frame size of cropped channel and background, always keep crop channel size the same
-    crop_size = np.shape(cropped_channel)[:2]
-    empty_size = np.shape(empty_channel)[:2]
-    if crop_size != empty_size:
-        if crop_size[0] > empty_size[0] or crop_size[1] > empty_size[1]:
-            pad_row_length = max(crop_size[0] - empty_size[0], 0)  # prevent negatives
-            pad_column_length = max(crop_size[1] - empty_size[1], 0)
-            empty_channel = np.pad(
-                empty_channel,
+    empty_size = empty_stack.shape[1:3]
+    if tuple(crop_size) == tuple(empty_size):
+        return empty_stack
+
+    if crop_size[0] > empty_size[0] or crop_size[1] > empty_size[1]:
+        pad_row_length = max(crop_size[0] - empty_size[0], 0)  # prevent negatives
+        pad_column_length = max(crop_size[1] - empty_size[1], 0)
+        empty_stack = np.pad(
+            empty_stack,
+            [
+                [0, 0],
+                [int(0.5 * pad_row_length), pad_row_length - int(0.5 * pad_row_length)],
                 [
-                    [
-                        np.int(0.5 * pad_row_length),
-                        pad_row_length - np.int(0.5 * pad_row_length),
-                    ],
-                    [
-                        np.int(0.5 * pad_column_length),
-                        pad_column_length - np.int(0.5 * pad_column_length),
-                    ],
-                    [0, 0],
+                    int(0.5 * pad_column_length),
+                    pad_column_length - int(0.5 * pad_column_length),
                 ],
-                "edge",
-            )
-            # mm3.information('size adjusted 1')
-        empty_size = np.shape(empty_channel)[:2]
-        if crop_size[0] < empty_size[0] or crop_size[1] < empty_size[1]:
-            empty_channel = empty_channel[
-                : crop_size[0],
-                : crop_size[1],
-            ]
+            ],
+            "edge",
+        )
 
-    ### Compute the difference between the empty and channel phase contrast images
-    # subtract cropped cell image from empty channel.
-    channel_subtracted = cropped_channel.astype("int32") - empty_channel.astype("int32")
-    # channel_subtracted = cropped_channel.astype('int32') - aligned_empty.astype('int32')
+    return empty_stack[:, : crop_size[0], : crop_size[1]]
 
-    # just zero out anything less than 0.
-    channel_subtracted[channel_subtracted < 0] = 0
-    channel_subtracted = channel_subtracted.astype("uint16")  # change back to 16bit
 
-    return channel_subtracted
+def subtract_fluor_stack(params, image_stack, empty_stack, out=None):
+    """Subtracts the empty stack from a fluorescence channel stack (t, y, x), all frames
+    at once. Like subtract_fluor there is no alignment, and values below zero are set to
+    zero. The subtraction is done in 16 bit, as image - min(image, empty), so there
+    are no 32 bit copies of the stack.
+
+    Parameters
+    out : np.ndarray
+        uint16 array (t, y, x) the result is written to, e.g. a buffer reused for the
+        peaks of an FOV. A new array is made if None.
+
+    Returns
+    subtracted_stack : np.ndarray
+        uint16 array of the frames both stacks have.
+
+    Called by
+    subtract_fluor
+    subtract_fluor_peak
+    """
+
+    n_frames = min(len(image_stack), len(empty_stack))
+    image_stack = np.asarray(image_stack[:n_frames], dtype="uint16")
+    empty_stack = fit_empty_stack(
+        np.asarray(empty_stack[:n_frames], dtype="uint16"), image_stack.shape[1:3]
+    )
+
+    if out is None:
+        out = np.empty(image_stack.shape, dtype="uint16")
 
+    # saturating subtraction, anything less than 0 is 0
+    np.minimum(image_stack, empty_stack, out=out)
+    np.subtract(image_stack, out, out=out)
 
-def subtract_fluor_helper(all_args):
-    return subtract_phase(*all_args)
+    return out
 
 
 # this function is used when one FOV doesn't have an empty
@@ -168,112 +402,46 @@ def copy_empty_stack(params, empty_dir, from_fov, to_fov, color="c1"):
         h5ds = h5f.create_dataset(
             "empty_%s" % color,
             data=avg_empty_stack,
-            chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-            maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-            compression="gzip",
-            shuffle=True,
-            fletcher32=True,
+            **hdf5_dataset_kwargs(params, avg_empty_stack.shape)
         )
 
         # give attribute which says which channels contribute. Just put 0
         h5ds.attrs.create("empty_channels", [0])
         h5f.close()
 
-    information("Saved empty channel for FOV %d." % to_fov)
+    if params["output"] == "Zarr":
+        zarray = save_zarr_stack(params, to_fov, "empty_%s" % color, avg_empty_stack)
+        # give attribute which says which channels contribute. Just put 0
+        zarray.attrs["empty_channels"] = [0]
 
+    information("Saved empty channel for FOV %d." % to_fov)
 
-# Do subtraction for an fov over many timepoints
-def subtract_fov_stack(params, sub_dir, fov_id, specs, color="c1", method="phase"):
-    """
-    For a given FOV, loads the precomputed empty stack and does subtraction on
-    all peaks in the FOV designated to be analyzed
 
-    Parameters
-    ----------
-    color : string, 'c1', 'c2', etc.
-        This is the channel to subtraction. will be appended to the word empty.
+# save a subtracted stack in the output format
+def save_subtracted_stack(
+    params, sub_dir, fov_id, peak_id, subtracted_stack, color="c1"
+):
+    """Saves the subtracted stack of a peak as a TIFF, to the HDF5 file or to the Zarr
+    store of the FOV, and shows it in the viewer if there is one.
 
     Called by
-    mm3_Subtract.py
-
-    Calls
-    mm3.subtract_phase
-
+    save_shared_subtracted
+    subtract_fluor_peak
     """
 
-    information("Subtracting peaks for FOV %d." % fov_id)
-
-    # load empty stack feed dummy peak number to get empty
-    avg_empty_stack = load_stack(params, fov_id, 0, color="empty_{}".format(color))
-
-    # determine which peaks are to be analyzed
-    ana_peak_ids = []
-    for peak_id, spec in six.iteritems(specs[fov_id]):
-        if spec == 1:  # 0 means it should be used for empty, -1 is ignore
-            ana_peak_ids.append(peak_id)
-    ana_peak_ids = sorted(ana_peak_ids)  # sort for repeatability
-    information("Subtracting %d channels for FOV %d." % (len(ana_peak_ids), fov_id))
-
-    # just break if there are to peaks to analize
-    if not ana_peak_ids:
-        return False
-
-    # load images for the peak and get phase images'
-    out_counter = 0
-    for peak_id in ana_peak_ids:
-        information("Subtracting peak %d." % peak_id)
-
-        image_data = load_stack(params, fov_id, peak_id, color=color)
-
-        # make a list for all time points to send to a multiprocessing pool
-        # list will length of image_data with tuples (image, empty)
-        subtract_pairs = zip(image_data, avg_empty_stack)
-
-        # set up multiprocessing pool to do subtraction. Should wait until finished
-        pool = Pool(processes=params["num_analyzers"])
-
-        if method == "phase":
-            subtract_args = [(params, pair[0], pair[1]) for pair in subtract_pairs]
-            subtracted_imgs = pool.map(
-                subtract_phase_helper, subtract_args, chunksize=10
-            )
-        elif method == "fluor":
-            subtract_args = [(params, pair[0], pair[1]) for pair in subtract_pairs]
-            subtracted_imgs = pool.map(
-                subtract_fluor_helper, subtract_args, chunksize=10
-            )
-
-        pool.close()  # tells the process nothing more will be added.
-        pool.join()  # blocks script until everything has been processed and workers exit
-
-        # linear loop for debug
-        # subtracted_imgs = [subtract_phase(subtract_pair) for subtract_pair in subtract_pairs]
-
-        # stack them up along a time axis
-        subtracted_stack = np.stack(subtracted_imgs, axis=0)
-
-        # save out the subtracted stack
-        if params["output"] == "TIFF":
-            sub_filename = params["experiment_name"] + "_xy%03d_p%04d_sub_%s.tif" % (
-                fov_id,
-                peak_id,
-                color,
-            )
-            # TODO: Make this respect compression levels
-            tiff.imsave(sub_dir / sub_filename, subtracted_stack, compress=4)  # save it
-
-            # if fov_id < 3:
-            napari.current_viewer().add_image(
-                subtracted_stack,
-                name="Subtracted" + "_xy%03d_p%04d" % (fov_id, peak_id),
-                visible=True,
-            )
-
-        if params["output"] == "HDF5":
-            h5f = h5py.File(
-                os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id), "r+"
-            )
+    if params["output"] == "TIFF":
+        sub_filename = params["experiment_name"] + "_xy%03d_p%04d_sub_%s.tif" % (
+            fov_id,
+            peak_id,
+            color,
+        )
+        # TODO: Make this respect compression levels
+        tiff.imsave(sub_dir / sub_filename, subtracted_stack, compress=4)  # save it
 
+    if params["output"] == "HDF5":
+        with h5py.File(
+            os.path.join(params["hdf5_dir"], "xy%03d.hdf5" % fov_id), "r+"
+        ) as h5f:
             # put subtracted channel in correct group
             h5g = h5f["channel_%04d" % peak_id]
 
@@ -284,19 +452,26 @@ def subtract_fov_stack(params, sub_dir, fov_id, specs, color="c1", method="phase
             h5ds = h5g.create_dataset(
                 "p%04d_sub_%s" % (peak_id, color),
                 data=subtracted_stack,
-                chunks=(1, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                maxshape=(None, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                compression="gzip",
-                shuffle=True,
-                fletcher32=True,
+                **hdf5_dataset_kwargs(params, subtracted_stack.shape)
             )
 
-        information("Saved subtracted channel %d." % peak_id)
-
-    if params["output"] == "HDF5":
-        h5f.close()
+    if params["output"] == "Zarr":
+        save_zarr_stack(
+            params,
+            fov_id,
+            "channel_%04d/p%04d_sub_%s" % (peak_id, peak_id, color),
+            subtracted_stack,
+        )
 
-    return True
+    # there is no viewer when run headless
+    viewer = napari.current_viewer()
+    if params["output"] in ("TIFF", "Zarr") and viewer is not None:
+        # if fov_id < 3:
+        viewer.add_image(
+            np.array(subtracted_stack),
+            name="Subtracted" + "_xy%03d_p%04d" % (fov_id, peak_id),
+            visible=True,
+        )
 
 
 # averages a list of empty channels
@@ -313,7 +488,7 @@ def average_empties(params, imgs, align=True):
     of the original images
 
     Called by
-    average_empties_stack
+    average_empties_block
     """
 
     aligned_imgs = []  # list contains the aligned, padded images
@@ -365,79 +540,49 @@ def average_empties(params, imgs, align=True):
     return avg_empty
 
 
-# average empty channels from stacks, making another TIFF stack
-def average_empties_stack(params, empty_dir, fov_id, specs, color="c1", align=True):
-    """Takes the fov file name and the peak names of the designated empties,
-    averages them and saves the image
-
-    Parameters
-    fov_id : int
-        FOV number
-    specs : dict
-        specifies whether a channel should be analyzed (1), used for making
-        an average empty (0), or ignored (-1).
-    color : string
-        Which plane to use.
-    align : boolean
-        Flag that is passed to the worker function average_empties, indicates
-        whether images should be aligned be for averaging (use False for fluorescent images)
+# averages the empties of a block of time points
+def average_empties_block(
+    params, fov_id, empty_peak_ids, t_start, t_end, color, align, empty_path
+):
+    """Averages the empty channels of the frames t_start to t_end and writes them to
+    the shared empty stack at empty_path (see share_stack). Only this block of frames
+    is read from each empty channel, so a worker holds a few frames of each at a time.
+    With one empty channel its frames are copied.
 
     Returns
-        True if succesful.
-        Saves empty stack to analysis folder
+    n_frames : int
+        number of frames averaged.
 
+    Called by
+    subtract
     """
 
-    information("Creating average empty channel for FOV %d." % fov_id)
-
-    # get peak ids of empty channels for this fov
-    empty_peak_ids = []
-    for peak_id, spec in six.iteritems(specs[fov_id]):
-        if spec == 0:  # 0 means it should be used for empty
-            empty_peak_ids.append(peak_id)
-    empty_peak_ids = sorted(empty_peak_ids)  # sort for repeatability
-
-    # depending on how many empties there are choose what to do
-    # if there is no empty the user is going to have to copy another empty stack
-    if len(empty_peak_ids) == 0:
-        information("No empty channel designated for FOV %d." % fov_id)
-        return False
-
-    # if there is just one then you can just copy that channel
-    elif len(empty_peak_ids) == 1:
-        peak_id = empty_peak_ids[0]
-        information("One empty channel (%d) designated for FOV %d." % (peak_id, fov_id))
-
-        # load the one phase contrast as the empties
-        avg_empty_stack = load_stack(params, fov_id, peak_id, color=color)
-
-    # but if there is more than one empty you need to align and average them per timepoint
-    elif len(empty_peak_ids) > 1:
-        # load the image stacks into memory
-        empty_stacks = []  # list which holds phase image stacks of designated empties
-        for peak_id in empty_peak_ids:
-            # load data and append to list
-            image_data = load_stack(params, fov_id, peak_id, color=color)
-
-            empty_stacks.append(image_data)
-
-        information(
-            "%d empty channels designated for FOV %d." % (len(empty_stacks), fov_id)
-        )
+    empty_blocks = [
+        load_stack(params, fov_id, peak_id, color=color, frames=(t_start, t_end))
+        for peak_id in empty_peak_ids
+    ]
+    avg_empty_stack = np.load(empty_path, mmap_mode="r+")
 
-        # go through time points and create list of averaged empties
-        avg_empty_stack = []  # list will be later concatentated into numpy array
-        time_points = range(image_data.shape[0])  # index is time
-        for t in time_points:
+    if len(empty_blocks) == 1:
+        avg_empty_stack[t_start:t_end] = empty_blocks[0]
+    else:
+        for t in range(t_end - t_start):
             # get images from one timepoint at a time and send to alignment and averaging
-            imgs = [stack[t] for stack in empty_stacks]
-            avg_empty = average_empties(
-                params, empty_dir, imgs, align=align
-            )  # function is in mm3
-            avg_empty_stack.append(avg_empty)
+            imgs = [block[t] for block in empty_blocks]
+            avg_empty_stack[t_start + t] = average_empties(params, imgs, align=align)
+    avg_empty_stack.flush()
 
-        # concatenate list and then save out to tiff stack
-        avg_empty_stack = np.stack(avg_empty_stack, axis=0)
+    return t_end - t_start
+
+
+# save an averaged empty stack in the output format
+def save_empty_stack(params, empty_dir, fov_id, avg_empty_stack, empty_peak_ids, color):
+    """Saves the averaged empty stack of an FOV as a TIFF, to the HDF5 file or to the
+    Zarr store of the FOV, with the peaks of the empty channels it was made from.
+
+    Called by
+    save_shared_empty
+    """
 
     # save out data
     if params["output"] == "TIFF":
@@ -459,20 +604,235 @@ def average_empties_stack(params, empty_dir, fov_id, specs, color="c1", align=Tr
         h5ds = h5f.create_dataset(
             "empty_%s" % color,
             data=avg_empty_stack,
-            chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-            maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-            compression="gzip",
-            shuffle=True,
-            fletcher32=True,
+            **hdf5_dataset_kwargs(params, avg_empty_stack.shape)
         )
 
         # give attribute which says which channels contribute
         h5ds.attrs.create("empty_channels", empty_peak_ids)
         h5f.close()
 
+    if params["output"] == "Zarr":
+        zarray = save_zarr_stack(params, fov_id, "empty_%s" % color, avg_empty_stack)
+        # give attribute which says which channels contribute
+        zarray.attrs["empty_channels"] = [int(peak_id) for peak_id in empty_peak_ids]
+
     information("Saved empty channel for FOV %d." % fov_id)
 
-    return True
+
+# tasks subtract runs on its TaskGraph (see _scheduler). The stacks are shared
+# between the tasks as memory mapped stacks in the scratch directory, named after the
+# FOV and peak, so the tasks find them by name
+def shared_stack_path(scratch_dir, name):
+    """Path of the stack share_stack makes in scratch_dir under name."""
+
+    return os.path.join(scratch_dir, name + ".npy")
+
+
+def share_empty_average(params, scratch_dir, fov_id, empty_peak_ids, n_frames, color):
+    """Makes the shared stack of n_frames the empty channels of an FOV are averaged
+    into, see average_empties_block.
+
+    Called by
+    subtract
+    """
+
+    first_frame = load_stack(
+        params, fov_id, empty_peak_ids[0], color=color, frames=(0, 1)
+    )
+    share_stack(
+        scratch_dir,
+        "xy%03d_empty" % fov_id,
+        (n_frames,) + first_frame.shape[1:],
+        first_frame.dtype,
+    )
+
+
+def save_shared_empty(params, empty_dir, scratch_dir, fov_id, empty_peak_ids, color):
+    """Saves the shared empty stack of an FOV once it is averaged. The shared stack is
+    kept for subtracting the channels of the FOV.
+
+    Called by
+    subtract
+    """
+
+    avg_empty_stack = np.load(
+        shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id), mmap_mode="r"
+    )
+    count(peaks=len(empty_peak_ids), frames=len(avg_empty_stack))
+
+    save_empty_stack(params, empty_dir, fov_id, avg_empty_stack, empty_peak_ids, color)
+
+
+def share_saved_empty(params, scratch_dir, fov_id, color):
+    """Shares the empty stack of an FOV which was saved before, made in an earlier run
+    or copied from another FOV.
+
+    Called by
+    subtract
+    """
+
+    avg_empty_stack = load_stack(params, fov_id, 0, color="empty_{}".format(color))
+    share_stack(
+        scratch_dir,
+        "xy%03d_empty" % fov_id,
+        avg_empty_stack.shape,
+        avg_empty_stack.dtype,
+        avg_empty_stack,
+    )
+
+
+def share_spectra_stack(params, scratch_dir, fov_id, padded_shape):
+    """Makes the shared stack for the transforms of the empty stack of an FOV for
+    aligning it to channels which are padded_shape once padded, see
+    empty_spectra_block. They are kept in single precision, which changes the match
+    scores by far less than the tie of find_empty_offsets.
+
+    Called by
+    subtract
+    """
+
+    n_frames = len(
+        np.load(shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id), mmap_mode="r")
+    )
+    share_stack(
+        scratch_dir,
+        "xy%03d_empty_spectra_%dx%d" % ((fov_id,) + padded_shape),
+        (n_frames, padded_shape[0], padded_shape[1] // 2 + 1),
+        np.complex64,
+    )
+
+
+def empty_spectra_block(params, scratch_dir, fov_id, padded_shape, t_start, t_end):
+    """Writes the transforms (see template_spectra) of the frames t_start to t_end of
+    the shared empty stack of an FOV to its shared transforms stack.
+
+    Returns
+    n_frames : int
+        number of frames transformed.
+
+    Called by
+    subtract
+    """
+
+    avg_empty_stack = np.load(
+        shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id), mmap_mode="r"
+    )
+    spectra = np.load(
+        shared_stack_path(
+            scratch_dir, "xy%03d_empty_spectra_%dx%d" % ((fov_id,) + padded_shape)
+        ),
+        mmap_mode="r+",
+    )
+
+    # the empty can be shorter than the channels the blocks are made for
+    t_end = min(t_end, len(spectra))
+    if t_end <= t_start:
+        return 0
+
+    spectra[t_start:t_end] = template_spectra(
+        avg_empty_stack[t_start:t_end], padded_shape
+    )
+    spectra.flush()
+
+    return t_end - t_start
+
+
+def share_channel_stack(params, scratch_dir, fov_id, peak_id, color, align_once):
+    """Loads the stack of a channel to subtract and shares it, with the output stack
+    subtract_frames writes to. If align_once the empty is aligned to the channel once
+    for all frames, as the drift was measured by compile.
+
+    Returns
+    offset : tuple
+        the alignment of the empty if align_once, else None.
+
+    Called by
+    subtract
+    """
+
+    information("Subtracting peak %d of FOV %d." % (peak_id, fov_id))
+
+    image_data = load_stack(params, fov_id, peak_id, color=color)
+    avg_empty_stack = np.load(
+        shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id), mmap_mode="r"
+    )
+    count(peaks=1, frames=len(image_data))
+    n_frames = min(len(image_data), len(avg_empty_stack))
+
+    offset = None
+    if align_once:
+        offset = find_empty_offset(params, image_data, avg_empty_stack)
+
+    share_stack(
+        scratch_dir,
+        "xy%03d_p%04d" % (fov_id, peak_id),
+        image_data.shape,
+        image_data.dtype,
+        image_data,
+    )
+    share_stack(
+        scratch_dir,
+        "xy%03d_p%04d_sub" % (fov_id, peak_id),
+        (n_frames,) + image_data.shape[1:],
+        "uint16",
+    )
+
+    return offset
+
+
+def save_shared_subtracted(params, sub_dir, scratch_dir, fov_id, peak_id, color):
+    """Saves the shared subtracted stack of a channel and removes its shared stacks.
+
+    Called by
+    subtract
+    """
+
+    channel_path = shared_stack_path(scratch_dir, "xy%03d_p%04d" % (fov_id, peak_id))
+    subtracted_path = shared_stack_path(
+        scratch_dir, "xy%03d_p%04d_sub" % (fov_id, peak_id)
+    )
+
+    subtracted_stack = np.load(subtracted_path, mmap_mode="r")
+    save_subtracted_stack(params, sub_dir, fov_id, peak_id, subtracted_stack, color)
+
+    # the files can not be removed while they are mapped on Windows
+    del subtracted_stack
+    os.remove(channel_path)
+    os.remove(subtracted_path)
+
+    information("Saved subtracted channel %d of FOV %d." % (peak_id, fov_id))
+
+
+def subtract_fluor_peak(params, sub_dir, scratch_dir, fov_id, peak_id, color):
+    """Subtracts (fluorescence) the shared empty stack of an FOV from a channel and
+    saves it.
+
+    Called by
+    subtract
+    """
+
+    image_data = load_stack(params, fov_id, peak_id, color=color)
+    avg_empty_stack = np.load(
+        shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id), mmap_mode="r"
+    )
+    count(peaks=1, frames=len(image_data))
+
+    subtracted_stack = subtract_fluor_stack(params, image_data, avg_empty_stack)
+    save_subtracted_stack(params, sub_dir, fov_id, peak_id, subtracted_stack, color)
+
+    information("Saved subtracted channel %d of FOV %d." % (peak_id, fov_id))
+
+
+def remove_fov_stacks(scratch_dir, fov_id):
+    """Removes the shared stacks of an FOV from the scratch directory.
+
+    Called by
+    subtract
+    """
+
+    for shared_filename in os.listdir(scratch_dir):
+        if shared_filename.startswith("xy%03d_" % fov_id):
+            os.remove(os.path.join(scratch_dir, shared_filename))
 
 
 def subtract(params, ana_dir: Path):
@@ -484,10 +844,11 @@ def subtract(params, ana_dir: Path):
     p = params
 
     viewer = napari.current_viewer()
-    viewer.layers.clear()
-    viewer.grid.enabled = True
-    # Set the shape better here.
-    viewer.grid.shape = (2, 20)
+    if viewer is not None:
+        viewer.layers.clear()
+        viewer.grid.enabled = True
+        # Set the shape better here.
+        viewer.grid.shape = (2, 20)
 
     user_spec_fovs = set(range_string_to_indices(p["FOV"]))
 
@@ -502,6 +863,9 @@ def subtract(params, ana_dir: Path):
     if not sub_dir.exists():
         sub_dir.mkdir()
 
+    # time each stage of the run, see _report
+    run_timer = start_run(params, "subtract")
+
     # load specs file
     specs = load_specs(params)
 
@@ -514,62 +878,350 @@ def subtract(params, ana_dir: Path):
 
     information("Found %d FOVs to process." % len(fov_id_list))
 
+    # use only as many workers, and subtract only as many FOVs and channels at once,
+    # as there is memory for, see _planner
+    n_fovs = max(min(p["num_analyzers"], len(fov_id_list)), 1)
+    n_peaks = 2 * p["num_analyzers"]
+    shared_bytes = None
+    metadata_table, channel_masks = load_planning_tables(params)
+    if metadata_table is not None:
+        subtraction_plan = plan_subtraction(
+            params, metadata_table, channel_masks, specs, fov_id_list
+        )
+        print_plan("Subtraction", subtraction_plan)
+        p["num_analyzers"] = subtraction_plan["processes"]
+        n_fovs = subtraction_plan["fovs"]
+        n_peaks = subtraction_plan["peaks"]
+        shared_bytes = subtraction_plan["shared_bytes"]
+
     # determine if we are doing fluorescence or phase subtraction, and set flags
     if sub_plane == p["phase_plane"]:
         align = True  # used when averaging empties
-        sub_method = "phase"  # used in subtract_fov_stack
+        sub_method = "phase"  # picks the subtraction tasks below
     else:
         align = False
         sub_method = "fluor"
 
-    ### Make average empty channels ###############################################################
+    # peaks used for the empties and peaks to subtract, by fov
+    empty_peak_ids = {}
+    ana_peak_ids = {}
+    for fov_id in fov_id_list:
+        empty_peak_ids[fov_id] = sorted(
+            peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 0
+        )
+        ana_peak_ids[fov_id] = sorted(
+            peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 1
+        )
+
+    # fovs with empties, FOVs without are given the empty of the closest fov with one
+    have_empty = [fov_id for fov_id in fov_id_list if empty_peak_ids[fov_id]]
+    if p["subtract"]["do_empties"] and not have_empty:
+        warning("No empty channels found. Return to channel selection")
+        run_timer.stop()
+        return
+
     if not p["subtract"]["do_empties"]:
         information("Loading precalculated empties.")
-        pass  # just skip this part and go to subtraction
-
     else:
         information("Calculating averaged empties for channel {}.".format(sub_plane))
+    if p["subtract"]["do_subtraction"]:
+        information("Subtracting channels for channel {}.".format(sub_plane))
+    else:
+        information("Skipping subtraction.")
 
-        need_empty = []  # list holds fov_ids of fov's that did not have empties
-        for fov_id in fov_id_list:
-            # send to function which will create empty stack for each fov.
-            averaging_result = average_empties_stack(
-                params, empty_dir, fov_id, specs, color=sub_plane, align=align
-            )
-            # add to list for FOVs that need to be given empties from other FOvs
-            if not averaging_result:
-                need_empty.append(fov_id)
-
-        # deal with those problem FOVs without empties
-        have_empty = list(fov_id_list.difference(set(need_empty)))  # fovs with empties
-        if not have_empty:
-            warning("No empty channels found. Return to channel selection")
-            return
-
-        for fov_id in need_empty:
-            from_fov = min(
-                have_empty, key=lambda x: abs(x - fov_id)
-            )  # find closest FOV with an empty
-            copy_result = copy_empty_stack(
-                params, empty_dir, from_fov, fov_id, color=sub_plane
+    # everything is run on one pool as a graph of tasks, see _scheduler. The empties
+    # of an FOV are averaged in blocks of frames, and its channels are subtracted in
+    # blocks of frames as soon as its empty is ready. The stacks are shared with the
+    # workers through memory maps, which are kept for n_fovs FOVs and n_peaks
+    # channels at a time
+    graph = TaskGraph(p["num_analyzers"], params)
+    graph.set_group_limit("fovs", n_fovs)
+    graph.set_group_limit("peaks", n_peaks)
+    scratch_dir = make_scratch_dir(params, shared_bytes)
+    fov_drifts = load_drift(params)
+    pad_size = p["subtract"]["alignment_pad"]
+
+    try:
+        for fov_id in sorted(fov_id_list):
+            labels = {"fov": fov_id}
+            cleanup_name = ("cleanup", fov_id)
+            empty_path = shared_stack_path(scratch_dir, "xy%03d_empty" % fov_id)
+            fov_tasks = []  # tasks which use the shared stacks of the fov
+
+            ### Make average empty channels #######################################################
+            if p["subtract"]["do_empties"] and empty_peak_ids[fov_id]:
+                n_frames = min(
+                    stack_length(params, fov_id, peak_id, color=sub_plane)
+                    for peak_id in empty_peak_ids[fov_id]
+                )
+                graph.add(
+                    ("sharing_empty", fov_id),
+                    share_empty_average,
+                    args=(
+                        params,
+                        scratch_dir,
+                        fov_id,
+                        empty_peak_ids[fov_id],
+                        n_frames,
+                        sub_plane,
+                    ),
+                    group="fovs",
+                    local=True,
+                    labels=labels,
+                    hold_until=cleanup_name,
+                )
+
+                # at most 64 frames so the blocks of the empty channels stay small
+                block_size = min(max(-(-n_frames // (4 * p["num_analyzers"])), 1), 64)
+                averaging_names = []
+                for t in range(0, n_frames, block_size):
+                    graph.add(
+                        ("averaging", fov_id, t),
+                        average_empties_block,
+                        args=(
+                            params,
+                            fov_id,
+                            empty_peak_ids[fov_id],
+                            t,
+                            min(t + block_size, n_frames),
+                            sub_plane,
+                            align,
+                            empty_path,
+                        ),
+                        deps=[("sharing_empty", fov_id)],
+                        labels=labels,
+                    )
+                    averaging_names.append(("averaging", fov_id, t))
+
+                graph.add(
+                    ("empties", fov_id),
+                    save_shared_empty,
+                    args=(
+                        params,
+                        empty_dir,
+                        scratch_dir,
+                        fov_id,
+                        empty_peak_ids[fov_id],
+                        sub_plane,
+                    ),
+                    deps=averaging_names,
+                    local=True,
+                    labels=labels,
+                )
+                fov_tasks.append(("empties", fov_id))
+
+            else:
+                empty_deps = []
+                if p["subtract"]["do_empties"]:
+                    # find closest FOV with an empty, and copy it once it is saved
+                    from_fov = min(have_empty, key=lambda x: abs(x - fov_id))
+                    graph.add(
+                        ("copying_empty", fov_id),
+                        copy_empty_stack,
+                        args=(params, empty_dir, from_fov, fov_id, sub_plane),
+                        deps=[("empties", from_fov)],
+                        local=True,
+                        labels=labels,
+                    )
+                    empty_deps = [("copying_empty", fov_id)]
+                    fov_tasks.append(("copying_empty", fov_id))
+
+                if p["subtract"]["do_subtraction"] and ana_peak_ids[fov_id]:
+                    graph.add(
+                        ("empties", fov_id),
+                        share_saved_empty,
+                        args=(params, scratch_dir, fov_id, sub_plane),
+                        deps=empty_deps,
+                        group="fovs",
+                        local=True,
+                        labels=labels,
+                        hold_until=cleanup_name,
+                    )
+                    fov_tasks.append(("empties", fov_id))
+
+            ### Subtract ##########################################################################
+            if p["subtract"]["do_subtraction"] and ana_peak_ids[fov_id]:
+                n_frames = stack_length(
+                    params, fov_id, ana_peak_ids[fov_id][0], color=sub_plane
+                )
+                # a few blocks of frames per worker, so they finish about together. The
+                # blocks are the same for all peaks, so they can share the transforms
+                block_size = max(-(-n_frames // (4 * p["num_analyzers"])), 1)
+                blocks = [
+                    (t, min(t + block_size, n_frames))
+                    for t in range(0, n_frames, block_size)
+                ]
+
+                # if compile measured the drift the empty is aligned once per peak
+                align_once = fov_drifts.get(fov_id) is not None
+
+                for peak_id in ana_peak_ids[fov_id]:
+                    peak_labels = {"fov": fov_id, "peak": peak_id}
+
+                    if sub_method == "fluor":
+                        graph.add(
+                            ("subtraction", fov_id, peak_id),
+                            subtract_fluor_peak,
+                            args=(
+                                params,
+                                sub_dir,
+                                scratch_dir,
+                                fov_id,
+                                peak_id,
+                                sub_plane,
+                            ),
+                            deps=[("empties", fov_id)],
+                            group="peaks",
+                            local=True,
+                            labels=peak_labels,
+                        )
+                        fov_tasks.append(("subtraction", fov_id, peak_id))
+                        continue
+
+                    graph.add(
+                        ("loading", fov_id, peak_id),
+                        share_channel_stack,
+                        args=(
+                            params,
+                            scratch_dir,
+                            fov_id,
+                            peak_id,
+                            sub_plane,
+                            align_once,
+                        ),
+                        deps=[("empties", fov_id)],
+                        group="peaks",
+                        local=True,
+                        labels=peak_labels,
+                        hold_until=("saving", fov_id, peak_id),
+                    )
+
+                    # the empty is aligned to every frame, its transforms are the same
+                    # for all peaks of the same size so they are only made once
+                    spectra_path = None
+                    if not align_once:
+                        channel_shape = load_stack(
+                            params, fov_id, peak_id, color=sub_plane, frames=(0, 1)
+                        ).shape[1:]
+                        padded_shape = (
+                            channel_shape[0] + 2 * pad_size,
+                            channel_shape[1] + 2 * pad_size,
+                        )
+                        spectra_name = "xy%03d_empty_spectra_%dx%d" % (
+                            (fov_id,) + padded_shape
+                        )
+                        spectra_path = shared_stack_path(scratch_dir, spectra_name)
+
+                        if ("sharing_spectra", fov_id, padded_shape) not in graph:
+                            graph.add(
+                                ("sharing_spectra", fov_id, padded_shape),
+                                share_spectra_stack,
+                                args=(params, scratch_dir, fov_id, padded_shape),
+                                deps=[("empties", fov_id)],
+                                local=True,
+                                labels=labels,
+                            )
+                            for t_start, t_end in blocks:
+                                graph.add(
+                                    ("spectra", fov_id, padded_shape, t_start),
+                                    empty_spectra_block,
+                                    args=(
+                                        params,
+                                        scratch_dir,
+                                        fov_id,
+                                        padded_shape,
+                                        t_start,
+                                        t_end,
+                                    ),
+                                    deps=[("sharing_spectra", fov_id, padded_shape)],
+                                    labels=labels,
+                                )
+
+                    stack_paths = (
+                        shared_stack_path(
+                            scratch_dir, "xy%03d_p%04d" % (fov_id, peak_id)
+                        ),
+                        empty_path,
+                        shared_stack_path(
+                            scratch_dir, "xy%03d_p%04d_sub" % (fov_id, peak_id)
+                        ),
+                        spectra_path,
+                    )
+                    subtraction_names = []
+                    for t_start, t_end in blocks:
+                        block_deps = [("loading", fov_id, peak_id)]
+                        if not align_once:
+                            block_deps.append(
+                                ("spectra", fov_id, padded_shape, t_start)
+                            )
+                        graph.add(
+                            ("subtraction", fov_id, peak_id, t_start),
+                            subtract_frames,
+                            args=(
+                                params,
+                                stack_paths,
+                                t_start,
+                                t_end,
+                                graph.output(("loading", fov_id, peak_id)),
+                            ),
+                            deps=block_deps,
+                            labels=peak_labels,
+                        )
+                        subtraction_names.append(
+                            ("subtraction", fov_id, peak_id, t_start)
+                        )
+
+                    graph.add(
+                        ("saving", fov_id, peak_id),
+                        save_shared_subtracted,
+                        args=(params, sub_dir, scratch_dir, fov_id, peak_id, sub_plane),
+                        deps=subtraction_names,
+                        local=True,
+                        labels=peak_labels,
+                    )
+                    fov_tasks.extend(
+                        [("loading", fov_id, peak_id), ("saving", fov_id, peak_id)]
+                    )
+
+            # the shared stacks of the fov are removed once all its tasks are done
+            graph.add(
+                cleanup_name,
+                remove_fov_stacks,
+                args=(scratch_dir, fov_id),
+                deps=fov_tasks,
+                local=True,
+                labels=labels,
             )
 
-    ### Subtract ##################################################################################
-    if p["subtract"]["do_subtraction"]:
-        information("Subtracting channels for channel {}.".format(sub_plane))
+        information("Waiting for empties and subtraction to finish.")
+        graph.run()
+
+    finally:
+        graph.close()
+        # also the stacks of fovs which failed
         for fov_id in fov_id_list:
-            # send to function which will create empty stack for each fov.
-            subtraction_result = subtract_fov_stack(
-                params, sub_dir, fov_id, specs, color=sub_plane, method=sub_method
-            )
-        information("Finished subtraction.")
+            remove_fov_stacks(scratch_dir, fov_id)
+        if not os.listdir(scratch_dir):
+            os.rmdir(scratch_dir)
+
+    for fov_id in sorted(fov_id_list):
+        if ("empties", fov_id) in graph.failed:
+            warning("Failed making the empty channel for FOV %d." % fov_id)
+            continue
+        for peak_id in ana_peak_ids[fov_id]:
+            if ("saving", fov_id, peak_id) in graph.failed or (
+                "subtraction",
+                fov_id,
+                peak_id,
+            ) in graph.failed:
+                warning("Failed subtracting peak %d of FOV %d." % (peak_id, fov_id))
 
-        viewer = napari.current_viewer()
+    if p["subtract"]["do_subtraction"]:
+        information("Finished subtraction.")
 
-    # Else just end, they only wanted to do empty averaging.
-    else:
-        information("Skipping subtraction.")
-        pass
+    run_timer.counts.update(fovs=len(fov_id_list))
+    run_timer.stop()
+    print_run_summary(params)
 
 
 def subtract_prepare_params(
@@ -580,6 +1232,7 @@ def subtract_prepare_params(
     FOV,
     phase_plane,
     alignment_pad,
+    memory_limit=None,
 ):
     # global params
     params = dict()
@@ -597,6 +1250,8 @@ def subtract_prepare_params(
     params["subtract"]["alignment_pad"] = alignment_pad
 
     params["num_analyzers"] = multiprocessing.cpu_count()
+    # GB the analysis may use, see _planner. None for half of the physical memory
+    params["memory_limit"] = memory_limit
 
     # useful folder shorthands for opening files
     params["TIFF_dir"] = os.path.join(
@@ -606,6 +1261,7 @@ def subtract_prepare_params(
         params["experiment_directory"], params["analysis_directory"]
     )
     params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+    params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
     params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
     params["sub_dir"] = os.path.join(params["ana_dir"], "subtracted")
     params["empty_dir"] = os.path.join(params["ana_dir"], "empties")
@@ -613,6 +1269,9 @@ def subtract_prepare_params(
     params["cell_dir"] = os.path.join(params["ana_dir"], "cell_data")
     params["track_dir"] = os.path.join(params["ana_dir"], "tracking")
 
+    # use the format Compile wrote the channels in
+    params["output"] = infer_output_format(params)
+
     return params
 
 
@@ -635,6 +1294,13 @@ def subtract_prepare_params(
     alignment_pad={
         "tooltip": "Required. Padding for images. Larger => slower, but also larger => more tolerant of size differences between template and comparison image."
     },
+    memory_limit={
+        "widget_type": "FloatSpinBox",
+        "min": 0,
+        "max": 4096,
+        "step": 0.5,
+        "tooltip": "Optional. Memory in GB subtraction may use. Fewer workers are used to stay within it. 0 uses half of the physical memory.",
+    },
 )
 def Subtract(
     working_directory=Path(),
@@ -644,15 +1310,17 @@ def Subtract(
     FOV_range: str = "",
     phase_plane="c1",
     alignment_pad: int = 10,
+    memory_limit: float = 0.0,
 ):
 
     params = subtract_prepare_params(
         output_prefix,
-        analysis_directory,
         working_directory,
+        analysis_directory,
         image_directory,
         FOV_range,
         phase_plane,
         alignment_pad,
+        memory_limit or None,
     )
     subtract(params, working_directory / analysis_directory)
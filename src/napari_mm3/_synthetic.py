@@ -0,0 +1,308 @@
+"""Synthetic mother machine experiments.
+
+write_synthetic_experiment writes TIFFs as nd2ToTIFF does, one file per FOV and
+time point with the planes stacked and the metadata as JSON in the image
+description, so they can be run through the whole pipeline without a microscope.
+The same seed always gives the same images.
+"""
+
+import json
+import os
+import numpy as np
+import tifffile as tiff
+
+from scipy import ndimage as ndi
+
+
+### Cells ###
+def grow_channel_cells(
+    rng,
+    n_frames,
+    channel_length,
+    birth_length=20.0,
+    doubling_frames=12.0,
+    cell_gap=4.0,
+):
+    """Simulates the cells in one channel. Cells are stacked from the closed end of
+    the channel, grow exponentially and divide in two when they have about doubled
+    their birth length. Cells pushed out of the open end are lost.
+
+    Parameters
+    rng : np.random.Generator
+    channel_length : float
+        length of the channel in pixels.
+    birth_length : float
+        mean length of a new born cell in pixels.
+    doubling_frames : float
+        mean number of frames for a cell to double in length.
+
+    Returns
+    cells : list
+        one array (n_cells, 2) per frame of the top and length of each cell in the
+        channel, in pixels from the closed end.
+    """
+
+    # length and growth rate per frame of each cell, from the closed end
+    lengths = []
+    rates = []
+    division_lengths = []
+    top = 0.0
+    while top < channel_length:
+        length = birth_length * rng.uniform(1.0, 2.0)
+        lengths.append(length)
+        rates.append(2 ** (1.0 / (doubling_frames * rng.uniform(0.8, 1.2))))
+        division_lengths.append(2 * birth_length * rng.uniform(0.9, 1.1))
+        top += length + cell_gap
+
+    cells = []
+    for t in range(n_frames):
+        if t > 0:
+            new_lengths, new_rates, new_division_lengths = [], [], []
+            for length, rate, division_length in zip(lengths, rates, division_lengths):
+                length = length * rate
+                if length >= division_length:
+                    # the daughters are not quite the same size
+                    split = rng.uniform(0.45, 0.55)
+                    for daughter_length in (length * split, length * (1 - split)):
+                        new_lengths.append(daughter_length - cell_gap / 2)
+                        new_rates.append(
+                            2 ** (1.0 / (doubling_frames * rng.uniform(0.8, 1.2)))
+                        )
+                        new_division_lengths.append(
+                            2 * birth_length * rng.uniform(0.9, 1.1)
+                        )
+                else:
+                    new_lengths.append(length)
+                    new_rates.append(rate)
+                    new_division_lengths.append(division_length)
+            lengths, rates, division_lengths = (
+                new_lengths,
+                new_rates,
+                new_division_lengths,
+            )
+
+        tops = np.concatenate([[0.0], np.cumsum(np.array(lengths) + cell_gap)[:-1]])
+
+        # drop the cells which have left the channel
+        in_channel = tops < channel_length
+        lengths = [l for l, keep in zip(lengths, in_channel) if keep]
+        rates = [r for r, keep in zip(rates, in_channel) if keep]
+        division_lengths = [d for d, keep in zip(division_lengths, in_channel) if keep]
+
+        cells.append(np.stack([tops[in_channel], lengths], axis=1))
+
+    return cells
+
+
+def draw_cell(image, top, length, center_x, width, value):
+    """Sets the pixels of a rod shaped cell in image to value. The cell is a
+    rectangle with round ends, lying along y from top for length pixels.
+
+    Called by
+    render_fov_frame
+    """
+
+    radius = width / 2.0
+    y1 = max(int(np.floor(top)), 0)
+    y2 = min(int(np.ceil(top + length)) + 1, image.shape[0])
+    x1 = max(int(np.floor(center_x - radius)), 0)
+    x2 = min(int(np.ceil(center_x + radius)) + 1, image.shape[1])
+    if y1 >= y2 or x1 >= x2:
+        return
+
+    yy, xx = np.mgrid[y1:y2, x1:x2].astype(np.float64) + 0.5
+
+    # distance to the line through the middle of the cell, which ends a radius
+    # from each end
+    nearest_y = np.clip(yy, top + radius, max(top + length - radius, top + radius))
+    inside = (yy - nearest_y) ** 2 + (xx - center_x) ** 2 <= radius**2
+
+    image[y1:y2, x1:x2][inside] = value
+
+
+### Images ###
+def render_fov_frame(
+    rng,
+    shape,
+    n_planes,
+    channel_xs,
+    channel_top,
+    channel_length,
+    channel_width,
+    frame_cells,
+    drift,
+    noise,
+):
+    """Draws one time point of an FOV, the phase plane followed by n_planes - 1
+    fluorescence planes.
+
+    In phase contrast the channels are brighter than the chip and the cells are
+    darker than the channels, so that subtracting the channel from an empty channel
+    leaves the cells bright. The channels open into a bright trench at the bottom,
+    which is how Compile tells which way up the image is. In fluorescence the cells
+    are bright on a dark background.
+
+    Parameters
+    shape : tuple
+        (rows, cols) of the image.
+    channel_xs : list
+        x position of the center of each channel.
+    frame_cells : list
+        cells of each channel at this time point, see grow_channel_cells.
+    drift : tuple
+        (dy, dx) the stage has moved since the first time point.
+
+    Returns
+    image : np.ndarray
+        uint16 array (n_planes, rows, cols).
+    """
+
+    dy, dx = drift
+    phase = np.full(shape, 250.0)
+    fluor = np.zeros(shape)
+    cell_width = channel_width - 2
+
+    # the trench the channels open into
+    phase[max(channel_top + dy + channel_length, 0) :] = 800.0
+
+    for channel_x, cells in zip(channel_xs, frame_cells):
+        x = channel_x + dx
+        phase[
+            channel_top + dy : channel_top + dy + channel_length,
+            max(x - channel_width // 2, 0) : max(x + channel_width // 2, 0),
+        ] = 1200.0
+        for top, length in cells:
+            draw_cell(phase, channel_top + dy + top, length, x, cell_width, 500.0)
+            draw_cell(fluor, channel_top + dy + top, length, x, cell_width, 1.0)
+
+    # the optics blur the edges a little
+    phase = ndi.gaussian_filter(phase, 1.0)
+    fluor = ndi.gaussian_filter(fluor, 1.0)
+
+    planes = [phase]
+    for plane in range(1, n_planes):
+        planes.append(100.0 + fluor * 800.0 / plane)
+
+    image = np.stack(planes) + rng.normal(0, noise, (n_planes,) + tuple(shape))
+
+    return np.clip(image, 0, 65535).astype(np.uint16)
+
+
+def write_synthetic_experiment(
+    experiment_directory,
+    experiment_name="synthetic",
+    image_directory="TIFF/",
+    n_fovs=2,
+    n_channels=12,
+    n_frames=40,
+    n_planes=2,
+    rows=320,
+    channel_width=10,
+    channel_separation=45,
+    empty_every=4,
+    max_drift=3,
+    noise=20.0,
+    seconds_per_frame=120,
+    seed=0,
+):
+    """Writes a synthetic mother machine experiment as TIFFs, named and with the
+    metadata nd2ToTIFF uses, to experiment_directory/image_directory.
+
+    Parameters
+    n_fovs, n_channels, n_frames, n_planes : int
+        size of the experiment. The first plane is phase contrast.
+    empty_every : int
+        every empty_every-th channel of an FOV has no cells. 0 for none.
+    max_drift : int
+        the stage wanders up to this many pixels in x and y from where it started.
+    noise : float
+        standard deviation of the noise added to the images.
+
+    Returns
+    experiment : dict
+        'tif_dir', the directory written to, 'filenames', the names of the TIFFs,
+        'n_images', 'channel_xs', the channel centers of each FOV at the first
+        time point, 'empty_channels', the indices of the empty channels, and
+        'drift', int array (n_frames, 2) of the (dy, dx) stage drift of each FOV.
+    """
+
+    rng = np.random.default_rng(seed)
+    tif_dir = os.path.join(experiment_directory, image_directory)
+    if not os.path.exists(tif_dir):
+        os.makedirs(tif_dir)
+
+    # the chip is the same for every FOV, with room at the sides for drift
+    cols = channel_separation * (n_channels + 1)
+    channel_xs = channel_separation * (np.arange(n_channels) + 1)
+    channel_top = rows // 8
+    channel_length = rows - 2 * channel_top
+    if empty_every:
+        empty_channels = list(range(empty_every - 1, n_channels, empty_every))
+    else:
+        empty_channels = []
+
+    planes = ["Phase"] + ["Fluor%d" % plane for plane in range(1, n_planes)]
+    start_jd = 2459000.5
+
+    filenames = []
+    fov_drifts = {}
+    for fov in range(1, n_fovs + 1):
+        fov_rng = np.random.default_rng([seed, fov])
+
+        channel_cells = [
+            (
+                [np.zeros((0, 2))] * n_frames
+                if channel in empty_channels
+                else grow_channel_cells(fov_rng, n_frames, channel_length)
+            )
+            for channel in range(n_channels)
+        ]
+
+        # the stage wanders in steps of at most a pixel
+        steps = fov_rng.integers(-1, 2, size=(n_frames, 2))
+        steps[0] = 0
+        drifts = np.clip(np.cumsum(steps, axis=0), -max_drift, max_drift)
+        fov_drifts[fov] = drifts
+
+        stage_x, stage_y = rng.uniform(-5000, 5000, size=2)
+
+        for t in range(1, n_frames + 1):
+            image = render_fov_frame(
+                fov_rng,
+                (rows, cols),
+                n_planes,
+                channel_xs,
+                channel_top,
+                channel_length,
+                channel_width,
+                [cells[t - 1] for cells in channel_cells],
+                drifts[t - 1],
+                noise,
+            )
+
+            metadata_t = {
+                "fov": fov,
+                "t": t,
+                "jd": start_jd + (t - 1) * seconds_per_frame / 86400.0,
+                "x": stage_x,
+                "y": stage_y,
+                "planes": planes,
+            }
+
+            tif_filename = experiment_name + "_t%04dxy%02d.tif" % (t, fov)
+            tiff.imsave(
+                os.path.join(tif_dir, tif_filename),
+                image,
+                description=json.dumps(metadata_t),
+                photometric="minisblack",
+            )
+            filenames.append(tif_filename)
+
+    return {
+        "tif_dir": tif_dir,
+        "filenames": filenames,
+        "n_images": len(filenames),
+        "channel_xs": channel_xs.tolist(),
+        "empty_channels": empty_channels,
+        "drift": fov_drifts,
+    }
@@ -0,0 +1,82 @@
+import os
+import time
+
+from napari_mm3 import _catalog
+from napari_mm3._catalog import RACY_SECONDS, load_catalog
+
+
+def touch(directory, filenames):
+    for fn in filenames:
+        open(os.path.join(str(directory), fn), "w").close()
+
+
+def set_dir_mtime(directory, mtime_ns):
+    os.utime(str(directory), ns=(mtime_ns, mtime_ns))
+
+
+def test_query(tmp_path):
+    touch(
+        tmp_path,
+        [
+            "exp_t0001xy01.tif",
+            "exp_t0002xy01.tif",
+            "exp_t0001xy01_1.tif",
+            "exp_t0001xy01c1.tif",
+            "exp_t0001xy02.tif",
+            "notes.tif",
+        ],
+    )
+    catalog = load_catalog(tmp_path)
+
+    assert catalog.fov_ids() == [1, 2]
+    assert catalog.query(fovs=[1], suffix="") == [
+        "exp_t0001xy01.tif",
+        "exp_t0002xy01.tif",
+    ]
+    assert catalog.query(fovs=[1], suffix="_1") == ["exp_t0001xy01_1.tif"]
+    assert catalog.query(fovs=[1], plane="c1") == ["exp_t0001xy01c1.tif"]
+    assert catalog.query(t_start=2) == ["exp_t0002xy01.tif"]
+    assert "notes.tif" in catalog.query()
+    assert catalog.query(t_end=1, suffix="") == [
+        "exp_t0001xy01.tif",
+        "exp_t0001xy02.tif",
+    ]
+    assert catalog.lookup(1, 1, "c1") == "exp_t0001xy01c1.tif"
+    assert catalog.lookup(2, 2) is None
+
+
+def test_load_catalog_invalidation(tmp_path):
+    tif_dir = tmp_path / "TIFF"
+    cache_dir = tmp_path / "analysis"
+    tif_dir.mkdir()
+    cache_dir.mkdir()
+    touch(tif_dir, ["exp_t0001xy01.tif"])
+
+    # a directory changed long before the scan is trusted, in this process and from
+    # the cache
+    old_ns = time.time_ns() - 10 * RACY_SECONDS * 10**9
+    set_dir_mtime(tif_dir, old_ns)
+    assert len(load_catalog(tif_dir, cache_dir)) == 1
+    assert os.path.exists(str(cache_dir / "image_catalog.npz"))
+
+    # a file added without changing the directory time is only seen with rescan
+    touch(tif_dir, ["exp_t0002xy01.tif"])
+    set_dir_mtime(tif_dir, old_ns)
+    _catalog._catalogs.clear()
+    assert len(load_catalog(tif_dir, cache_dir)) == 1
+    assert len(load_catalog(tif_dir, cache_dir, rescan=True)) == 2
+
+    # a changed directory time is scanned again
+    touch(tif_dir, ["exp_t0003xy01.tif"])
+    set_dir_mtime(tif_dir, old_ns + 10**9)
+    assert len(load_catalog(tif_dir, cache_dir)) == 3
+
+    # a scan in the same tick as the last change is not trusted, so a file added in
+    # that tick is found by the next load
+    now_ns = time.time_ns()
+    set_dir_mtime(tif_dir, now_ns)
+    assert len(load_catalog(tif_dir, cache_dir)) == 3
+    touch(tif_dir, ["exp_t0004xy01.tif"])
+    set_dir_mtime(tif_dir, now_ns)
+    _catalog._catalogs.clear()
+    assert len(load_catalog(tif_dir, cache_dir)) == 4
@@ -0,0 +1,18 @@
+import pytest
+
+from napari_mm3._benchmark import parse_elements_tag_loop, synthetic_elements_tag
+from napari_mm3._compile import parse_elements_tag
+
+
+@pytest.mark.parametrize("n_planes", [1, 2, 3])
+def test_parse_elements_tag(n_planes):
+    planes = ["c%d" % (i + 1) for i in range(n_planes)]
+
+    # the tags after the first have the same length, so they are read at the offsets
+    # cached for it
+    for seed in range(4):
+        blob, values = synthetic_elements_tag(planes, n_entries=200, seed=seed)
+        idata = parse_elements_tag(blob)
+
+        assert idata == values
+        assert idata == parse_elements_tag_loop(blob)
@@ -0,0 +1,43 @@
+import pytest
+
+from napari_mm3._function import TimeTable
+
+
+def make_time_table():
+    # FOV 1 misses time point 3, FOV 2 starts at time point 2
+    return TimeTable.from_arrays(
+        [1, 1, 1, 2, 2], [1, 2, 4, 2, 3], [0, 60, 180, 60, 120]
+    )
+
+
+def test_fov_times_lookups():
+    time_table = make_time_table()
+
+    assert time_table.keys() == [1, 2]
+    assert 1 in time_table and 3 not in time_table
+
+    fov_times = time_table[1]
+    assert fov_times[1] == 0
+    assert fov_times[4] == 180
+    assert fov_times.keys() == [1, 2, 4]
+    assert len(fov_times) == 3
+    assert 3 not in fov_times
+    assert fov_times.get(3) is None
+    assert fov_times.get(3, -5) == -5
+    for t in (0, 3, 5):
+        with pytest.raises(KeyError):
+            fov_times[t]
+
+    assert time_table[2][2] == 60
+    assert time_table[2].get(1) is None
+
+
+def test_time_table_round_trips(tmp_path):
+    time_table = make_time_table()
+    expected = {1: {1: 0, 2: 60, 4: 180}, 2: {2: 60, 3: 120}}
+
+    assert time_table.to_dict() == expected
+    assert TimeTable.from_dict(expected).to_dict() == expected
+
+    time_table.save(str(tmp_path / "time_table.npz"))
+    assert TimeTable.load(str(tmp_path / "time_table.npz")).to_dict() == expected
@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from napari_mm3._benchmark import pick_channels, pipeline_params
+from napari_mm3._compile import compile
+from napari_mm3._function import load_specs, load_stack
+from napari_mm3._subtract import subtract
+from napari_mm3._synthetic import write_synthetic_experiment
+
+
+@pytest.mark.parametrize(
+    "output, phase_plane",
+    [("TIFF", "c1"), ("HDF5", "c1"), ("Zarr", "c1"), ("HDF5", "c2")],
+)
+def test_compile_subtract(tmp_path, output, phase_plane):
+    if output == "Zarr":
+        pytest.importorskip("zarr")
+
+    n_frames = 6
+    write_synthetic_experiment(tmp_path, n_fovs=1, n_channels=8, n_frames=n_frames)
+    params = pipeline_params(str(tmp_path), "synthetic", 1, output)
+
+    compile(params)
+    pick_channels(params)
+
+    # subtract always works on c1, which is subtracted as fluorescence if another
+    # plane is the phase plane
+    params["phase_plane"] = phase_plane
+    subtract(params, Path(params["ana_dir"]))
+
+    # the picked channels have cells and empties, and each channel with cells has
+    # a subtracted stack of all frames, the size of its phase stack
+    specs = load_specs(params)
+    assert list(specs.keys()) == [1]
+    assert set(specs[1].values()) == {0, 1}
+    for peak_id, spec in specs[1].items():
+        if spec != 1:
+            continue
+        image_stack = load_stack(params, 1, peak_id, color="c1")
+        sub_stack = load_stack(params, 1, peak_id, color="sub_c1")
+        assert sub_stack.shape == image_stack.shape[:3]
+        assert len(sub_stack) == n_frames
+        assert sub_stack.any()
+
+        if phase_plane != "c1":
+            # fluorescence is the channel less the empty, without alignment
+            empty_stack = load_stack(params, 1, 0, color="empty_c1")
+            np.testing.assert_array_equal(
+                sub_stack, image_stack - np.minimum(image_stack, empty_stack)
+            )
@@ -0,0 +1,58 @@
+from napari_mm3._scheduler import TaskGraph
+
+
+# tasks run in the pool have to be importable
+def add(a, b):
+    return a + b
+
+
+def fail(*args):
+    raise ValueError("task failed")
+
+
+def test_failed_dependency_skips_dependents():
+    graph = TaskGraph(1)
+    try:
+        graph.add("one", add, args=(0, 1))
+        graph.add("two", add, args=(graph.output("one"), 1), deps=["one"])
+        graph.add("bad", fail, args=(graph.output("one"),), deps=["one"])
+        graph.add("after_bad", add, args=(graph.output("bad"), 1), deps=["bad"])
+        graph.add("after_after", add, args=(1, 1), deps=["after_bad", "two"])
+        graph.add("local_bad", fail, local=True)
+        graph.add("after_local", add, args=(1, 1), deps=["local_bad"])
+        graph.add("missing", add, args=(1, 1), deps=["not_in_graph"])
+        graph.run()
+    finally:
+        graph.close()
+
+    assert graph.results == {"one": 1, "two": 2}
+    assert graph.failed == {
+        "bad",
+        "after_bad",
+        "after_after",
+        "local_bad",
+        "after_local",
+        "missing",
+    }
+
+
+def test_output_items_and_group_limit():
+    graph = TaskGraph(2)
+    try:
+        graph.set_group_limit("sums", 1)
+        graph.add("pair", divmod, args=(7, 2))
+        for n in range(4):
+            graph.add(
+                ("sum", n),
+                add,
+                args=(graph.output("pair", 0), n),
+                deps=["pair"],
+                group="sums",
+            )
+        graph.run()
+    finally:
+        graph.close()
+
+    assert graph.results["pair"] == (3, 1)
+    assert [graph.results[("sum", n)] for n in range(4)] == [3, 4, 5, 6]
+    assert not graph.failed
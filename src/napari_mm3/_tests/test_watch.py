@@ -0,0 +1,63 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from napari_mm3 import _compile
+from napari_mm3._benchmark import pipeline_params
+from napari_mm3._function import load_stack, load_time_table
+from napari_mm3._synthetic import write_synthetic_experiment
+
+
+@pytest.mark.parametrize("output", ["HDF5", "Zarr"])
+def test_watch_keeps_stacks_and_time_table_in_step(tmp_path, monkeypatch, output):
+    if output == "Zarr":
+        pytest.importorskip("zarr")
+
+    experiment = write_synthetic_experiment(
+        str(tmp_path / "source"), n_fovs=1, n_channels=6, n_frames=10
+    )
+    tif_dir = tmp_path / "TIFF"
+    tif_dir.mkdir()
+
+    def deliver(t):
+        fn = "synthetic_t%04dxy01.tif" % t
+        shutil.copy(os.path.join(experiment["tif_dir"], fn), str(tif_dir / fn))
+        # old enough to be taken as fully written
+        os.utime(str(tif_dir / fn), (time.time() - 60, time.time() - 60))
+
+    for t in range(1, 5):
+        deliver(t)
+
+    # each poll ends with a sleep, which brings the next images: 6 before 5, 8
+    # before 7, 10 without 9, which is given up on and comes too late
+    batches = [[6], [5], [8], [7], [10]] + [[]] * 10 + [[9]]
+    real_sleep = time.sleep
+
+    def poll_sleep(seconds):
+        if batches:
+            for t in batches.pop(0):
+                deliver(t)
+        real_sleep(0.2)
+
+    monkeypatch.setattr(_compile.time, "sleep", poll_sleep)
+
+    params = pipeline_params(str(tmp_path), "synthetic", 1, output)
+    params["compile"]["watch"] = True
+    params["compile"]["watch_interval"] = 0.2
+    params["compile"]["watch_timeout"] = 3
+    params["compile"]["watch_gap_timeout"] = 1
+    _compile.compile(params)
+
+    assert not batches
+
+    # time points 1 to 8 and 10, with a time table entry for each frame
+    time_table = load_time_table(params["ana_dir"])
+    fov_times = time_table[1]
+    assert sorted(fov_times.keys()) == list(range(1, 10))
+    for peak_id in _compile.load_channel_masks(params)[1]:
+        assert len(load_stack(params, 1, peak_id, color="c1")) == 9
+
+    # the last frame has the time of time point 10
+    assert fov_times[9] - fov_times[8] == 2 * (fov_times[8] - fov_times[7])
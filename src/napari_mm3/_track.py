@@ -22,7 +22,9 @@ from ._function import (
     find_complete_cells,
     plot_lineage_images,
     find_cells_of_birth_label,
+    infer_output_format,
 )
+from ._report import start_run, stage_timer, count, print_run_summary
 
 
 # functions for checking if a cell has divided or not
@@ -325,7 +327,11 @@ def make_lineage_chnl_stack(params, fov_and_peak_id):
                             time_table, daughter2_id, region2, t, parent_id=leaf_id
                         )
                         Cells[leaf_id].divide(
-                            Cells[daughter1_id], Cells[daughter2_id], t
+                            params,
+                            time_table,
+                            Cells[daughter1_id],
+                            Cells[daughter2_id],
+                            t,
                         )
 
                         # remove mother from current leaves
@@ -533,6 +539,9 @@ def Track_Cells(params):
     if user_spec_fovs:
         fov_id_list[:] = [fov for fov in fov_id_list if fov in user_spec_fovs]
 
+    # time each stage of the run, see _report
+    run_timer = start_run(params, "track")
+
     ### Create cell lineages from segmented images
     information("Creating cell lineages using standard algorithm.")
 
@@ -546,7 +555,10 @@ def Track_Cells(params):
     for fov_id in fov_id_list:
         # update will add the output from make_lineages_function, which is a
         # dict of Cell entries, into Cells
-        Cells.update(make_lineages_fov(params, fov_id, specs))
+        with stage_timer(params, "lineages", fov=fov_id):
+            fov_cells = make_lineages_fov(params, fov_id, specs)
+            count(cells=len(fov_cells))
+        Cells.update(fov_cells)
 
     information("Finished lineage creation.")
 
@@ -566,6 +578,10 @@ def Track_Cells(params):
     with open(os.path.join(p["cell_dir"], "complete_cells.pkl"), "wb") as cell_file:
         pickle.dump(Complete_Cells, cell_file, protocol=pickle.HIGHEST_PROTOCOL)
 
+    run_timer.counts.update(fovs=len(fov_id_list), cells=len(Cells))
+    run_timer.stop()
+    print_run_summary(params)
+
     information("Finished curating and saving cell data.")
 
 
@@ -615,6 +631,7 @@ def track_update_params(
         params["experiment_directory"], params["analysis_directory"]
     )
     params["hdf5_dir"] = os.path.join(params["ana_dir"], "hdf5")
+    params["zarr_dir"] = os.path.join(params["ana_dir"], "zarr")
     params["chnl_dir"] = os.path.join(params["ana_dir"], "channels")
     params["empty_dir"] = os.path.join(params["ana_dir"], "empties")
     params["sub_dir"] = os.path.join(params["ana_dir"], "subtracted")
@@ -622,6 +639,9 @@ def track_update_params(
     params["cell_dir"] = os.path.join(params["ana_dir"], "cell_data")
     params["track_dir"] = os.path.join(params["ana_dir"], "tracking")
 
+    # use the format Compile wrote the channels in
+    params["output"] = infer_output_format(params)
+
     return params
 
 